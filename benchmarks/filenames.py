@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Measure the throughput and accuracy of the file name parser and series matcher.
+
+The corpus is a text file with one release name per line, optionally followed by a tab and
+the expected series name (leave it empty for movies and anything else that is not an episode).
+The matcher is built from the local TheTVDB store (--tvdb) or from a series list with one
+name per line (--series), never from the expected names in the corpus, so a file name has to
+be told apart from the other series to count as identified. benchmarks/series.txt goes with
+benchmarks/release_names.txt.
+
+Usage: benchmarks/filenames.py corpus.txt (--tvdb /tmp/mediad-tvdb.db | --series series.txt) [--threshold 0.8] [--repeat 10]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import episodename
+
+def load_corpus(filename):
+  corpus = []
+  f = open(filename, 'r')
+  try:
+    for line in f:
+      line = line.rstrip('\r\n')
+      if not line or line.startswith('#'):
+        continue
+      name, sep, expected = line.partition('\t')
+      corpus.append((name, expected.strip() or None))
+  finally:
+    f.close()
+  return corpus
+
+def load_series(filename):
+  series = []
+  f = open(filename, 'r')
+  try:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        series.append((len(series), line))
+  finally:
+    f.close()
+  return series
+
+def main():
+  parser = argparse.ArgumentParser("Benchmark the file name parser and series matcher")
+  parser.add_argument('corpus')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--tvdb', help="TheTVDB store to build the matcher from")
+  source.add_argument('--series', help="file with one series name per line to build the matcher from")
+  parser.add_argument('--threshold', type=float, default=0.8)
+  parser.add_argument('--repeat', type=int, default=10)
+  args = parser.parse_args()
+
+  corpus = load_corpus(args.corpus)
+  if args.tvdb:
+    from tvdbcache import TVDBCache
+    tvdb = TVDBCache(args.tvdb)
+    try:
+      series = tvdb.series_names()
+    finally:
+      tvdb.close()
+  else:
+    series = load_series(args.series)
+  start = time.time()
+  matcher = episodename.SeriesMatcher(series)
+  print "matcher built with %d series in %.3fs" % (len(matcher), time.time() - start)
+
+  start = time.time()
+  for i in range(args.repeat):
+    results = [matcher.identify(name, threshold=args.threshold) for name, expected in corpus]
+  elapsed = time.time() - start
+  print "%d names x %d: %.0f names/sec" % (len(corpus), args.repeat, len(corpus) * args.repeat / elapsed)
+
+  correct = wrong = missed = false_positives = 0
+  for (name, expected), result in zip(corpus, results):
+    if expected is None:
+      if result is not None:
+        false_positives += 1
+        print "  false positive: %s -> %s" % (name, result[1])
+    elif result is None:
+      missed += 1
+    elif episodename.normalize(result[1]) == episodename.normalize(expected):
+      correct += 1
+    else:
+      wrong += 1
+      print "  wrong series: %s -> %s (expected %s)" % (name, result[1], expected)
+  episodes = correct + wrong + missed
+  print "episodes: %d identified correctly, %d wrong, %d left to the classifier (%.1f%% accuracy, %.1f%% coverage)" % (
+    correct, wrong, missed, 100.0 * correct / max(correct + wrong, 1), 100.0 * (correct + wrong) / max(episodes, 1))
+  print "non-episodes: %d, %d false positives" % (len(corpus) - episodes, false_positives)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Count the kaa.metadata parses (and the time spent in them) while gathering training data.
+
+Compares the old training path, which parsed every file once to check the media type and
+again in get_video_features, with the current single-parse path of gather_training_data.
+
+Usage: benchmarks/gather_io.py <directory>
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import kaa.metadata
+import mediad
+
+class ParseCounter:
+  """Wrap kaa.metadata.parse to count the calls and the time spent in them."""
+  def __init__(self):
+    self.calls = 0
+    self.seconds = 0.0
+    self.parse = kaa.metadata.parse
+
+  def __call__(self, filename, *args, **kwargs):
+    self.calls += 1
+    start = time.time()
+    try:
+      return self.parse(filename, *args, **kwargs)
+    finally:
+      self.seconds += time.time() - start
+
+  def reset(self):
+    self.calls = 0
+    self.seconds = 0.0
+
+def legacy_gather(classifier, directory):
+  """The training loop as it was before the single-parse API: parse, check media, parse again."""
+  rows = 0
+  for path, subdirs, files in os.walk(directory):
+    for filename in files:
+      absolute_path = os.path.join(path, filename)
+      info = kaa.metadata.parse(absolute_path)
+      if info is not None and info.media == "MEDIA_AV":
+        if os.path.exists(absolute_path) and classifier.get_video_features(absolute_path) is not None:
+          rows += 1
+  return rows
+
+def main():
+  if len(sys.argv) != 2:
+    print __doc__
+    sys.exit(1)
+  directory = sys.argv[1]
+  files = sum(len(f) for p, s, f in os.walk(directory))
+
+  counter = ParseCounter()
+  kaa.metadata.parse = counter
+  #no feature cache, so every file has to be parsed in both runs
+  classifier = mediad.Classifier('/dev/null')
+
+  for name, run in (('legacy', lambda: legacy_gather(classifier, directory)),
+                    ('current', lambda: classifier.gather_training_data(directory, mediad.Video.tv))):
+    counter.reset()
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+    print "%-8s files: %d  parses: %d  parses/file: %.2f  parse time: %.3fs  total: %.3fs" % (
+      name, files, counter.calls, float(counter.calls) / max(files, 1), counter.seconds, elapsed)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Measure the startup time of mediad.py for each subcommand, and list the heavy modules it imported.
+
+Each command is run in a fresh interpreter, several times, and the median wall time is reported.
+If --max-seconds is given, the script exits with an error when any command is slower, so it can be
+used to catch startup regressions. The commands run in a temporary directory with a copy of the conf
+that logs there, so nothing is written to the checkout.
+
+Usage: benchmarks/startup.py [--conf mediad.conf] [--runs 5] [--max-seconds 0.5]
+"""
+import argparse
+import ConfigParser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+MEDIAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'mediad.py')
+
+#modules that should only be loaded by the commands that use them
+HEAVY_MODULES = ('kaa.metadata', 'numpy', 'sklearn', 'pika', 'pylab', 'matplotlib')
+
+#run mediad.main() with the given arguments, then report the time and the heavy modules that were imported
+RUNNER = """
+import json, os, sys, time
+start = time.time()
+sys.path.insert(0, os.path.dirname(%(mediad)r))
+sys.argv = [%(mediad)r] + %(argv)r
+try:
+  import mediad
+  mediad.main()
+except SystemExit:
+  pass
+elapsed = time.time() - start
+heavy = sorted(m for m in %(heavy)r if m in sys.modules)
+sys.__stderr__.write('STARTUP ' + json.dumps({'seconds': elapsed, 'modules': heavy}) + '\\n')
+"""
+
+def commands(conf):
+  return (('version', ['--version']),
+          ('help', ['--help']),
+          ('classifier status', ['--conf', conf, '--classifier', 'status']),
+          ('filename (missing file)', ['--conf', conf, '--filename', '/nonexistent/file.avi']))
+
+def temporary_conf(conf, directory):
+  """Copy the conf to directory, with the logfile moved there too. Return the filename of the copy."""
+  config = ConfigParser.SafeConfigParser()
+  config.read(conf)
+  if not config.has_section('GENERAL'):
+    config.add_section('GENERAL')
+  config.set('GENERAL', 'logfile', os.path.join(directory, 'mediad.log'))
+  filename = os.path.join(directory, 'mediad.conf')
+  f = open(filename, 'w')
+  try:
+    config.write(f)
+  finally:
+    f.close()
+  return filename
+
+def run(argv, directory):
+  code = RUNNER % {'mediad': os.path.abspath(MEDIAD), 'argv': argv, 'heavy': HEAVY_MODULES}
+  #relative paths in the conf end up in the temporary directory
+  process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=directory)
+  out, err = process.communicate()
+  for line in err.splitlines():
+    if line.startswith('STARTUP '):
+      return json.loads(line[len('STARTUP '):])
+  raise RuntimeError("command %s failed: %s" % (' '.join(argv), err))
+
+def main():
+  parser = argparse.ArgumentParser("Benchmark mediad.py startup time")
+  parser.add_argument('--conf', default=os.path.join(os.path.dirname(MEDIAD), 'mediad.conf'))
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--max-seconds', type=float, default=None)
+  args = parser.parse_args()
+
+  failed = False
+  directory = tempfile.mkdtemp(prefix='mediad-startup-')
+  try:
+    conf = temporary_conf(os.path.abspath(args.conf), directory)
+    for name, argv in commands(conf):
+      results = [run(argv, directory) for i in range(args.runs)]
+      times = sorted(r['seconds'] for r in results)
+      median = times[len(times) // 2]
+      print "%-26s median %.3fs  min %.3fs  heavy modules: %s" % (
+        name, median, times[0], ', '.join(results[0]['modules']) or 'none')
+      if args.max_seconds is not None and median > args.max_seconds:
+        print "  slower than %.3fs" % args.max_seconds
+        failed = True
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+  main()
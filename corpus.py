@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import os
+import struct
+import random
+
+#Matroska element ids, see http://www.matroska.org/technical/specs/index.html
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TRACKS = 0x1654AE6B
+CUES = 0x1C53BB6B
+VOID = 0xEC
+
+#(show, episodes per season, minutes) and (title, year) used to name the synthetic files
+SHOWS = (('The.Office.US', 24, 22), ('Breaking.Bad', 13, 47), ('Doctor.Who.2005', 13, 45),
+         ('Parks.and.Recreation', 22, 22), ('The.Wire', 12, 58), ('Seinfeld', 22, 22),
+         ('Mad.Men', 13, 47), ('Community', 22, 21), ('Top.Gear', 8, 60), ('Archer', 13, 21))
+MOVIES = (('The.Matrix', 1999), ('Heat', 1995), ('Alien', 1979), ('Inception', 2010), ('Amelie', 2001),
+          ('Brazil', 1985), ('Ran', 1985), ('Zodiac', 2007), ('Gattaca', 1997), ('Fargo', 1996))
+RELEASES = (('720p.HDTV.x264', 1280, 720, 'V_MPEG4/ISO/AVC'), ('1080p.WEB-DL.H264', 1920, 1080, 'V_MPEG4/ISO/AVC'),
+            ('HDTV.XviD', 624, 352, 'V_MS/VFW/FOURCC'), ('1080p.BluRay.x265', 1920, 1080, 'V_MPEGH/ISO/HEVC'))
+
+def encode_id(element_id):
+  """The element id with its length marker, in as few bytes as it takes."""
+  return struct.pack('>I', element_id).lstrip('\0')
+
+def encode_size(size, length=None):
+  """The data size as an EBML variable length integer, of the given length or the shortest that fits."""
+  if length is None:
+    length = 1
+    #all ones is reserved for an unknown size
+    while size >= (1 << (7 * length)) - 1:
+      length += 1
+  return struct.pack('>Q', size | (1 << (7 * length)))[8 - length:]
+
+def element(element_id, data):
+  return encode_id(element_id) + encode_size(len(data)) + data
+
+def uint(element_id, value, length=None):
+  data = struct.pack('>Q', value)
+  return element(element_id, data[8 - length:] if length else data.lstrip('\0') or '\0')
+
+def double(element_id, value):
+  return element(element_id, struct.pack('>d', value))
+
+def string(element_id, value):
+  return element(element_id, value)
+
+def track(number, track_type, codec, settings):
+  return element(0xAE, uint(0xD7, number) + uint(0x73C5, number) + uint(0x83, track_type) +
+                       string(0x86, codec) + settings)
+
+def write_matroska(filename, duration, width=1280, height=720, codec='V_MPEG4/ISO/AVC', audio_tracks=1,
+                   subtitle_tracks=0, size=None):
+  """Write a Matroska file that parses as a video of duration seconds, with a header, a seek head,
+  the segment info and the tracks, but no frames. If size is given, the file is padded to size bytes
+  with a void element that is left as a hole in the file, so it takes almost no space on disk.
+
+  """
+  info = element(INFO, uint(0x2AD7B1, 1000000) + double(0x4489, duration * 1000.0) +
+                       string(0x4D80, 'mediad') + string(0x5741, 'mediad'))
+  tracks = [track(1, 1, codec, element(0xE0, uint(0xB0, width) + uint(0xBA, height)))]
+  for i in range(audio_tracks):
+    tracks.append(track(len(tracks) + 1, 2, 'A_AAC', element(0xE1, double(0xB5, 48000.0) + uint(0x9F, 2))))
+  for i in range(subtitle_tracks):
+    tracks.append(track(len(tracks) + 1, 0x11, 'S_TEXT/UTF8', ''))
+  tracks = element(TRACKS, ''.join(tracks))
+  cues = element(CUES, '')
+
+  #the seek positions are written with a fixed length, so the size of the seek head is known up front
+  def seekhead(positions):
+    return element(SEEKHEAD, ''.join(element(SEEK, element(SEEK_ID, encode_id(element_id)) + uint(SEEK_POSITION, position, 8))
+                                     for element_id, position in positions))
+  children = ((INFO, info), (TRACKS, tracks), (CUES, cues))
+  position = len(seekhead([(element_id, 0) for element_id, data in children]))
+  positions = []
+  for element_id, data in children:
+    positions.append((element_id, position))
+    position += len(data)
+  segment_data = seekhead(positions) + info + tracks + cues
+
+  header = element(EBML, uint(0x4286, 1) + uint(0x42F7, 1) + uint(0x42F2, 4) + uint(0x42F3, 8) +
+                         string(0x4282, 'matroska') + uint(0x4287, 2) + uint(0x4285, 2))
+  void = 0
+  if size is not None:
+    #id, 8 byte size, then the padding
+    void = max(0, size - len(header) - 12 - len(segment_data) - 9)
+  segment_size = len(segment_data) + (9 + void if size is not None else 0)
+  f = open(filename, 'wb')
+  try:
+    f.write(header + encode_id(SEGMENT) + encode_size(segment_size, 8) + segment_data)
+    if size is not None:
+      f.write(encode_id(VOID) + encode_size(void, 8))
+      f.truncate(f.tell() + void)
+  finally:
+    f.close()
+
+def make_corpus(directory, count, seed=0):
+  """Write count synthetic files to directory, half named and sized like TV episodes in tv/ and half
+  like movies in movies/. Return the (tv directory, movie directory).
+
+  """
+  rng = random.Random(seed)
+  tv_dir = os.path.join(directory, 'tv')
+  movie_dir = os.path.join(directory, 'movies')
+  for path in (tv_dir, movie_dir):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+  for i in range(count):
+    release, width, height, codec = rng.choice(RELEASES)
+    if i % 2 == 0:
+      show, episodes, minutes = SHOWS[(i // 2) % len(SHOWS)]
+      number = i // 2 // len(SHOWS)
+      name = '%s.S%02dE%02d.%s.mkv' % (show, number // episodes + 1, number % episodes + 1, release)
+      filename = os.path.join(tv_dir, show.replace('.', ' '), name)
+      duration = minutes * 60 + rng.uniform(-90, 90)
+      kbps = rng.uniform(1200, 4000)
+    else:
+      title, year = MOVIES[(i // 2) % len(MOVIES)]
+      part = i // 2 // len(MOVIES)
+      name = '%s.%d.%s%s.mkv' % (title, year, release, '.CD%d' % part if part else '')
+      filename = os.path.join(movie_dir, '%s (%d)' % (title.replace('.', ' '), year), name)
+      duration = rng.uniform(85, 160) * 60
+      kbps = rng.uniform(2000, 9000)
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    write_matroska(filename, duration, width, height, codec, audio_tracks=rng.choice((1, 1, 2)),
+                   subtitle_tracks=rng.choice((0, 0, 1, 2)), size=int(duration * kbps * 1000 / 8))
+  return (tv_dir, movie_dir)
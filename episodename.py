@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import os
+import re
+#the store and the matcher have to normalize series names the same way
+from tvdbcache import normalize
+
+#Episode markers in release names, tried in order. Everything before the marker is the series name.
+EPISODE_PATTERNS = (
+  #Show.Name.S01E02, S01E02E03, s1e2, S01.E02
+  ('episode', re.compile(r'[ ._\-\[(]s(?P<season>\d{1,2})[ ._\-]?e(?P<episode>\d{1,3})(?:[ ._\-]?e\d{1,3})*(?![0-9])', re.IGNORECASE)),
+  #Show.Name.1x02
+  ('episode', re.compile(r'[ ._\-\[(](?P<season>\d{1,2})x(?P<episode>\d{2,3})(?![0-9])', re.IGNORECASE)),
+  #Show Name - Season 1 Episode 2
+  ('episode', re.compile(r'[ ._\-\[(]season[ ._\-]?(?P<season>\d{1,2})[ ._\-]*episode[ ._\-]?(?P<episode>\d{1,3})(?![0-9])', re.IGNORECASE)),
+  #Show.Name.2013.05.21
+  ('date', re.compile(r'[ ._\-\[(](?P<year>(?:19|20)\d\d)[ ._\-](?P<month>0[1-9]|1[0-2])[ ._\-](?P<day>0[1-9]|[12]\d|3[01])(?![0-9])')),
+)
+
+#a year or a country tag at the end of a series name, "Doctor Who (2005)", "The Office US"
+SERIES_SUFFIX = re.compile(r'[ ._\-]*[(\[]?((?:19|20)\d\d|us|uk)[)\]]?$', re.IGNORECASE)
+SEPARATORS = re.compile(r'[._\s]+')
+GROUP_PREFIX = re.compile(r'^\[[^\]]*\][ ._\-]*')
+
+class EpisodeName:
+  """The series name and episode (or air date) found in a file name."""
+  def __init__(self, series, season=None, episode=None, aired=None):
+    self.series = series
+    self.season = season
+    self.episode = episode
+    self.aired = aired
+
+  def __repr__(self):
+    if self.aired:
+      return "%s %s" % (self.series, self.aired)
+    return "%s S%02dE%02d" % (self.series, self.season, self.episode)
+
+def parse(filename):
+  """Find the series name and episode in a file name. Return an EpisodeName, or None if the name
+  does not look like an episode.
+
+  """
+  name = os.path.splitext(os.path.basename(filename))[0]
+  name = GROUP_PREFIX.sub('', name)
+  #a leading separator lets the patterns require one before the marker
+  name = ' ' + name
+  for kind, pattern in EPISODE_PATTERNS:
+    match = pattern.search(name)
+    if match is None:
+      continue
+    series = SEPARATORS.sub(' ', name[:match.start()]).strip(' -_')
+    if not series:
+      #the series is often only in the directory name, "Show Name/Season 1/S01E02.mkv"
+      parent = os.path.basename(os.path.dirname(filename))
+      if parent.lower().startswith('season'):
+        parent = os.path.basename(os.path.dirname(os.path.dirname(filename)))
+      series = SEPARATORS.sub(' ', GROUP_PREFIX.sub('', parent)).strip(' -_')
+    if not series:
+      return None
+    if kind == 'date':
+      return EpisodeName(series, aired="%s-%s-%s" % (match.group('year'), match.group('month'), match.group('day')))
+    return EpisodeName(series, season=int(match.group('season')), episode=int(match.group('episode')))
+  return None
+
+def trigrams(name):
+  """Return the set of character trigrams of the normalized name, padded so short names still have some."""
+  text = '  %s ' % normalize(name)
+  return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class SeriesMatcher:
+  """
+  Fuzzy matching of series names against a fixed list of known series.
+
+  The names are indexed by character trigram when the matcher is built. A lookup only
+  scores the series that share a trigram with the name, using the Jaccard similarity of
+  the trigram sets (or how much of the name is contained in the series name), so it
+  stays fast with many thousands of known series.
+  """
+  def __init__(self, series):
+    """series is a list of (id, name) tuples."""
+    self.names = {}
+    self.grams = {}
+    self.index = {}
+    self.exact = {}
+    for series_id, name in series:
+      grams = trigrams(name)
+      self.names[series_id] = name
+      self.grams[series_id] = len(grams)
+      self.exact.setdefault(normalize(name), series_id)
+      for gram in grams:
+        self.index.setdefault(gram, []).append(series_id)
+
+  def __len__(self):
+    return len(self.names)
+
+  def match(self, name):
+    """Return the (series id, name, score) of the best match, with a score between 0 and 1,
+    or None if no known series shares anything with the name.
+
+    """
+    normalized = normalize(name)
+    if normalized in self.exact:
+      series_id = self.exact[normalized]
+      return (series_id, self.names[series_id], 1.0)
+    #the year or country tag is often missing from one of the names
+    stripped = normalize(SERIES_SUFFIX.sub('', name))
+    if stripped in self.exact:
+      series_id = self.exact[stripped]
+      return (series_id, self.names[series_id], 0.95)
+    grams = trigrams(name)
+    shared = {}
+    for gram in grams:
+      for series_id in self.index.get(gram, ()):
+        shared[series_id] = shared.get(series_id, 0) + 1
+    #a long enough name that is contained in a known name ("The Daily Show" in "The Daily Show with
+    #Jon Stewart") is a good match even though the trigram sets differ a lot in size
+    contained = len(normalized) >= 8
+    best = None
+    for series_id, count in shared.iteritems():
+      score = float(count) / (len(grams) + self.grams[series_id] - count)
+      if contained:
+        score = max(score, 0.85 * count / len(grams))
+      if best is None or score > best[2]:
+        best = (series_id, self.names[series_id], score)
+    return best
+
+  def identify(self, filename, threshold=0.8):
+    """Return (series id, series name, EpisodeName) if the file name is an episode of a known series
+    with a score of at least threshold, otherwise None.
+
+    """
+    parsed = parse(filename)
+    if parsed is None:
+      return None
+    match = self.match(parsed.series)
+    if match is None or match[2] < threshold:
+      return None
+    return (match[0], match[1], parsed)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+import os
+import json
+import sqlite3
+import threading
+
+class FeatureCache:
+  """
+  A persistent cache of video feature rows.
+
+  Rows are keyed by the device, inode, size and mtime of the file, so a file that has
+  not changed since it was last parsed can be looked up with a single stat() instead
+  of running it through kaa.metadata again. Files that are not videos are cached too
+  (with a row of None) so they are not re-parsed on every start.
+
+  Each row is stored with the feature schema it was built with, rows from another
+  schema are treated as a miss. Rows also record whether the file was added to the
+  training set, which is separate from being cached: classifyd caches every file it
+  classifies, and a file keeps its key when it is renamed into the library.
+  """
+  def __init__(self, filename, schema=''):
+    self.filename = os.path.abspath(filename)
+    self.schema = schema
+    #the cache can be read from a pool's feeder thread while the main thread writes to it
+    self.lock = threading.RLock()
+    self.connect()
+    self.pending = 0
+
+  def connect(self):
+    #other processes (forked classifyd workers, --local, a retrain) share the cache, a write lock that is
+    #not released quickly is treated as a miss instead of blocking a request
+    self.connection = sqlite3.connect(self.filename, timeout=2, check_same_thread=False)
+    #the cache is rebuildable, so trade durability for write speed
+    self.connection.execute("PRAGMA synchronous=OFF")
+    self.connection.execute("PRAGMA journal_mode=MEMORY")
+    columns = [column[1] for column in self.connection.execute("PRAGMA table_info(features)")]
+    if columns and 'schema' not in columns:
+      #written by a version that did not record the schema
+      self.connection.execute("DROP TABLE features")
+    self.connection.execute("""CREATE TABLE IF NOT EXISTS features (
+                                 device INTEGER NOT NULL,
+                                 inode INTEGER NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 mtime REAL NOT NULL,
+                                 path TEXT,
+                                 schema TEXT,
+                                 row TEXT,
+                                 trained INTEGER NOT NULL DEFAULT 0,
+                                 PRIMARY KEY (device, inode))""")
+    if columns and 'schema' in columns and 'trained' not in columns:
+      #written by a version that took every cached file as trained, keep it that way for those rows
+      self.connection.execute("ALTER TABLE features ADD COLUMN trained INTEGER NOT NULL DEFAULT 0")
+      self.connection.execute("UPDATE features SET trained=1")
+    self.connection.commit()
+
+  def reopen(self):
+    """Open a new connection to the cache, a forked process can't use the parent's connection."""
+    self.lock = threading.RLock()
+    self.pending = 0
+    self.connect()
+
+  def __repr__(self):
+    return self.filename
+
+  def key(self, filename):
+    """Return the (device, inode, size, mtime) key for the file, or None if it can't be stat'ed."""
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+  def get(self, filename, key=None):
+    """Look up the cached row for the file.
+    Return a (hit, row) tuple. If hit is False, the file has to be parsed. A hit with a
+    row of None means the file was parsed before and is not a video.
+
+    """
+    hit, row, trained = self.lookup(filename, key)
+    return (hit, row)
+
+  def lookup(self, filename, key=None):
+    """Like get(), but return a (hit, row, trained) tuple, where trained is True if the file
+    was added to the training set since it was cached.
+
+    """
+    key = key or self.key(filename)
+    if key is None:
+      return (False, None, False)
+    try:
+      with self.lock:
+        cursor = self.connection.execute("SELECT size, mtime, schema, row, trained FROM features WHERE device=? AND inode=?",
+                                         (key[0], key[1]))
+        result = cursor.fetchone()
+    except sqlite3.OperationalError:
+      #locked by another process, parse the file instead
+      return (False, None, False)
+    if result is None or result[0] != key[2] or result[1] != key[3] or result[2] != self.schema:
+      return (False, None, False)
+    return (True, json.loads(result[3]) if result[3] is not None else None, bool(result[4]))
+
+  def put(self, filename, row, key=None, trained=False):
+    """Store the row for the file. Writes are committed in batches, call commit() when done.
+    Return False if the row could not be stored, for example because another process holds the lock.
+
+    """
+    key = key or self.key(filename)
+    if key is None:
+      return False
+    with self.lock:
+      try:
+        self.connection.execute("INSERT OR REPLACE INTO features (device, inode, size, mtime, path, schema, row, trained) VALUES (?,?,?,?,?,?,?,?)",
+                                (key[0], key[1], key[2], key[3], filename, self.schema,
+                                 json.dumps(row) if row is not None else None, 1 if trained else 0))
+      except sqlite3.OperationalError:
+        return False
+      self.pending += 1
+      if self.pending >= 1000:
+        self.commit()
+    return True
+
+  def mark_trained(self, filenames):
+    """Record that the files were added to the training set. Return False if the cache is locked."""
+    keys = [key for key in (self.key(filename) for filename in filenames) if key is not None]
+    with self.lock:
+      try:
+        self.connection.executemany("UPDATE features SET trained=1 WHERE device=? AND inode=?",
+                                    [(key[0], key[1]) for key in keys])
+      except sqlite3.OperationalError:
+        return False
+      self.pending += len(keys)
+    return True
+
+  def commit(self):
+    """Commit any pending writes to disk. If that fails, they are dropped (the files are parsed
+    again next time) so the write lock is not held on to. Return False in that case.
+
+    """
+    with self.lock:
+      if not self.pending:
+        return True
+      self.pending = 0
+      try:
+        self.connection.commit()
+      except sqlite3.OperationalError:
+        self.connection.rollback()
+        return False
+    return True
+
+  def close(self):
+    self.commit()
+    self.connection.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+import os
+import re
+
+#Bump this when an extractor changes, so cached rows and saved models built with the old
+#extractors are detected instead of being used with the new ones
+FEATURE_SCHEMA_VERSION = 2
+
+#Release names that look like episodes: S01E02, 1x02, 2013.05.21
+EPISODE_PATTERN = re.compile(r'(^|[^a-z0-9])(s\d{1,2}[ ._-]?e\d{1,3}|\d{1,2}x\d{2,3}|(19|20)\d\d[ ._-]\d\d[ ._-]\d\d)([^a-z0-9]|$)', re.IGNORECASE)
+SEASON_PATTERN = re.compile(r'(^|[^a-z0-9])(season|series|saison|staffel)[ ._-]?\d+([^a-z0-9]|$)', re.IGNORECASE)
+YEAR_PATTERN = re.compile(r'(^|[^0-9])(19[2-9]\d|20\d\d)([^0-9]|$)')
+
+def codec_name(stream):
+  """Return the lower case codec (or fourcc) of a kaa stream, or an empty string."""
+  codec = getattr(stream, 'codec', None) or getattr(stream, 'fourcc', None) or ''
+  return str(codec).lower()
+
+def first_video(info):
+  video = getattr(info, 'video', None) or []
+  return video[0] if len(video) > 0 else None
+
+def video_attribute(name):
+  def extract(info, filename, size):
+    video = first_video(info)
+    return float(getattr(video, name, None) or 0) if video is not None else 0.0
+  return extract
+
+def stream_count(name):
+  def extract(info, filename, size):
+    return float(len(getattr(info, name, None) or []))
+  return extract
+
+def codec_is(*names):
+  def extract(info, filename, size):
+    codec = codec_name(first_video(info))
+    return 1.0 if any(name in codec for name in names) else 0.0
+  return extract
+
+def bitrate(info, filename, size):
+  """Overall bitrate in kbit/s, from the container if it has one or from the size and length."""
+  value = getattr(info, 'bitrate', None)
+  if value:
+    return float(value) / 1000
+  length = float(getattr(info, 'length', None) or 0)
+  return (size * 8 / length / 1000) if length > 0 else 0.0
+
+def path_matches(pattern):
+  def extract(info, filename, size):
+    return 1.0 if filename and pattern.search(filename) else 0.0
+  return extract
+
+#name -> extractor(info, filename, size), every extractor returns a float
+FEATURES = {
+  'length': lambda info, filename, size: float(int(info.length or 0)),
+  'width': video_attribute('width'),
+  'height': video_attribute('height'),
+  'bitrate': bitrate,
+  'size': lambda info, filename, size: float(size) / (1024 * 1024),
+  'video_streams': stream_count('video'),
+  'audio_streams': stream_count('audio'),
+  'subtitle_streams': stream_count('subtitles'),
+  'codec_h264': codec_is('h264', 'avc', 'x264'),
+  'codec_hevc': codec_is('hevc', 'h265', 'x265'),
+  'codec_mpeg4': codec_is('xvid', 'divx', 'dx50', 'mp4v', 'mpeg4', 'fmp4'),
+  'codec_mpeg2': codec_is('mpeg2', 'mpg2', 'mpeg-2'),
+  'path_episode': path_matches(EPISODE_PATTERN),
+  'path_season': path_matches(SEASON_PATTERN),
+  'path_year': path_matches(YEAR_PATTERN),
+}
+
+#the order of the columns when no feature list is configured
+DEFAULT_FEATURES = ('length', 'width', 'height', 'bitrate', 'size', 'video_streams', 'audio_streams',
+                    'subtitle_streams', 'codec_h264', 'codec_hevc', 'codec_mpeg4', 'codec_mpeg2',
+                    'path_episode', 'path_season', 'path_year')
+
+#models saved before the schema was recorded only used the length
+LEGACY_SCHEMA = {'version': 1, 'features': ['length']}
+
+def schema(features=DEFAULT_FEATURES):
+  """Return the feature schema, stored with the model and used to key the feature cache."""
+  return {'version': FEATURE_SCHEMA_VERSION, 'features': list(features)}
+
+def schema_key(features=DEFAULT_FEATURES):
+  """Return the schema as a short string."""
+  return "%d:%s" % (FEATURE_SCHEMA_VERSION, ','.join(features))
+
+def check_features(features):
+  """Raise ValueError if a feature name is unknown."""
+  unknown = [name for name in features if name not in FEATURES]
+  if unknown:
+    raise ValueError("unknown features: %s (known features are %s)" % (', '.join(unknown), ', '.join(sorted(FEATURES))))
+
+def matrix(rows):
+  """Return the feature rows as one float64 NumPy matrix, built in a single call. The rows come back one
+  at a time from the parse pool and the feature cache, this is where they are put together.
+
+  """
+  import numpy
+  return numpy.array(rows, dtype=numpy.float64)
+
+def extract_features(info, filename=None, features=DEFAULT_FEATURES):
+  """Build the feature row from an info object that was already returned by kaa.metadata.parse.
+  Return a (media, row) tuple. The media is the kaa media type (or None if the file could not be parsed)
+  and the row is None unless the file is a video. The row has one float per feature, in order.
+
+  """
+  if info is None:
+    return (None, None)
+  #documentation here: http://doc.freevo.org/api/kaa/metadata/usage.html#attributes-keys
+  if info.media != "MEDIA_AV":
+    return (info.media, None)
+  size = 0
+  if filename:
+    try:
+      size = os.path.getsize(filename)
+    except OSError:
+      pass
+  row = []
+  for name in features:
+    try:
+      row.append(FEATURES[name](info, filename, size))
+    except (TypeError, ValueError, AttributeError):
+      #missing or malformed metadata
+      row.append(0.0)
+  return (info.media, row)
+
+def parse_video_file(filename, features=DEFAULT_FEATURES):
+  """Parse the file with kaa.metadata and return a (filename, row) tuple, where row is None if the file
+  is not a video. The file is parsed exactly once.
+  This is a module-level function so it can be sent to a process pool.
+
+  """
+  import kaa.metadata
+  try:
+    info = kaa.metadata.parse(filename)
+  except Exception:
+    return (filename, None)
+  media, row = extract_features(info, filename, features)
+  return (filename, row)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+class IncrementalModel:
+  """
+  A linear classifier that can absorb new labeled examples without a full refit.
+
+  The features are standardized with a running mean and variance (video lengths are
+  in seconds, which would swamp a gradient descent model) and classified with a hinge
+  loss SGDClassifier, so this behaves like a linear SVM. It has the same fit() and
+  predict() methods as svm.SVC, plus partial_fit() for new examples.
+  """
+  def __init__(self, classes=(0, 1)):
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.preprocessing import StandardScaler
+    self.classes = list(classes)
+    self.scaler = StandardScaler()
+    self.model = SGDClassifier(loss='hinge')
+    self.examples = 0
+
+  def fit(self, X, y):
+    """Train from scratch on the full training set."""
+    self.scaler.fit(X)
+    self.model.fit(self.scaler.transform(X), y)
+    self.examples = len(X)
+    return self
+
+  def partial_fit(self, X, y):
+    """Update the model with new examples."""
+    self.scaler.partial_fit(X)
+    self.model.partial_fit(self.scaler.transform(X), y, classes=self.classes)
+    self.examples += len(X)
+    return self
+
+  def predict(self, X):
+    return self.model.predict(self.scaler.transform(X))
@@ -1,20 +1,36 @@
 #!/usr/bin/env python
-from thetvdb import thetvdb
 import argparse
 import ConfigParser
 import sys
 import os
 import time
-import kaa.metadata
-import pylab as pl
-from numpy import array,vstack,hstack,mgrid,c_,shape
-from sklearn import svm
-from sklearn.externals import joblib
 from daemon import Daemon
-import pika
+from featurecache import FeatureCache
+from trainingset import TrainingSet
+from modelstore import ModelStore
+from resultcache import ResultCache
+import features
+import metrics
+from features import extract_features, parse_video_file, DEFAULT_FEATURES
+import functools
 import uuid
 import traceback
 import cPickle as pickle
+import itertools
+import re
+import json
+import socket
+import threading
+import signal
+import random
+import atexit
+import Queue
+import collections
+from multiprocessing import TimeoutError
+from multiprocessing.pool import Pool, ThreadPool
+
+#The heavy modules (kaa.metadata, numpy, sklearn, pika, pylab) are imported in the functions that
+#use them, so a command like --classifier status only pays for what it needs
 
 #Global Arguments
 version = '0.5'
@@ -22,7 +38,6 @@ args = None
 logfile_path = None
 config = None
 log = None
-response = None
 
 #tv = thetvdb.TVShow('94571')
 
@@ -33,6 +48,70 @@ class Video:
   tv=1
   movie=0
 
+#Extensions of files that are handed to kaa.metadata, anything else is skipped without opening it
+VIDEO_EXTENSIONS = ('avi','divx','mkv','webm','mp4','m4v','mov','mpg','mpeg','ts','m2ts','vob',
+                    'wmv','asf','flv','ogm','ogv','rm','rmvb','3gp')
+
+#Request priorities. Interactive requests (a few files someone is waiting for) go to the classifyd queue,
+#bulk requests (a re-index of an archive) to classifyd.bulk, which classifyd takes fewer messages from
+PRIORITY_BULK = 0
+PRIORITY_INTERACTIVE = 5
+
+#content type of a batch request (a JSON list of filenames), any other request is a single filename
+BATCH_CONTENT_TYPE = 'application/json'
+
+#Release samples are short clips that would look like tv episodes to the SVM
+SAMPLE_PATTERN = re.compile(r'(^|[\W_])sample([\W_]|$)',re.IGNORECASE)
+
+def sniff_container(filename):
+  """Read the first few bytes of the file and return True if they look like a known video container.
+  
+  """
+  try:
+    f = open(filename,'rb')
+    try:
+      header = f.read(16)
+      if len(header) >= 1 and header[0] == '\x47':
+        #mpeg transport stream, the sync byte repeats every 188 bytes
+        f.seek(188)
+        return f.read(1) == '\x47'
+      if len(header) >= 5 and header[4] == '\x47':
+        #blu-ray m2ts, every packet has a 4 byte timestamp in front, so they are 192 bytes
+        f.seek(196)
+        return f.read(1) == '\x47'
+    finally:
+      f.close()
+  except IOError:
+    return False
+  if header.startswith('\x1a\x45\xdf\xa3'):
+    #matroska / webm (EBML)
+    return True
+  if header.startswith('RIFF') and header[8:12] in ('AVI ','AVIX'):
+    return True
+  if header[4:8] in ('ftyp','moov','mdat','free','wide','skip','pnot'):
+    #mp4 / quicktime
+    return True
+  if header.startswith('\x00\x00\x01\xba') or header.startswith('\x00\x00\x01\xb3'):
+    #mpeg program stream / elementary stream
+    return True
+  if header.startswith('\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+    #asf / wmv
+    return True
+  if header.startswith('FLV') or header.startswith('OggS') or header.startswith('.RMF'):
+    return True
+  return False
+
+def sniff_and_parse(filename,features=DEFAULT_FEATURES,sniff=True):
+  """Check the container signature of the file, then parse it with parse_video_file().
+  Return a (filename, row, skipped) tuple, skipped is True if the signature was not a video container
+  and the file was not parsed. This is a module-level function so it can be sent to a process pool.
+  
+  """
+  if sniff and not sniff_container(filename):
+    return (filename,None,True)
+  filename,row = parse_video_file(filename,features)
+  return (filename,row,False)
+
 class Status():
   def __init__(self):
     self.message = 'initializing'
@@ -58,15 +137,94 @@ class Status():
       self.statistics[key] = amount
     else:
       self.statistics[key] += amount
+  
+  def set_stat(self,key,value):
+    """Replace a statistic, for values that are not counts (like a ratio)."""
+    self.statistics[key] = value
 
-class Classifier(Daemon):
+#A classify request held by classifyd until its batch is flushed
+PendingRequest = collections.namedtuple('PendingRequest',('channel','method','properties','filenames','batch',
+                                                          'received','deadline','priority'))
+
+class ClassifierStatus(Daemon):
+  """The status of classifyd as another process sees it, from its pidfile, its status socket and its last
+  status checkpoint. --classifier status only needs this, so it does not open the feature cache or the model store.
   
-  def __init__(self,pidfile,logfile_path = None,amqp_host = 'localhost',svm_save_filename = None,
-               status_filename = None, X_filename = None, y_filename = None):
-    if args:
-      self.log = Logger(logfile_path,args.verbose)
+  """
+  def __init__(self,pidfile,status_socket=None,status_filename=None,logger=None):
+    self.log = logger or log
+    self.status_socket = os.path.abspath(status_socket) if status_socket else None
+    self.status_filename = status_filename
+    Daemon.__init__(self,pidfile)
+  
+  def __repr__(self):
+    if self.get_pid() is None:
+      return "classifyd is not running"
     else:
-      self.log = Logger(logfile_path)
+      status = self.read_status()
+      return "classifyd is running (status: %s)" % (str(status.message) if status else 'unknown')
+  
+  def get_statistics(self):
+    if self.get_pid():
+      status = self.read_status()
+      return str(status.statistics) if status else None
+    return None
+  
+  def read_status(self):
+    """Get the status of the running daemon, from its status socket if it is available or from the last
+    checkpoint in status_filename otherwise. Return None if neither could be read.
+    
+    """
+    if self.status_socket and os.path.exists(self.status_socket):
+      client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      try:
+        client.settimeout(2)
+        client.connect(self.status_socket)
+        data = []
+        while True:
+          chunk = client.recv(65536)
+          if not chunk:
+            break
+          data.append(chunk)
+        result = json.loads(''.join(data))
+        status = Status()
+        status.message = result['message']
+        status.statistics = result['statistics']
+        return status
+      except (socket.error,ValueError,KeyError),e:
+        self.log.print_log_verbose("status socket %s could not be read: %s",self.status_socket,e)
+      finally:
+        client.close()
+    return self.load_pickle(self.status_filename)
+  
+  def load_pickle(self,filename = None):
+    """Load the object from the file and return it.
+    
+    """
+    if filename and os.path.exists(filename):
+      try:
+        f = open(filename,'rb')
+        result = pickle.load(f)
+        f.close()
+        self.log.print_log_verbose("Loaded object from file %s",filename)
+        return result
+      except Exception,e:
+        self.log.print_error("Pickle count not be loaded from file (%s), error was %s %s",filename,sys.exc_info()[0],e)
+        self.log.print_error("Traceback: %s",traceback.format_exc())
+        return None
+    return None
+
+class Classifier(ClassifierStatus):
+  
+  def __init__(self,pidfile,logfile_path = None,amqp_host = 'localhost',svm_save_filename = None,
+               status_filename = None, X_filename = None, y_filename = None, feature_cache_filename = None,
+               parse_workers = 1, parse_mode = 'thread', extensions = VIDEO_EXTENSIONS, sniff = True,
+               skip_samples = True, batch_size = 32, batch_window = 0.05, model = 'svc',
+               status_socket = None, status_interval = 5, feature_names = DEFAULT_FEATURES, consumers = 1,
+               heartbeat = 60, reconnect_max = 60, metrics_port = 0, metrics_host = '127.0.0.1',
+               reload_interval = 30, result_cache_size = 10000, result_cache_ttl = 300, bulk_prefetch = 1,
+               learn_batch = 50, learn_interval = 60):
+    self.log = Logger(logfile_path,args.verbose if args else False,json_lines=config_log_json())
     
     #For progress messages
     self.files_processed = 0
@@ -74,57 +232,251 @@ class Classifier(Daemon):
     #Make sure pickle supports compress
     pickle.HIGHEST_PROTOCOL
     
-    self.svc = svm.SVC(kernel="linear")
+    #created by train() or load_svm_from_file(), so sklearn is only imported by the daemon
+    self.svc = None
+    #with the incremental (sgd) model, new examples are absorbed with partial_fit instead of a full refit
+    self.incremental = (model == 'sgd')
     self.X_filename = os.path.abspath(X_filename) if X_filename else None
     self.y_filename = os.path.abspath(y_filename) if y_filename else None
+    #X and y are stored as memory-mapped files that new rows can be appended to
+    self.training_set = TrainingSet(self.X_filename,self.y_filename) if X_filename and y_filename else None
     self.__X = None
     self.__y = None
     self.amqp_host = amqp_host
     self.amqp_queue = 'classifyd'
+    #bulk requests are consumed on their own channel with a prefetch of bulk_prefetch messages, so at most that
+    #many bulk batches are ahead of an interactive request
+    self.bulk_queue = self.amqp_queue + '.bulk'
+    self.bulk_prefetch = max(1,int(bulk_prefetch))
+    #files with a known classification are learned by one process only (the first worker), which appends them
+    #to the training set and saves a model version once per learn_batch files or learn_interval seconds.
+    #Their requests are acknowledged once they are saved, so a crash loses none.
+    self.learn_queue = self.amqp_queue + '.learn'
+    self.learner = True
+    self.learner_pid = None
+    self.learn_batch = max(1,int(learn_batch))
+    self.learn_interval = float(learn_interval)
+    self.learned = []
+    self.learn_scheduled = False
+    #number of forked consumer processes, they share the model loaded before the fork
+    self.consumers = max(1,int(consumers))
+    #the consumer reconnects with exponential backoff (up to reconnect_max seconds) when the broker goes away
+    self.heartbeat = int(heartbeat)
+    self.reconnect_max = float(reconnect_max)
+    #returns a new connection to the broker, it can be replaced to run against a stand-in broker
+    self.connection_factory = self.connect
+    self.workers = {}
+    
+    #Requests are collected for up to batch_window seconds (or batch_size files) and classified together
+    self.batch_size = max(1,int(batch_size))
+    self.batch_window = float(batch_window)
+    self.pending_requests = []
+    self.flush_scheduled = False
+    self.feature_pool = None
+    self.connection = None
     self.svm_filename = os.path.abspath(svm_save_filename) if svm_save_filename else None
     
+    #Saved models are versioned. The running daemon loads a new version in the background (on SIGHUP, or
+    #when the current version changes, checked every reload_interval seconds) and swaps it in between batches
+    self.model_store = ModelStore(self.svm_filename) if self.svm_filename else None
+    self.model_version = None
+    self.loaded_version = None
+    self.next_model = None
+    self.model_lock = threading.Lock()
+    self.reload_event = threading.Event()
+    self.reload_interval = float(reload_interval)
+    
+    #Concurrent metadata parsing while gathering training data
+    self.parse_workers = max(1,int(parse_workers))
+    self.parse_mode = parse_mode
+    
+    #Classifications of files that were asked about before, keyed by path, size, mtime and model version
+    self.result_cache = ResultCache(int(result_cache_size),float(result_cache_ttl)) if int(result_cache_size) > 0 else None
+    
+    #Cheap checks done before a file is handed to kaa.metadata
+    self.extensions = frozenset(e.lower().lstrip('.') for e in extensions) if extensions else None
+    self.sniff = sniff
+    self.skip_samples = skip_samples
+    
+    #The features that make up a row, the schema is saved with the model and keys the feature cache
+    self.features = list(feature_names)
+    self.feature_schema = features.schema(self.features)
+    
+    #Cache of feature rows, so unchanged files are not parsed again
+    self.feature_cache = None
+    if feature_cache_filename:
+      try:
+        self.feature_cache = FeatureCache(feature_cache_filename,schema=features.schema_key(self.features))
+        self.log.print_log_verbose("using feature cache %s",self.feature_cache)
+      except Exception,e:
+        self.log.print_error("Feature cache could not be opened (%s), error was %s %s",feature_cache_filename,sys.exc_info()[0],e)
+    
+    #The status lives in memory, it is checkpointed to status_filename at most every status_interval
+    #seconds and served to other processes on the status_socket
     self.status_filename = status_filename
-    if self.status_filename and os.path.exists(self.status_filename):
-      #if the file exists, try to load it from there
-      f = open(self.status_filename,'rb')
-      self.status = pickle.load(f)
-      f.close()
-    else:
-      #if not, then assume we are starting over
-      self.status = Status()
+    self.status_socket = os.path.abspath(status_socket) if status_socket else None
+    self.status_interval = float(status_interval)
+    self.status_saved = 0
+    self.status_dirty = False
+    self.status = Status()
+    #Forked workers save their statistics to status_dir, where the supervisor adds them to its own.
+    self.status_dir = None
+    
+    #Per stage latencies and counters, served in the Prometheus text format on metrics_port.
+    #Forked workers save theirs to metrics_dir, where the supervisor picks them up.
+    self.metrics_host = metrics_host
+    self.metrics_port = int(metrics_port)
+    self.metrics_dir = None
+    self.metrics = metrics.Registry(prefix='classifyd_')
+    self.stage = {
+      'queue_wait': self.metrics.histogram('queue_wait_seconds','Time from the client sending a request until it was received'),
+      'batch_wait': self.metrics.histogram('batch_wait_seconds','Time a request was held for its batch'),
+      'parse': self.metrics.histogram('parse_seconds','Time spent parsing a file with kaa.metadata'),
+      'feature_build': self.metrics.histogram('feature_build_seconds','Time spent building the feature row of a parsed file'),
+      'predict': self.metrics.histogram('predict_seconds','Time spent in predict for a batch'),
+      'publish': self.metrics.histogram('publish_seconds','Time spent publishing a reply'),
+      'ack': self.metrics.histogram('ack_seconds','Time spent acknowledging a batch'),
+    }
+    self.counter = {
+      'requests': self.metrics.counter('requests_total','Requests received'),
+      'files': self.metrics.counter('files_total','Files classified'),
+      'errors': self.metrics.counter('classify_errors_total','Files that could not be classified'),
+      'invalid_requests': self.metrics.counter('invalid_requests_total','Requests that could not be decoded'),
+      'cache_hits': self.metrics.counter('feature_cache_hits_total','Feature rows found in the feature cache'),
+      'cache_misses': self.metrics.counter('feature_cache_misses_total','Files that were not in the feature cache'),
+      'result_cache_hits': self.metrics.counter('result_cache_hits_total','Classifications found in the result cache'),
+      'result_cache_misses': self.metrics.counter('result_cache_misses_total','Files that were not in the result cache'),
+      'deadline_expired': self.metrics.counter('deadline_expired_total','Batches that were not done by their deadline'),
+      'expired_requests': self.metrics.counter('expired_requests_total','Requests that were past their deadline before they were classified'),
+      'bulk_requests': self.metrics.counter('bulk_requests_total','Requests received with bulk priority'),
+      'reconnects': self.metrics.counter('amqp_reconnects_total','Reconnections to the broker'),
+    }
+    self.recovery = self.metrics.histogram('amqp_recovery_seconds','Time from losing the broker connection until it was back',
+                                           buckets=(0.1,0.5,1.0,2.5,5.0,10.0,30.0,60.0,120.0,300.0))
     #call the parent's __init__ to initialize the daemon variables
-    Daemon.__init__(self,pidfile)
-  
-  def __repr__(self):
-    if self.get_pid() is None:
-      return "classifyd is not running"
-    else:
-      return "classifyd is running (status: %s)" % str(self.status.message)
-  
-  def get_statistics(self):
-    if self.get_pid():
-      return str(self.status.statistics)
-    return None
+    ClassifierStatus.__init__(self,pidfile,status_socket,status_filename,self.log)
   
   def update_status(self,message=None,stat_key=None,stat_value=None):
     if message:
-      self.log.print_log_verbose("updating status message to '%s'" % message)
+      self.log.print_log_verbose("updating status message to '%s'",message)
       self.status.message = message
-      self.log.print_log_verbose("status message set to '%s'" % message)
+      self.log.print_log_verbose("status message set to '%s'",message)
     
     if stat_key:
       self.status.add_stat(stat_key,amount=int(stat_value if stat_value else 1))
     
-    #if something was updated, save it
-    if self.status_filename and (message or stat_key):
-      try:
-        output = open(self.status_filename,'wb')
-        pickle.dump(self.status,output)
-        self.log.print_log_verbose("status saved to file '%s'" % self.status_filename)
-        output.close()
-      except Exception,e:
-        self.log.print_error("Error saving status to %s: %s %s" % (str(self.status_filename),sys.exc_info()[0],e))
-        self.log.print_error("Traceback: %s" % traceback.format_exc())
+    #if something was updated, save it. statistics are only checkpointed every status_interval seconds,
+    #a new message is saved right away
+    if message or stat_key:
+      self.status_dirty = True
+      if message or time.time() - self.status_saved >= self.status_interval:
+        self.checkpoint_status()
+  
+  def checkpoint_status(self):
+    """Save the status to status_filename if it changed since the last checkpoint.
+    The workers' statistics change without the supervisor knowing, so with workers it is always saved.
+    
+    """
+    if self.status_filename and (self.status_dirty or self.status_dir):
+      self.status_dirty = False
+      self.status_saved = time.time()
+      status = Status()
+      status.message = self.status.message
+      status.statistics = self.collect_statistics()
+      if self.save_pickle(status,self.status_filename):
+        self.log.print_log_verbose("status saved to file '%s'",self.status_filename)
+  
+  def collect_statistics(self):
+    """Return this process's statistics with the ones the workers saved to status_dir added in.
+    Counts are summed, the result cache hit ratio is worked out again from the summed hits and misses.
+    
+    """
+    statistics = dict(self.status.statistics)
+    for worker in metrics.load_snapshots(self.status_dir):
+      for key,value in worker.items():
+        if key != 'result cache hit ratio (%)':
+          statistics[key] = statistics.get(key,0) + value
+    lookups = statistics.get('result cache hits',0) + statistics.get('result cache misses',0)
+    if lookups:
+      statistics['result cache hit ratio (%)'] = int(round(100.0 * statistics.get('result cache hits',0) / lookups))
+    return statistics
+  
+  def write_statistics(self):
+    """Save this worker's statistics to <pid>.json in status_dir, atomically."""
+    metrics.save_snapshot(self.status_dir,dict(self.status.statistics))
+  
+  def start_status_threads(self):
+    """Start the background threads that checkpoint the status and answer the status socket.
+    This is called from run(), threads do not survive the daemon's fork.
+    
+    """
+    def checkpoint_loop():
+      while True:
+        time.sleep(self.status_interval)
+        try:
+          self.checkpoint_status()
+        except Exception,e:
+          self.log.print_error("Error saving status: %s",e)
+    thread = threading.Thread(target=checkpoint_loop,name='status-checkpoint')
+    thread.daemon = True
+    thread.start()
+    
+    if not self.status_socket:
+      return
+    try:
+      #a socket left behind by a crashed daemon
+      if os.path.exists(self.status_socket):
+        os.remove(self.status_socket)
+      server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      server.bind(self.status_socket)
+      server.listen(5)
+    except socket.error,e:
+      self.log.print_error("status socket %s could not be created: %s",self.status_socket,e)
+      return
+    def serve_loop():
+      while True:
+        connection,address = server.accept()
+        try:
+          connection.sendall(json.dumps({'pid': os.getpid(),
+                                         'message': self.status.message,
+                                         'statistics': self.collect_statistics()}))
+        except socket.error,e:
+          self.log.print_log_verbose("status request failed: %s",e)
+        finally:
+          connection.close()
+    thread = threading.Thread(target=serve_loop,name='status-socket')
+    thread.daemon = True
+    thread.start()
+    self.log.print_log_verbose("status served on %s",self.status_socket)
+  
+  def start_metrics_server(self):
+    """Serve the metrics on metrics_port. With several consumers, the workers save their metrics
+    to metrics_dir, and they are added to the supervisor's when the metrics are requested.
+    
+    """
+    if not self.metrics_port:
+      return
+    if self.consumers > 1:
+      import tempfile
+      self.metrics_dir = tempfile.mkdtemp(prefix='mediad-metrics-')
+    if metrics.serve(self.metrics_host,self.metrics_port,lambda: metrics.render(self.metrics.collect(self.metrics_dir)),self.log):
+      self.log.print_log("metrics served on http://%s:%d/metrics",self.metrics_host,self.metrics_port)
+  
+  def start_metrics_snapshots(self):
+    """Save this worker's statistics to status_dir and its metrics to metrics_dir every status_interval seconds."""
+    def snapshot_loop():
+      while True:
+        time.sleep(self.status_interval)
+        try:
+          if self.status_dir:
+            self.write_statistics()
+          if self.metrics_dir:
+            self.metrics.write_snapshot(self.metrics_dir)
+        except (IOError,OSError),e:
+          self.log.print_error("Error saving metrics: %s",e)
+    thread = threading.Thread(target=snapshot_loop,name='metrics-snapshot')
+    thread.daemon = True
+    thread.start()
   
   def update_progress(self,files_processed=1):
     """Update the user of the progress of the system so far, generally while gathering training data.
@@ -132,38 +484,85 @@ class Classifier(Daemon):
     At a cutoff, it will update the log of its progress.
     
     """
+    previous = self.files_processed
     self.files_processed += files_processed
-    #Update every 500 files
-    if self.files_processed % 500 == 0:
-      self.log.print_log("Progress update, %s files processed for training data" % str(self.files_processed))
+    #Update every 500 files (rows can be added in bulk, so check if we crossed a multiple of 500)
+    if self.files_processed // 500 > previous // 500:
+      self.log.print_log("Progress update, %s files processed for training data",self.files_processed)
+  
+  def prefilter(self,filename):
+    """Decide if the file is worth parsing with kaa.metadata without opening it, when possible.
+    Return None if the file should be parsed, or the reason it was skipped.
+    
+    The extension and sample checks only look at the name, the container signature check
+    reads the first bytes of the file, so it should be done after any cache lookup.
+    """
+    name = os.path.basename(filename)
+    if self.extensions is not None:
+      extension = os.path.splitext(name)[1].lower().lstrip('.')
+      if extension not in self.extensions:
+        return 'extension'
+    if self.skip_samples and SAMPLE_PATTERN.search(os.path.splitext(name)[0]):
+      return 'sample'
+    return None
   
-  def get_video_features(self,filename):
-    """Gather the features of the given file and return a row to be used in the SVM.
+  def get_media_features(self,filename,info=None):
+    """Gather the features of the given file and return a (media, row) tuple, where row is used in the SVM
+    and media is the kaa media type. If the file has already been parsed, pass the info object
+    so it is not parsed a second time. If a feature cache is configured, the row is taken from the
+    cache when the file has not changed since it was last parsed.
     
     Parameter is the absolute filename
     """
     
-    self.log.print_log_verbose("Gathering video features for "+str(filename))
-    if os.path.exists(filename):
-      info = kaa.metadata.parse(filename)
-    else:
-      self.log.print_error("file cannot be found")
-      return None
-    self.log.print_log_verbose("Media type for: "+str(info.media))
-    if info is not None and info.media == "MEDIA_AV":
-      #gather features
-      x1 = int(info.length)
-      self.log.print_log_verbose("x1 (video length): "+str(x1))
-      return [x1]
-    return None
+    self.log.print_log_verbose("Gathering video features for %s",filename)
+    key = None
+    if self.feature_cache:
+      key = self.feature_cache.key(filename)
+      if key is None:
+        self.log.print_error("file cannot be found")
+        return (None, None)
+      hit,row = self.feature_cache.get(filename,key)
+      if hit:
+        self.counter['cache_hits'].inc()
+        self.log.print_log_verbose("feature cache hit: %s",row)
+        return ("MEDIA_AV" if row is not None else None, row)
+      self.counter['cache_misses'].inc()
+    if info is None:
+      import kaa.metadata
+      try:
+        with self.stage['parse'].time():
+          info = kaa.metadata.parse(filename)
+      except Exception,e:
+        self.log.print_error("file could not be parsed (%s): %s",filename,e)
+        return (None, None)
+      if info is None:
+        self.log.print_error("file cannot be found or is not a media file")
+    with self.stage['feature_build'].time():
+      media,row = extract_features(info,filename,self.features)
+    self.log.print_log_verbose("Media type for: %s",media)
+    self.log.print_log_verbose("features: %s",row)
+    if self.feature_cache:
+      self.feature_cache.put(filename,row,key)
+    return (media, row)
+  
+  def get_video_features(self,filename,info=None):
+    """Gather the features of the given file and return a row to be used in the SVM, or None if the file is
+    not a video.
+    
+    Parameter is the absolute filename
+    """
+    return self.get_media_features(filename,info)[1]
 
-  def gather_training_data(self,directory,classification):
+  def gather_training_data(self,directory,classification,new_only=False):
     """Add to the current training set of data with the media files existing on the system. For each
     file, gather features to add it to the X array (a num_files X num_features array) and the
     classification in the y vector (a num_files length vector) matching 1 for tv and 0 for movies.
     
-    There is no return value. This function builds on the current contents of X and y
+    This function builds on the current contents of X and y. If new_only is True, only files that are not
+    recorded as trained in the feature cache are added (their cached rows are used if they have one).
     
+    Return the (X_rows, y_rows) lists that were added.
     """
     
     #gather data in lists so we can bulk-add to the matrix
@@ -171,165 +570,616 @@ class Classifier(Daemon):
     X_rows = []
     y_rows = []
     
-    for path,subdirs,files in os.walk(directory):
-      for filename in files:
-        absolute_path = os.path.join(path, filename)
-        self.log.print_log_verbose("processing file "+filename)
-        info = kaa.metadata.parse(absolute_path)
-        #only process video files
-        #documentation here: http://doc.freevo.org/api/kaa/metadata/usage.html#attributes-keys
-        if info is not None and info.media == "MEDIA_AV":
-          #gather features
-          row = self.get_video_features(absolute_path)
-          #add to training set
-          if row is not None:
-            self.log.print_log_verbose("adding row: "+str(row))
-            X_rows.append(row)
-            y_rows.append(classification)
-            self.update_status(stat_key='training examples')
-            self.update_progress(files_processed=1)
+    #rows found in the feature cache, these are filled in while walking
+    cached_rows = []
+    cached_paths = []
+    cache_stats = {'feature cache hits': 0, 'feature cache misses': 0}
+    #files that never made it to the parser
+    skip_stats = {'extension': 0, 'sample': 0, 'signature': 0}
+    
+    def uncached_files():
+      """Walk the directory and yield the files that have to be parsed."""
+      for path,subdirs,files in os.walk(directory):
+        for filename in files:
+          absolute_path = os.path.join(path, filename)
+          reason = self.prefilter(absolute_path)
+          if reason:
+            skip_stats[reason] += 1
+            continue
+          if self.feature_cache:
+            #unchanged files only cost a stat()
+            hit,row,trained = self.feature_cache.lookup(absolute_path)
+            if hit:
+              cache_stats['feature cache hits'] += 1
+              #files classifyd was asked about are cached, but not trained on
+              if row is not None and not (new_only and trained):
+                cached_rows.append(row)
+                cached_paths.append(absolute_path)
+              continue
+            cache_stats['feature cache misses'] += 1
+          yield absolute_path
+    
+    #the walk only stats the files, the signature check and the parse of each uncached file are one task,
+    #which runs in the pool when there is one
+    parse = functools.partial(sniff_and_parse,features=self.features,sniff=self.sniff)
+    pool = None
+    if self.parse_workers > 1:
+      #overlap the directory walk with concurrent parsing, results come back in chunks
+      self.log.print_log("parsing with %d %s workers",self.parse_workers,self.parse_mode)
+      if self.parse_mode == 'process':
+        pool = Pool(self.parse_workers)
+      else:
+        pool = ThreadPool(self.parse_workers)
+      results = pool.imap_unordered(parse,uncached_files(),chunksize=16)
+    else:
+      results = itertools.imap(parse,uncached_files())
+    try:
+      for absolute_path,row,skipped in results:
+        if skipped:
+          skip_stats['signature'] += 1
+          continue
+        if self.feature_cache:
+          #non-video files are stored too, so they are not parsed again
+          self.feature_cache.put(absolute_path,row,trained=row is not None)
+        if row is not None:
+          self.log.print_log_verbose("adding row for %s: %s",absolute_path,row)
+          X_rows.append(row)
+          y_rows.append(classification)
+          self.update_progress(files_processed=1)
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+    if len(X_rows) > 0:
+      self.update_status(stat_key='training examples',stat_value=len(X_rows))
+    
+    #add the rows that came from the cache
+    if len(cached_rows) > 0:
+      X_rows.extend(cached_rows)
+      y_rows.extend([classification] * len(cached_rows))
+      self.update_status(stat_key='training examples',stat_value=len(cached_rows))
+      self.update_progress(files_processed=len(cached_rows))
+    if self.feature_cache:
+      for key,value in cache_stats.items():
+        if value:
+          self.update_status(stat_key=key,stat_value=value)
+    for reason,value in skip_stats.items():
+      if value:
+        self.update_status(stat_key='prefilter skipped (%s)' % reason,stat_value=value)
+    
+    if self.feature_cache:
+      self.feature_cache.mark_trained(cached_paths)
+      self.feature_cache.commit()
     
     #now add the gathered data to the array
+    self.add_training_rows(X_rows,y_rows)
+    return (X_rows,y_rows)
+  
+  def add_training_rows(self,X_rows,y_rows):
+    """Append the rows to the X matrix and the classifications to the y vector."""
     if len(X_rows) > 0:
-      self.log.print_log_verbose("Adding X_rows: "+str(X_rows))
-      self.log.print_log_verbose("Adding y_rows: "+str(y_rows))
+      from numpy import array,vstack,hstack
+      self.log.print_log_verbose("Adding %d rows",len(X_rows))
       if self.__X is None:
-        self.__X = array(X_rows)
+        self.__X = features.matrix(X_rows)
         self.__y = array(y_rows)
       else:
-        self.__X = vstack((self.__X,X_rows))
+        self.__X = vstack((self.__X,features.matrix(X_rows)))
         self.__y = hstack((self.__y,y_rows))
   
-  def load_pickle(self,filename = None):
-    """Load the object from the file and return it.
+  def save_pickle(self,obj,filename = None):
+    """Save the object to a file.
+    The object is written to a temporary file which is renamed over the old one, so a crash never leaves
+    a partial file behind.
     
     """
-    if filename and os.path.exists(filename):
-      try:
-        f = open(filename,'rb')
-        result = pickle.load(f)
-        f.close()
-        self.log.print_log_verbose("Loaded object from file %s" % filename)
-        self.log.print_log_verbose("Object data: %s" % str(result))
-        return result
-      except Exception,e:
-        self.log.print_error("Pickle count not be loaded from file (%s), error was %s %s" % (str(filename),sys.exc_info()[0],e))
-        self.log.print_error("Traceback: %s" % traceback.format_exc())
-        return None
-    return None
-  
-  def save_pickle(self,obj,filename = None):
-    """Save the object to a file."""
     if filename:
       try:
-        output = open(filename,'wb')
-        pickle.dump(obj,output)
+        temp_filename = filename + '.tmp'
+        output = open(temp_filename,'wb')
+        pickle.dump(obj,output,pickle.HIGHEST_PROTOCOL)
+        output.flush()
+        os.fsync(output.fileno())
         output.close()
-        self.log.print_log_verbose("save_pickle(): Saved object to file %s" % filename)
+        os.rename(temp_filename,filename)
+        self.log.print_log_verbose("save_pickle(): Saved object to file %s",filename)
         return True
       except Exception,e:
-        self.log.print_error("Object could not be saved to file (%s), error was %s %s" % (str(filename),sys.exc_info()[0],e))
-        self.log.print_error("Traceback: %s" % traceback.format_exc())
+        self.log.print_error("Object could not be saved to file (%s), error was %s %s",filename,sys.exc_info()[0],e)
+        self.log.print_error("Traceback: %s",traceback.format_exc())
         return False
     return False
   
   def load_svm_from_file(self,filename = None):
-    """Load the saved SVM from a file. If the file does not exist or could not be loaded, then return false.
+    """Load the saved SVM. The current version in the model store is used if there is one, otherwise the
+    file written by earlier versions of mediad. If nothing could be loaded, then return false.
     
     """
-    
-    if filename and os.path.exists(filename):
+    if self.model_store and self.model_store.exists():
       try:
-        self.log.print_log("loading SVM from %s..." % filename)
+        self.log.print_log("loading model version %s from %s...",self.model_store.current_version(),self.model_store)
+        self.svc,manifest = self.load_model()
+        self.model_version = self.loaded_version = manifest['version']
+      except Exception,e:
+        #this includes a model trained on different features, it has to be retrained
+        self.log.print_error("model could not be loaded from %s, it will be retrained: %s",self.model_store,e)
+        return False
+    elif filename and os.path.exists(filename):
+      #a model trained on different features can't be used, it has to be retrained
+      saved_schema = self.load_schema(filename)
+      if saved_schema != self.feature_schema:
+        self.log.print_error("SVM in %s was trained with feature schema %s, but the configured schema is %s. The SVM will be retrained",
+                             filename,saved_schema,self.feature_schema)
+        return False
+      try:
+        self.log.print_log("loading SVM from %s...",filename)
+        from sklearn.externals import joblib
         self.svc = joblib.load(filename)
-        self.update_status("ready")
-        self.log.print_log("...done")
-        
-        #X and y should be available for loading as well
-        self.__X = self.load_pickle(self.X_filename)
-        self.__y = self.load_pickle(self.y_filename)
-        
-        #Set the status statistic for training examples
-        if self.__X is not None and len(self.__X) > 0:
-          self.update_status(stat_key='training examples',stat_value=int(len(self.__X)))
-        else:
-          self.log.print_error("self.__X was empty, but I expected it to have values loaded from a pickle save file. Status statistics will not work for the running daemon")
       except Exception,e:
-        self.log.print_error("SVM could not be loaded from file (%s), error was %s %s" % (str(filename),sys.exc_info()[0],e))
-        self.log.print_error("Traceback: %s" % traceback.format_exc())
+        self.log.print_error("SVM could not be loaded from file (%s), error was %s %s",filename,sys.exc_info()[0],e)
+        self.log.print_error("Traceback: %s",traceback.format_exc())
         return False
-      return True
     else:
-      self.log.print_log_verbose("load_svm_from_file() called with invalid filename (filename: %s)" % str(filename))
+      self.log.print_log_verbose("load_svm_from_file() called with invalid filename (filename: %s)",filename)
       return False
-
+    self.update_status("ready")
+    self.log.print_log("...done")
+    
+    #X and y should be available for loading as well, they are mapped and only read when used
+    self.load_training_data()
+    
+    #Set the status statistic for training examples
+    if self.__X is not None and len(self.__X) > 0:
+      self.update_status(stat_key='training examples',stat_value=int(len(self.__X)))
+    else:
+      self.log.print_error("self.__X was empty, but I expected it to have values loaded from the training set files. Status statistics will not work for the running daemon")
+    return True
+  
+  def load_model(self,version=None):
+    """Load a version of the model (the current one by default) from the model store.
+    Return (model, manifest), or raise ValueError if it was trained on other features than the configured ones.
+    
+    """
+    #the incremental model is updated in place by partial_fit, so it can't be mapped read-only
+    model,manifest = self.model_store.load(version,mmap=not self.incremental)
+    if manifest.get('schema') != self.feature_schema:
+      raise ValueError("model version %s was trained with feature schema %s, but the configured schema is %s"
+                       % (manifest.get('version'),manifest.get('schema'),self.feature_schema))
+    return (model,manifest)
+  
+  def start_model_watcher(self):
+    """Start the thread that loads new model versions in the background, when reload_event is set (by SIGHUP)
+    or when the current version in the model store changed. This is called in the process that consumes,
+    threads do not survive the daemon's fork.
+    
+    """
+    if not self.model_store:
+      return
+    def watch_loop():
+      failed_version = None
+      while True:
+        self.reload_event.wait(self.reload_interval if self.reload_interval > 0 else None)
+        requested = self.reload_event.is_set()
+        self.reload_event.clear()
+        version = self.model_store.current_version()
+        if version is None or version == self.loaded_version or (version == failed_version and not requested):
+          continue
+        try:
+          model,manifest = self.load_model(version)
+        except Exception,e:
+          failed_version = version
+          self.log.print_error("model version %s could not be loaded, still using version %s: %s",version,self.model_version,e)
+          self.update_status(stat_key='model reload failures')
+          continue
+        with self.model_lock:
+          self.next_model = (model,manifest['version'])
+        self.loaded_version = manifest['version']
+        self.log.print_log("model version %s loaded, it is used from the next batch",version)
+    thread = threading.Thread(target=watch_loop,name='model-watcher')
+    thread.daemon = True
+    thread.start()
+  
+  def swap_model(self):
+    """Switch to the model loaded by the watcher thread, if there is one. This is called between batches."""
+    with self.model_lock:
+      next_model = self.next_model
+      self.next_model = None
+    if next_model is not None:
+      self.svc,self.model_version = next_model
+      self.log.print_log("switched to model version %s",self.model_version)
+      self.update_status(stat_key='model reloads')
+  
+  def load_schema(self,svm_filename):
+    """Return the feature schema saved next to the SVM. Models saved without one only used the length."""
+    schema_filename = svm_filename + '.schema'
+    if not os.path.exists(schema_filename):
+      return features.LEGACY_SCHEMA
+    try:
+      f = open(schema_filename,'r')
+      try:
+        return json.load(f)
+      finally:
+        f.close()
+    except (IOError,ValueError),e:
+      self.log.print_error("Feature schema could not be loaded from %s: %s",schema_filename,e)
+      return None
+  
+  def save_svm(self):
+    """Save the SVM as a new version in the model store, which becomes the current version."""
+    if not self.model_store:
+      return False
+    self.log.print_log_verbose("saving SVM to %s",self.model_store)
+    try:
+      manifest = self.model_store.save(self.svc,self.feature_schema,
+                                       training_examples=int(len(self.__X)) if self.__X is not None else 0)
+    except Exception,e:
+      self.log.print_error("Error saving SVM to %s: %s %s",self.model_store,sys.exc_info()[0],e)
+      self.log.print_error("Traceback: %s",traceback.format_exc())
+      return False
+    #this process already has the new version, the watcher does not need to load it
+    self.model_version = self.loaded_version = manifest['version']
+    self.log.print_log_verbose("SVM saved as version %s in %s",manifest['version'],self.model_store)
+    return True
+  
+  def load_training_data(self):
+    """Map the saved X matrix and y vector. Return False if they could not be loaded."""
+    if not self.training_set or not self.training_set.exists():
+      return False
+    try:
+      self.__X,self.__y = self.training_set.load()
+      self.log.print_log_verbose("training set (%d rows) mapped from %s",len(self.__X),self.training_set)
+      return True
+    except Exception,e:
+      self.log.print_error("Training set could not be loaded from %s, error was %s %s",self.training_set,sys.exc_info()[0],e)
+      return False
+  
+  def save_training_data(self,X_rows=None,y_rows=None):
+    """Save the X matrix and y vector so the daemon can start without gathering the training data again.
+    If rows are passed, they are appended to the saved training set instead of rewriting it.
+    
+    """
+    if not self.training_set or self.__X is None:
+      return False
+    from numpy import shape
+    try:
+      if X_rows is not None and self.training_set.exists():
+        self.training_set.append(X_rows,y_rows)
+        self.log.print_log("%d rows appended to %s",len(X_rows),self.training_set)
+      else:
+        self.training_set.save(self.__X,self.__y)
+        self.log.print_log("X matrix (size %s) and y vector (size %s) saved to %s",shape(self.__X),shape(self.__y),self.training_set)
+    except Exception,e:
+      self.log.print_error("Error saving training set to %s: %s %s",self.training_set,sys.exc_info()[0],e)
+      return False
+    return True
+  
   def train(self):
     """Train the SVM with the current __X matrix and __y vector.
     
     """
     self.log.print_log("training SVM...")
     self.update_status('training')
-    #Since we are re-training, we delete the pickled X and y if they exist
-    if self.X_filename and os.path.exists(self.X_filename):
-      os.remove(self.X_filename)
-    if self.y_filename and os.path.exists(self.y_filename):
-      os.remove(self.y_filename)
     
     #train with the current __X and __y
+    #the saved X and y are kept until the new ones are written, so a crash here loses nothing
+    if self.incremental:
+      from incremental import IncrementalModel
+      self.svc = IncrementalModel(classes=(Video.movie,Video.tv))
+    else:
+      from sklearn import svm
+      from sklearn.pipeline import make_pipeline
+      from sklearn.preprocessing import StandardScaler
+      #the columns are seconds, pixels, kbit/s, MB and 0/1 flags, unscaled they slow libsvm down a lot
+      #and drown out the flags, so they are standardized like IncrementalModel does
+      self.svc = make_pipeline(StandardScaler(),svm.SVC(kernel="linear"))
     self.svc.fit(self.__X,self.__y)
     self.log.print_log("...done")
     
-    #Save the SVM to file
+    #Save the SVM and the X and y variables to file
     if self.svm_filename:
-      self.log.print_log_verbose("saving SVM to %s" % str(self.svm_filename))
-      try:
-        joblib.dump(self.svc, self.svm_filename, compress=9)
-        self.log.print_log_verbose("SVM saved as %s" % str(self.svm_filename))
-      except TypeError:
-        #if the compress option is not supported, then we try without
-        try:
-          joblib.dump(self.svc, self.svm_filename)
-          self.log.print_log_verbose("SVM saved as %s (without compression)" % str(self.svm_filename))
-        except Exception,e:
-          self.log.print_error("Error saving SVM to %s: %s %s" % (str(self.svm_filename),sys.exc_info()[0],e))
-      except Exception,e:
-        self.log.print_error("Error saving SVM to %s: %s %s" % (str(self.svm_filename),sys.exc_info()[0],e))
-        self.log.print_error("Traceback: %s" % traceback.format_exc())
-      self.log.print_log_verbose("pickling %s %s" % (str(self.__X),self.X_filename))
-      
-      #Save the X and y variables
-      if self.save_pickle(self.__X,self.X_filename):
-        self.log.print_log("X matrix (size %s) saved to %s" % (shape(self.__X),self.X_filename))
-        if self.save_pickle(self.__y,self.y_filename):
-          self.log.print_log("y vector (size %s) saved to %s" % (shape(self.__y),self.y_filename))
-        else:
-          self.log.print_log_error("Error saving y vector pickle")
-      else:
-        self.log.print_log_error("Error saving X Matrix pickle")
-        
+      self.save_svm()
+      self.save_training_data()
+    
     self.log.print_log_verbose("returning from train(): classifier is trained and ready")
     self.update_status('ready')
   
+  def learn(self,X_rows,y_rows):
+    """Update the model with new labeled examples that were already added to the training set.
+    With the incremental model, the examples are absorbed with partial_fit and the snapshot is saved,
+    otherwise the model is retrained on the full training set.
+    
+    """
+    if len(X_rows) == 0:
+      return
+    if self.incremental and hasattr(self.svc,'partial_fit'):
+      from numpy import array
+      self.log.print_log("learning %d new examples...",len(X_rows))
+      self.svc.partial_fit(features.matrix(X_rows),array(y_rows))
+      self.update_status(stat_key='incremental examples',stat_value=len(X_rows))
+      if self.svm_filename:
+        self.save_svm()
+        self.save_training_data(X_rows,y_rows)
+      self.log.print_log("...done")
+    else:
+      self.train()
+  
+  def learn_file(self,filename,classification,request=None):
+    """Queue a file with a known classification (for example, after it was moved into tv_dir or movie_dir)
+    to be added to the training set and the model by save_learned(), which runs once learn_batch files are
+    queued or learn_interval seconds after the first one. request is the (channel, delivery tag) to
+    acknowledge once the file is saved.
+    Return True if the file was a video and was queued.
+    
+    """
+    row = self.get_video_features(filename)
+    if row is None:
+      return False
+    self.log.print_log("learning %s as %s",filename,classification_name(classification))
+    self.learned.append((filename,row,classification,request))
+    if len(self.learned) >= self.learn_batch:
+      self.save_learned()
+    elif not self.learn_scheduled and self.connection is not None:
+      self.learn_scheduled = True
+      self.connection.add_timeout(self.learn_interval,self.save_learned)
+    return True
+  
+  def save_learned(self):
+    """Add the files queued by learn_file() to the training set and the model as one batch, so a model
+    version is saved (and every worker's result cache emptied) once per batch rather than once per file.
+    
+    """
+    self.learn_scheduled = False
+    if not self.learned:
+      return
+    learned,self.learned = self.learned,[]
+    X_rows = [row for filename,row,classification,request in learned]
+    y_rows = [classification for filename,row,classification,request in learned]
+    self.add_training_rows(X_rows,y_rows)
+    self.update_status(stat_key='training examples',stat_value=len(X_rows))
+    if self.feature_cache:
+      #so the next start does not add them again
+      self.feature_cache.mark_trained([filename for filename,row,classification,request in learned])
+      self.feature_cache.commit()
+    if self.incremental:
+      self.learn(X_rows,y_rows)
+    elif self.svm_filename:
+      #refitting the svc for every batch would be too slow, it picks the examples up on the next retrain
+      self.save_training_data(X_rows,y_rows)
+    for filename,row,classification,request in learned:
+      if request is not None:
+        request[0].basic_ack(delivery_tag = request[1])
+  
   def classify(self,filename):
     """Classify the given file using the SVM.
     Return a classification from the Video class.
     
     """
-    features = self.get_video_features(filename)
-    if features is not None:
-      self.log.print_log_verbose("classifying "+str(filename))
-      self.log.print_log_verbose("features: "+str(features))
-      return int(self.svc.predict([features])[0])
+    return self.classify_many([filename])[0]
+  
+  def classify_many(self,filenames,deadline=None):
+    """Classify a list of files using the SVM.
+    Return a list of classifications from the Video class, in the same order as filenames
+    (-1 for files that could not be classified, or whose features were not ready by the deadline,
+    a time.time() value). Files found in the result cache are not parsed or predicted again.
+    
+    """
+    if self.result_cache is None:
+      return self.classify_uncached(filenames,deadline)
+    results = [-1] * len(filenames)
+    keys = [self.result_cache.key(filename,self.model_version) for filename in filenames]
+    missed = []
+    for i,key in enumerate(keys):
+      hit,result = self.result_cache.get(key) if key is not None else (False,None)
+      if hit:
+        results[i] = result
+      else:
+        missed.append(i)
+    hits = len(filenames) - len(missed)
+    self.counter['result_cache_hits'].inc(hits)
+    self.counter['result_cache_misses'].inc(len(missed))
+    self.counter['files'].inc(hits)
+    self.status.set_stat('result cache hit ratio (%)',int(round(100 * self.result_cache.hit_ratio())))
+    if hits:
+      self.update_status(stat_key='result cache hits',stat_value=hits)
+    if missed:
+      self.update_status(stat_key='result cache misses',stat_value=len(missed))
+      classified = self.classify_uncached([filenames[i] for i in missed],deadline)
+      for i,result in zip(missed,classified):
+        results[i] = result
+        #failures are not cached, a file that could not be parsed yet may be complete on the next request
+        if result != -1 and keys[i] is not None:
+          self.result_cache.put(keys[i],result)
+    return results
+  
+  def classify_uncached(self,filenames,deadline=None):
+    """Classify a list of files using the SVM, without the result cache. The features are extracted
+    concurrently and all files are predicted in a single call. The return value is the same as classify_many().
+    
+    """
+    rows = [None] * len(filenames)
+    if len(filenames) > 1 and self.parse_workers > 1:
+      if self.feature_pool is None:
+        #created on first use, so the threads belong to the daemonized process
+        self.feature_pool = ThreadPool(self.parse_workers)
+      found = self.feature_pool.imap(self.get_video_features,filenames)
+      for i in range(len(filenames)):
+        try:
+          rows[i] = found.next(None if deadline is None else max(0,deadline - time.time()))
+        except TimeoutError:
+          #the files that are still being parsed finish in the background and end up in the feature cache
+          break
     else:
-      return -1
+      for i,filename in enumerate(filenames):
+        if deadline is not None and time.time() >= deadline:
+          break
+        rows[i] = self.get_video_features(filename)
+    if deadline is not None and time.time() >= deadline:
+      self.log.print_error("deadline passed while classifying %d files",len(filenames))
+      self.update_status(stat_key='deadline expired')
+      self.counter['deadline_expired'].inc()
+    
+    results = [-1] * len(filenames)
+    indexes = [i for i,row in enumerate(rows) if row is not None]
+    if indexes:
+      self.log.print_log_verbose("classifying %d files",len(indexes))
+      with self.stage['predict'].time():
+        predictions = self.svc.predict(features.matrix([rows[i] for i in indexes]))
+      for i,prediction in zip(indexes,predictions):
+        results[i] = int(prediction)
+    self.counter['files'].inc(len(filenames))
+    self.counter['errors'].inc(len(filenames) - len(indexes))
+    #rows are committed once per batch, so the cache's write lock is never held between requests
+    if self.feature_cache and not self.feature_cache.commit():
+      self.log.print_error("feature cache %s is locked, the rows of this batch were not saved",self.feature_cache)
+    return results
+  
+  def on_request(self,ch,method,properties,body):
+    """Callback for a message on the classifyd queues.
+    The body is either a single filename, or a JSON list of filenames (with the BATCH_CONTENT_TYPE content type)
+    which is answered with a JSON list of classifications. A filename may start with '[', so the body is not sniffed. Requests are held until the batch is full or the batch window has passed.
+    A request that is already past the deadline in its headers is answered with -1 right away.
+    
+    """
+    received = time.time()
+    self.log.print_log("received message (delivery tag %s): %s",method.delivery_tag,body)
+    self.counter['requests'].inc()
+    #the client puts the time it sent the request, and the time it stops waiting, in the headers
+    headers = getattr(properties,'headers',None) or {}
+    sent = headers.get('sent')
+    if isinstance(sent,(int,float)):
+      self.stage['queue_wait'].observe(max(0,received - sent))
+    deadline = headers.get('deadline')
+    deadline = deadline if isinstance(deadline,(int,float)) else None
+    priority = getattr(properties,'priority',None)
+    if priority is None:
+      priority = PRIORITY_BULK if method.routing_key == self.bulk_queue else PRIORITY_INTERACTIVE
+    if priority < PRIORITY_INTERACTIVE:
+      self.counter['bulk_requests'].inc()
+    if getattr(properties,'content_type',None) == BATCH_CONTENT_TYPE:
+      try:
+        filenames = [str(f) for f in json.loads(body)]
+        batch = True
+      except ValueError,e:
+        self.log.print_error("invalid batch request (delivery tag %s): %s",method.delivery_tag,e)
+        self.counter['invalid_requests'].inc()
+        filenames = []
+        batch = True
+    else:
+      filenames = [body]
+      batch = False
+    request = PendingRequest(ch,method,properties,filenames,batch,received,deadline,priority)
+    
+    if deadline is not None and received >= deadline:
+      #nobody is waiting for the answer anymore, don't spend any parse time on it
+      self.expire_request(request)
+      ch.basic_ack(delivery_tag = method.delivery_tag)
+      return
+    self.pending_requests.append(request)
+    
+    if sum(len(request.filenames) for request in self.pending_requests) >= self.batch_size or self.batch_window <= 0:
+      self.flush_requests()
+    elif not self.flush_scheduled and self.connection is not None:
+      self.flush_scheduled = True
+      self.connection.add_timeout(self.batch_window,self.flush_requests)
+  
+  def on_learn(self,ch,method,properties,body):
+    """Callback for a message on the learn queue, a filename with its classification in the learn header.
+    It is not answered, and it is acknowledged once save_learned() has saved it.
+    
+    """
+    headers = getattr(properties,'headers',None) or {}
+    try:
+      if self.learn_file(os.path.abspath(body),int(headers['learn']),(ch,method.delivery_tag)):
+        return
+    except Exception,e:
+      self.log.print_error("%s could not be learned: %s",body,e)
+      self.log.print_error("Traceback: %s",traceback.format_exc())
+    ch.basic_ack(delivery_tag = method.delivery_tag)
+  
+  def reply(self,request,results):
+    """Publish the classifications of a request to its reply queue."""
+    import pika
+    if request.properties.reply_to:
+      with self.stage['publish'].time():
+        request.channel.basic_publish(exchange='',
+                                      routing_key=request.properties.reply_to,
+                                      properties=pika.BasicProperties(correlation_id = request.properties.correlation_id),
+                                      body=json.dumps(results) if request.batch else str(results[0]))
+  
+  def expire_request(self,request):
+    """Answer a request that is past its deadline with -1 for every file, without classifying it."""
+    self.log.print_error("request (delivery tag %s) expired %.1f seconds ago, it is not classified",
+                         request.method.delivery_tag,time.time() - request.deadline)
+    self.update_status(stat_key='expired requests')
+    self.counter['expired_requests'].inc()
+    self.reply(request,[-1] * len(request.filenames))
+  
+  def flush_requests(self):
+    """Classify every pending request, send the replies and acknowledge them together.
+    Requests are classified in order of priority, each priority as one batch, and requests whose
+    deadline passed while they were held are answered with -1 without being classified.
+    
+    """
+    self.flush_scheduled = False
+    if not self.pending_requests:
+      return
+    #a new model is only switched to between batches
+    self.swap_model()
+    requests = self.pending_requests
+    self.pending_requests = []
+    for request in requests:
+      self.stage['batch_wait'].observe(time.time() - request.received)
+    
+    for priority in sorted(set(request.priority for request in requests),reverse=True):
+      group = []
+      for request in requests:
+        if request.priority != priority:
+          continue
+        if request.deadline is not None and time.time() >= request.deadline:
+          self.expire_request(request)
+        else:
+          group.append(request)
+      if not group:
+        continue
+      filenames = []
+      for request in group:
+        filenames.extend(request.filenames)
+      #the batch is cut short only once every request in it has been given up on
+      deadlines = [request.deadline for request in group]
+      deadline = max(deadlines) if None not in deadlines else None
+      results = self.classify_many(filenames,deadline) if filenames else []
+      self.log.print_log_verbose("classified %d files from %d requests (priority %s)",len(filenames),len(group),priority)
+      
+      offset = 0
+      for request in group:
+        self.reply(request,results[offset:offset+len(request.filenames)])
+        offset += len(request.filenames)
+    self.log.print_log_verbose("sent %d responses",len(requests))
+    
+    #the delivery tags on a channel are increasing, so one ack per channel covers the whole batch
+    last = {}
+    for request in requests:
+      last[request.channel] = max(last.get(request.channel,0),request.method.delivery_tag)
+    with self.stage['ack'].time():
+      for channel,delivery_tag in last.items():
+        channel.basic_ack(delivery_tag = delivery_tag, multiple=True)
+    self.log.print_log_verbose("acknowledged %d requests",len(requests))
 
   def plot_training_data(self):
     """Plot the training data to the screen to be used for troubleshooting.
-    Until it is figured out, this just prints the training data.
+    The first feature is plotted against the classification.
     
     """
     self.log.print_log("X:\n"+str(self.__X))
     self.log.print_log("y:\n"+str(self.__y))
+    if self.__X is None or len(self.__X) == 0:
+      return
+    #pylab is slow to import, so it is only loaded here
+    import pylab as pl
+    pl.scatter(self.__X[:,0],self.__y,c=self.__y)
+    pl.xlabel(self.features[0])
+    pl.ylabel('classification (1 = tv, 0 = movie)')
+    pl.show()
   
   def setup_channel(self,delete_if_empty=False):
     """Configure the amqp channel.
@@ -338,6 +1188,7 @@ class Classifier(Daemon):
     
     This method is not working and should be avoided for now.
     """
+    import pika
     try:
       #create connection
       connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.amqp_host))
@@ -356,7 +1207,7 @@ class Classifier(Daemon):
         try:
           channel.queue_delete(queue=self.amqp_queue, if_empty=True)
         except pika.exceptions.AMQPChannelError, e:
-          self.log.print_log_verbose("tried to delete %s queue but received an error. If this is 404, it should be no problem. Error was %s" % (self.amqp_queue,str(e)))
+          self.log.print_log_verbose("tried to delete %s queue but received an error. If this is 404, it should be no problem. Error was %s",self.amqp_queue,e)
       
       #declare the queue
       self.log.print_log("declaring queue")
@@ -368,95 +1219,476 @@ class Classifier(Daemon):
       return channel
     except Exception,e:
       #this should be more robust and remove the catch-all except
-      self.log.print_error_and_exit("channel not created: %s (%s)" % (str(e),sys.exc_info()[0]))
+      self.log.print_error_and_exit("channel not created: %s (%s)",e,sys.exc_info()[0])
       return None
   
   def run(self):
     """Override for inherited run method of the Daemon class.
     
     """
-    self.log.print_log_verbose("run() called. classifier status is %s." % str(self.status.message))
+    self.log.print_log_verbose("run() called. classifier status is %s.",self.status.message)
+    self.start_status_threads()
+    self.start_metrics_server()
+    #a reload requested while training is picked up by the model watcher once consuming. The forked
+    #workers inherit the handler
+    signal.signal(signal.SIGHUP,self.on_reload_signal)
+    
+    if self.status.message == 'initializing':
+      self.train()
+    if self.consumers > 1:
+      self.supervise()
+    else:
+      self.consume()
+  
+  def on_reload_signal(self,signum,frame):
+    """SIGHUP handler: the model watcher loads the current model version, and a supervisor passes
+    the signal on to its workers.
     
+    """
+    self.reload_event.set()
+    for pid in self.workers.keys():
+      try:
+        os.kill(pid,signal.SIGHUP)
+      except OSError:
+        pass
+  
+  def connect(self):
+    """Return a new blocking connection to the broker."""
+    import pika
+    return pika.BlockingConnection(pika.ConnectionParameters(host=self.amqp_host,heartbeat_interval=self.heartbeat))
+  
+  def consume(self):
+    """Connect to the broker and consume the classifyd queue, forever.
+    If the connection is lost, the requests that were not acknowledged yet are dropped (the broker
+    delivers them again) and the consumer reconnects with exponential backoff.
+    
+    """
+    import pika
+    self.log.print_log("classifier daemon is running (pid %s)",str(os.getpid()))
+    self.start_model_watcher()
+    delay = 1.0
+    lost = None
     while True:
-      if self.status.message == 'initializing':
-        self.train()
-      elif self.status.message == 'ready':
-        self.log.print_log("classifier daemon is running (pid %s)" % str(os.getpid()))
-        #channel = self.setup_channel(delete_if_empty=True)
+      try:
+        #create connection
+        connection = self.connection_factory()
+        self.log.print_log_verbose("connection initialized")
         
-        """
-        This code below is copied from setup_channel() method because the queue_declare call
-        seems to block (when I expect the start_consuming() to be blocking instead), so I'll keep the
-        copied code below until I figure out how to get the channel from another method.
-        """
+        #create channel
+        channel = connection.channel()
+        self.log.print_log_verbose("channel initialized")
         
-        ###################################
-        #this is copied from setup_channel#
-        ###################################
+        #declare the queue
+        self.log.print_log_verbose("declaring queue")
+        channel.queue_declare(queue=self.amqp_queue, durable=True, exclusive=False, auto_delete=False)
+        self.log.print_log_verbose("queue declared")
         
-        try:
-          #create connection
-          connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.amqp_host))
-          self.log.print_log_verbose("connection initialized")
-          
-          #create channel
-          channel = connection.channel()
-          self.log.print_log_verbose("channel initialized")
-          
-          #declare the queue
-          self.log.print_log_verbose("delcaring queue")
-          channel.queue_declare(queue=self.amqp_queue, durable=True, exclusive=False, auto_delete=False)
-          self.log.print_log_verbose("queue declared")
-          
-          #qos allows for better handling of multiple clients
-          channel.basic_qos(prefetch_count=1)
-        except Exception,e:
-          #this should be more robust and remove the catch-all except
-          self.log.print_error_and_exit("channel not created: %s (%s)" % (str(e),sys.exc_info()[0]))
+        #qos allows for better handling of multiple clients
+        #prefetch enough messages to fill a batch
+        channel.basic_qos(prefetch_count=self.batch_size)
         
-        ###################################
-        #this is copied from setup_channel#
-        ###################################
+        #bulk requests get their own channel and a small prefetch, so they can't crowd out interactive ones
+        bulk_channel = connection.channel()
+        bulk_channel.queue_declare(queue=self.bulk_queue, durable=True, exclusive=False, auto_delete=False)
+        bulk_channel.basic_qos(prefetch_count=self.bulk_prefetch)
+        learn_channel = None
+        if self.learner:
+          learn_channel = connection.channel()
+          learn_channel.queue_declare(queue=self.learn_queue, durable=True, exclusive=False, auto_delete=False)
+          learn_channel.basic_qos(prefetch_count=self.learn_batch)
+        self.connection = connection
         
-        if channel:
-          self.log.print_log_verbose("channel appears available")
-          def on_request(ch, method, properties, body):
-            self.log.print_log("received message (delivery tag %s): %s" % (method.delivery_tag,body))
-            result = self.classify(body)
-            self.log.print_log_verbose("classified as %s" % str(result))
-            ch.basic_publish(exchange='',
-                             routing_key=properties.reply_to,
-                             properties=pika.BasicProperties(correlation_id = properties.correlation_id),
-                             body=str(result))
-            self.log.print_log_verbose("sent response")
-            ch.basic_ack(delivery_tag = method.delivery_tag)
-            self.log.print_log_verbose("acknowledged %s" % method.delivery_tag)
-          
-          #everything is ready to go, now start the consuming of the queue
-          self.log.print_log("queue %s declared, listening for messages..." % self.amqp_queue)
-          channel.basic_consume(on_request,queue=self.amqp_queue)
-          #the next command blocks, so it will keep listening and this method will no longer loop
-          channel.start_consuming()
-        else:
-          self.log.print_error_and_exit("rabbitmq channel creation failed, classifier exiting...")
+        if lost is not None:
+          recovery = time.time() - lost
+          self.log.print_log("reconnected to %s after %.1f seconds",self.amqp_host,recovery)
+          self.recovery.observe(recovery)
+          self.status.add_stat('amqp recovery seconds',round(recovery,3))
+          self.update_status(stat_key='amqp reconnects')
+          self.counter['reconnects'].inc()
+          lost = None
+        delay = 1.0
+        
+        #everything is ready to go, now start the consuming of the queue
+        self.log.print_log("queues %s and %s declared, listening for messages...",self.amqp_queue,self.bulk_queue)
+        channel.basic_consume(self.on_request,queue=self.amqp_queue)
+        bulk_channel.basic_consume(self.on_request,queue=self.bulk_queue)
+        if learn_channel:
+          learn_channel.basic_consume(self.on_learn,queue=self.learn_queue)
+        #the next command blocks, so it will keep listening until the connection is lost
+        channel.start_consuming()
+      except (pika.exceptions.AMQPError,socket.error),e:
+        self.log.print_error("connection to %s lost: %s (%s)",self.amqp_host,e,sys.exc_info()[0])
+      
+      #anything held for a batch was never acknowledged, so the broker will deliver it again
+      self.connection = None
+      self.pending_requests = []
+      self.flush_scheduled = False
+      self.learned = []
+      self.learn_scheduled = False
+      if lost is None:
+        lost = time.time()
+      #the jitter keeps the workers from reconnecting all at once
+      wait = delay * random.uniform(0.5,1.0)
+      self.log.print_log("reconnecting in %.1f seconds...",wait)
+      time.sleep(wait)
+      delay = min(delay * 2,self.reconnect_max)
+  
+  def start_worker(self,learner=False):
+    """Fork a consumer process. The child shares the loaded model with the parent (copy-on-write).
+    Only the learner consumes the learn queue, the others pick its model versions up with the model watcher.
+    
+    """
+    pid = os.fork()
+    if pid > 0:
+      self.workers[pid] = time.time()
+      if learner:
+        self.learner_pid = pid
+      self.log.print_log("started %s (pid %s)","learner" if learner else "worker",pid)
+      return pid
+    #in the child
+    try:
+      signal.signal(signal.SIGTERM,signal.SIG_DFL)
+      self.workers = {}
+      self.learner = learner
+      #only the supervisor saves the status, and the sqlite connection can't be shared with it
+      self.status_filename = None
+      if self.feature_cache:
+        self.feature_cache.reopen()
+      #the supervisor reports what it counted before the fork itself
+      if self.status_dir:
+        self.status.statistics = {}
+      #this also replaces the metric locks, a scrape in the parent may have held one at the fork
+      self.metrics.reset()
+      if self.status_dir or self.metrics_dir:
+        self.start_metrics_snapshots()
+      self.consume()
+      code = 0
+    except SystemExit,e:
+      code = e.code if isinstance(e.code,int) else 1
+    except Exception,e:
+      self.log.print_error("worker (pid %s) failed: %s",os.getpid(),e)
+      self.log.print_error("Traceback: %s",traceback.format_exc())
+      code = 1
+    #os._exit skips the atexit handlers, so write out the cached rows, the statistics, the metrics and
+    #the queued log messages first. Learned files that were not saved yet are redelivered to the next learner.
+    if self.feature_cache:
+      self.feature_cache.commit()
+    try:
+      if self.status_dir:
+        self.write_statistics()
+      if self.metrics_dir:
+        self.metrics.write_snapshot(self.metrics_dir)
+    except (IOError,OSError):
+      pass
+    self.log.close()
+    os._exit(code)
+  
+  def supervise(self):
+    """Run consumers worker processes and restart any that die, until the supervisor is terminated.
+    The workers save their statistics to status_dir, and the supervisor serves them added to its own.
+    A worker's file is kept after it exits, so its counts stay in the totals when it is restarted.
+    
+    """
+    import shutil
+    import tempfile
+    self.status_dir = tempfile.mkdtemp(prefix='mediad-status-')
+    def terminate(signum,frame):
+      for pid in self.workers.keys():
+        try:
+          os.kill(pid,signal.SIGTERM)
+        except OSError:
+          pass
+      shutil.rmtree(self.status_dir,ignore_errors=True)
+      if self.metrics_dir:
+        shutil.rmtree(self.metrics_dir,ignore_errors=True)
+      sys.exit(0)
+    signal.signal(signal.SIGTERM,terminate)
+    
+    self.log.print_log("classifier supervisor is running (pid %s) with %d workers",str(os.getpid()),self.consumers)
+    self.update_status(stat_key='workers',stat_value=self.consumers)
+    for i in range(self.consumers):
+      self.start_worker(learner=(i == 0))
+    while True:
+      try:
+        pid,exit_status = os.wait()
+      except OSError,e:
+        #interrupted by a signal
+        continue
+      started = self.workers.pop(pid,None)
+      if started is None:
+        continue
+      self.log.print_error("worker (pid %s) exited with status %s, restarting it",pid,exit_status)
+      #keep its statistics under a name a new worker with the same pid will not overwrite
+      try:
+        os.rename(os.path.join(self.status_dir,'%d.json' % pid),os.path.join(self.status_dir,'%d-%d.json' % (pid,time.time())))
+      except OSError:
+        pass
+      self.update_status(stat_key='worker restarts')
+      #don't spin if the workers die right away, for example while the broker is down
+      if time.time() - started < 5:
+        time.sleep(5)
+      self.start_worker(learner=(pid == self.learner_pid))
   
   def stop(self):
     """Override for inherited stop method of Daemon class.
     Right now this just logs that the classifier is stopping.
     
     """
-    self.log.print_log("classifier daemon is shutting down (pid %s)" % str(os.getpid()))
+    self.log.print_log("classifier daemon is shutting down (pid %s)",str(os.getpid()))
     if self.status_filename and os.path.exists(self.status_filename):
       os.remove(self.status_filename)
     Daemon.stop(self)
+    if self.status_socket and os.path.exists(self.status_socket):
+      os.remove(self.status_socket)
+
+class Watcher(Daemon):
+  """Watch the watch_dir with inotify and classify new files once they are completely written.
+  
+  Files are held until they have been closed after writing (or moved in) and no further events have been
+  seen for settle seconds, so files that are still being copied are not classified. Files that become
+  ready together are sent to classifyd as one batch over a persistent connection.
+  """
+  #with a settle of 5 seconds, a file is retried for almost three hours
+  MAX_ATTEMPTS = 10
+  
+  def __init__(self,pidfile,watch_dir,logfile_path=None,amqp_host='localhost',settle=5,
+               extensions=VIDEO_EXTENSIONS,batch_size=32,tv_dir=None,movie_dir=None,move_journal=None,
+               transfers_per_device=2,matcher=None):
+    self.log = Logger(logfile_path,args.verbose if args else False,json_lines=config_log_json())
+    self.watch_dir = os.path.abspath(watch_dir)
+    self.amqp_host = amqp_host
+    self.settle = float(settle)
+    self.extensions = frozenset(e.lower().lstrip('.') for e in extensions)
+    self.batch_size = batch_size
+    #path -> [time of the last event, closed after writing, size at the last check]
+    self.pending = {}
+    #path -> number of times classifyd did not classify it, they are retried with a growing delay
+    self.attempts = {}
+    self.client = None
+    #files whose names identify them as episodes of a known series skip the classifier
+    self.matcher = matcher
+    #classified files are moved into the library if a move journal is configured
+    self.destinations = {Video.tv: tv_dir, Video.movie: movie_dir}
+    self.mover = None
+    #(destination, classification) of the files that were moved, filled in by the mover's threads
+    self.moved = Queue.Queue()
+    if move_journal:
+      from mover import Mover
+      self.mover = Mover(move_journal,transfers_per_device=transfers_per_device,log=self.log)
+    Daemon.__init__(self,pidfile)
+  
+  def __repr__(self):
+    if self.get_pid() is None:
+      return "mediad is not running"
+    else:
+      return "mediad is running (pid %s, watching %s)" % (self.get_pid(),self.watch_dir)
+  
+  def wanted(self,filename):
+    """Return True if the file has a video extension."""
+    return os.path.splitext(filename)[1].lower().lstrip('.') in self.extensions
+  
+  def file_event(self,filename,closed):
+    """Record an event for the file. closed is True if the file was closed after writing or moved in."""
+    if not self.wanted(filename) or self.in_library(filename):
+      return
+    entry = self.pending.get(filename)
+    if entry is None:
+      self.pending[filename] = [time.time(),closed,None]
+    else:
+      entry[0] = time.time()
+      entry[1] = closed
+  
+  def library_roots(self):
+    """Return the absolute tv and movie directories (the library), where files are moved to."""
+    return [os.path.abspath(directory) for directory in self.destinations.values() if directory]
+  
+  def in_library(self,path):
+    """Return True if the path is in the tv or movie directory."""
+    path = os.path.abspath(path)
+    return any(path == root or path.startswith(root + os.sep) for root in self.library_roots())
+  
+  def scan(self):
+    """Queue the files that are already in the watch_dir, they were missed while the daemon was down.
+    The library is skipped, its files were classified before.
+    
+    """
+    for path,subdirs,files in os.walk(self.watch_dir):
+      #pruning subdirs keeps os.walk from descending into the library
+      subdirs[:] = [subdir for subdir in subdirs if not self.in_library(os.path.join(path,subdir))]
+      for filename in files:
+        self.file_event(os.path.join(path,filename),True)
+  
+  def retry(self,filename):
+    """Queue a file again that classifyd did not classify (it may be down, or the file incomplete).
+    The delay doubles with every attempt. Return False, and forget the file, after MAX_ATTEMPTS.
+    
+    """
+    attempts = self.attempts.get(filename,0) + 1
+    if attempts > self.MAX_ATTEMPTS:
+      self.attempts.pop(filename,None)
+      return False
+    self.attempts[filename] = attempts
+    #a file is ready settle seconds after its last event, so the event is put in the future
+    self.pending[filename] = [time.time() + self.settle * (2 ** attempts - 1),True,None]
+    return True
+  
+  def ready_files(self):
+    """Return the pending files that have settled, and remove them from the pending list.
+    A file has settled when no event was seen for settle seconds, and it was either closed after writing
+    or its size did not change since the last check.
+    
+    """
+    now = time.time()
+    ready = []
+    for filename,entry in self.pending.items():
+      if now - entry[0] < self.settle:
+        continue
+      try:
+        size = os.path.getsize(filename)
+      except OSError:
+        #the file was removed or renamed before it settled
+        del self.pending[filename]
+        continue
+      if entry[1] or entry[2] == size:
+        ready.append(filename)
+        del self.pending[filename]
+      else:
+        entry[0] = now
+        entry[2] = size
+    return sorted(ready)
+  
+  def process(self,filenames):
+    """Classify the settled files and log the results."""
+    unidentified = []
+    for filename in filenames:
+      if identify_episode(self.matcher,filename) == Video.tv:
+        self.log.print_log("%s\t%s",filename,classification_name(Video.tv))
+        self.move(filename,Video.tv)
+      else:
+        unidentified.append(filename)
+    filenames = unidentified
+    for i in range(0,len(filenames),self.batch_size):
+      batch = filenames[i:i+self.batch_size]
+      try:
+        if self.client is None:
+          self.client = ClassifyClient(amqp_host=self.amqp_host)
+        results = self.client.classify_many(batch,batch_size=self.batch_size)
+      except Exception,e:
+        self.log.print_error("classification of %d files failed: %s",len(batch),e)
+        #reconnect on the next batch and retry these files after they settle again
+        self.client = None
+        for filename in batch:
+          self.file_event(filename,True)
+        continue
+      for filename,result in zip(batch,results):
+        if result == -1 and self.retry(filename):
+          self.log.print_log("%s was not classified, retrying (attempt %d)",filename,self.attempts[filename])
+          continue
+        self.attempts.pop(filename,None)
+        self.log.print_log("%s\t%s",filename,classification_name(result))
+        self.move(filename,result)
+  
+  def move(self,filename,result):
+    """Move a classified file into the tv or movie directory, keeping its path relative to the watch_dir."""
+    destination_dir = self.destinations.get(result)
+    if self.mover is None or not destination_dir:
+      return
+    if self.in_library(filename):
+      #the library can be inside the watch_dir, a file that is already in it stays where it is
+      self.log.print_log_verbose("%s is already in the library, not moving it",filename)
+      return
+    destination = os.path.join(os.path.abspath(destination_dir),os.path.relpath(filename,self.watch_dir))
+    self.mover.submit(filename,destination,callback=functools.partial(self.on_moved,result))
+  
+  def on_moved(self,result,source,destination,error):
+    """Called by the mover when a move is done. The file is learned from the main loop."""
+    if error is None:
+      self.moved.put((destination,result))
+  
+  def learn_moved(self):
+    """Send the files that were moved into the library to classifyd, to be added to the training set."""
+    while True:
+      try:
+        destination,result = self.moved.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        if self.client is None:
+          self.client = ClassifyClient(amqp_host=self.amqp_host)
+        self.client.learn(destination,result)
+      except Exception,e:
+        #the file is still learned when classifyd next starts and looks for new training data
+        self.log.print_error("%s could not be sent to be learned: %s",destination,e)
+        self.client = None
+  
+  def run(self):
+    """Override for inherited run method of the Daemon class.
+    
+    """
+    import pyinotify
+    self.log.print_log("mediad is running (pid %s), watching %s",str(os.getpid()),self.watch_dir)
+    
+    watcher = self
+    class EventHandler(pyinotify.ProcessEvent):
+      def process_IN_CLOSE_WRITE(self,event):
+        watcher.file_event(event.pathname,True)
+      def process_IN_MOVED_TO(self,event):
+        watcher.file_event(event.pathname,True)
+      def process_IN_MODIFY(self,event):
+        watcher.file_event(event.pathname,False)
+      def process_IN_CREATE(self,event):
+        if not event.dir:
+          watcher.file_event(event.pathname,False)
+    
+    if self.in_library(self.watch_dir):
+      self.log.print_error("watch_dir %s is inside the tv or movie directory, not starting",self.watch_dir)
+      return
+    watch_manager = pyinotify.WatchManager()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+    #the timeout (in milliseconds) lets the loop check for settled files while no events arrive
+    notifier = pyinotify.Notifier(watch_manager,EventHandler(),timeout=int(min(self.settle,1)*1000))
+    #files moved into the library would otherwise be seen again, classified and moved into it once more
+    watch_manager.add_watch(self.watch_dir,mask,rec=True,auto_add=True,exclude_filter=self.in_library)
+    if self.mover:
+      #finish the moves that were interrupted when the daemon last stopped
+      recovered = self.mover.recover()
+      if recovered:
+        self.log.print_log("recovered %d interrupted moves",recovered)
+    self.scan()
+    
+    while True:
+      notifier.process_events()
+      if notifier.check_events():
+        notifier.read_events()
+        #drain a burst of events before looking for settled files
+        continue
+      ready = self.ready_files()
+      if ready:
+        self.log.print_log_verbose("%d files settled",len(ready))
+        self.process(ready)
+      self.learn_moved()
 
 class Logger():
-  def __init__(self,logfile_path=None,verbose=False):
+  """Log messages to the logfile, or to stdout if there is no logfile.
+  Messages for the logfile are put on a bounded queue and written by a background thread, a batch
+  at a time with one flush, so the caller never waits for the disk. The arguments of a message are
+  only formatted into it when it is written, and verbose messages are dropped before that unless
+  verbose is on. With json_lines, every message is written as a JSON object on its own line.
+  
+  """
+  QUEUE_SIZE = 10000
+  
+  def __init__(self,logfile_path=None,verbose=False,json_lines=False):
     if logfile_path is None:
       self.logfile = None
     else:
       self.logfile = open(os.path.abspath(logfile_path),'a+')
     self.verbose = verbose
+    self.json_lines = json_lines
+    self.queue = None
+    self.writer = None
+    self.writer_pid = None
+    atexit.register(self.close)
   
   def __repr__(self):
     if self.logfile is None:
@@ -464,41 +1696,97 @@ class Logger():
     else:
       return self.logfile.name
   
+  def start_writer(self):
+    """Start the writer thread. This is done on the first message in each process, since threads
+    do not survive the daemon's fork. The child gets a new queue, the one it inherited holds messages
+    the parent writes (and possibly a lock that was held during the fork).
+    
+    """
+    self.queue = Queue.Queue(self.QUEUE_SIZE)
+    self.writer_pid = os.getpid()
+    self.writer = threading.Thread(target=self.write_loop,args=(self.queue,self.logfile))
+    self.writer.daemon = True
+    self.writer.start()
+  
+  def write_loop(self,queue,logfile):
+    while True:
+      entries = [queue.get()]
+      try:
+        while len(entries) < 1000:
+          entries.append(queue.get_nowait())
+      except Queue.Empty:
+        pass
+      lines = [self.format_entry(*entry) for entry in entries if entry is not None]
+      if lines:
+        logfile.write(''.join(lines))
+        logfile.flush()
+      if None in entries:
+        return
+  
+  def format_message(self,message,args):
+    if not args:
+      return str(message)
+    try:
+      return message % args
+    except (TypeError,ValueError),e:
+      return "%s %s (%s)" % (message,str(args),e)
+  
+  def format_entry(self,created,level,message,args):
+    message = self.format_message(message,args)
+    if self.json_lines:
+      return json.dumps({'time': time.strftime("%Y-%m-%dT%H:%M:%S",time.localtime(created)),
+                         'level': level,'pid': os.getpid(),'message': message}) + '\n'
+    return time.strftime("%Y-%m-%d %T| ",time.localtime(created)) + message + '\n'
+  
+  def write(self,level,message,args):
+    if self.logfile is None:
+      print self.format_message(message,args)
+    elif not self.logfile.closed:
+      if self.writer_pid != os.getpid():
+        self.start_writer()
+      #blocks if the writer falls behind by QUEUE_SIZE messages
+      self.queue.put((time.time(),level,message,args))
+  
   def close(self):
-    if self.logfile is not None:
-      logfile.close()
+    """Write the queued messages and close the logfile."""
+    if self.logfile is None or self.logfile.closed:
+      return
+    if self.writer_pid == os.getpid() and self.writer.is_alive():
+      self.queue.put(None)
+      self.writer.join(10)
+    self.writer_pid = None
+    self.logfile.close()
   
-  def timestamp(self):
-    return time.strftime("%Y-%m-%d %T| ")
-
-  def print_error(self,message):
+  def print_error(self,message,*args):
     """Print the error message with a prefix designating that it is an error.
     This should print to the logfile (if defined) as well as the stdout.
     
     """
-    self.print_log_and_stdout("ERROR: %s" % (message))
+    message = "ERROR: %s" % message
+    self.write('error',message,args)
+    if self.logfile:
+      print self.format_message(message,args)
 
-  def print_error_and_exit(self,message):
-    self.print_error(message)
+  def print_error_and_exit(self,message,*args):
+    self.print_error(message,*args)
     sys.exit(1)
 
-  def print_log(self,message):
-    if self.logfile is None:
-      print str(message)
-    else:
-      message = self.timestamp()+message
-      self.logfile.write(message+'\n')
-      self.logfile.flush()
+  def print_log(self,message,*args):
+    self.write('info',message,args)
 
-  def print_log_and_stdout(self,message):
-    self.print_log(message)
+  def print_log_and_stdout(self,message,*args):
+    self.print_log(message,*args)
     #if logfile is defined, then we already printed it to stdout
     if self.logfile:
-      print message
+      print self.format_message(message,args)
     
-  def print_log_verbose(self,message):
+  def print_log_verbose(self,message,*args):
     if self.verbose:
-      self.print_log(message)
+      self.write('verbose',message,args)
+
+def config_log_json():
+  """Return True if log_format in the GENERAL section asks for JSON lines."""
+  return config is not None and config.has_option("GENERAL","log_format") and config.get("GENERAL","log_format") == 'json'
 
 def verify_config(config):
   """Verify that the essential parts of the configuration are provided in the ConfigParser object.
@@ -511,6 +1799,9 @@ def verify_config(config):
     else:
       log.print_error("watch_dir must be defined in GENERAL section")
       return False
+    if not config.has_option('GENERAL','pidfile'):
+      log.print_error("pidfile must be defined in GENERAL section")
+      return False
   else:
     log.print_error("GENERAL section must be defined")
     return False
@@ -534,7 +1825,14 @@ def load_media_data(classifier):
   
   """
   if config.has_option("CLASSIFIER","svm_filename") and classifier.load_svm_from_file(config.get("CLASSIFIER","svm_filename")):
-    log.print_log_verbose("SVM loaded from file (%s)" % config.get("CLASSIFIER","svm_filename"))
+    log.print_log_verbose("SVM loaded from file (%s)",config.get("CLASSIFIER","svm_filename"))
+    if classifier.incremental and classifier.feature_cache:
+      #files that are not in the feature cache were added since the last start, learn just those
+      log.print_log("looking for new training data...")
+      for directory,classification in ((config.get("TV","tv_dir"),Video.tv),(config.get("MOVIES","movie_dir"),Video.movie)):
+        X_rows,y_rows = classifier.gather_training_data(directory,classification,new_only=True)
+        classifier.learn(X_rows,y_rows)
+      log.print_log("...done")
     return True
   else:
     log.print_log_verbose("svm_filename not provided or load failed. Now loading from scratch")
@@ -545,71 +1843,534 @@ def load_media_data(classifier):
   log.print_log("...done")
   return True
 
+#(description, expected classification, feature values) of typical files for --test,
+#features that are not listed are 0
+CLASSIFIER_TESTS = (
+  ("22 minute 720p episode",Video.tv,{'length': 1320,'width': 1280,'height': 720,'bitrate': 2500,'size': 400,
+                                      'video_streams': 1,'audio_streams': 1,'codec_h264': 1,'path_episode': 1}),
+  ("45 minute 1080p episode",Video.tv,{'length': 2700,'width': 1920,'height': 1080,'bitrate': 4500,'size': 1450,
+                                       'video_streams': 1,'audio_streams': 1,'subtitle_streams': 1,'codec_h264': 1,
+                                       'path_episode': 1,'path_season': 1}),
+  ("95 minute xvid movie",Video.movie,{'length': 5700,'width': 720,'height': 304,'bitrate': 1000,'size': 700,
+                                       'video_streams': 1,'audio_streams': 1,'codec_mpeg4': 1,'path_year': 1}),
+  ("2 hour 1080p movie",Video.movie,{'length': 7200,'width': 1920,'height': 1080,'bitrate': 8000,'size': 7000,
+                                    'video_streams': 1,'audio_streams': 2,'subtitle_streams': 2,'codec_h264': 1,
+                                    'path_year': 1}),
+)
+
 def test_classifier(classifier):
-  """Test the classifier with some sample training data.
-  You can modify the tests by changing the tests variable, each tuple would be a test.
+  """Test the classifier with the typical files in CLASSIFIER_TESTS, built with the configured features.
+  You can modify the tests by changing CLASSIFIER_TESTS.
   
   """
-  #each tuple is a test
-  #[length in seconds]
-  tests = ([1200],[2500],[5000],[8000])
-  for test in tests:
-    log.print_log("testing "+str(test[0])+" seconds ("+str(test[0]/60)+" minutes)...")
-    result = int(classifier.svc.predict(test)[0])
-    if result == Video.tv:
-      log.print_log("tv")
-    elif result == Video.movie:
-      log.print_log("movie")
-    else:
-      log.print_log("no result")
+  for description,expected,values in CLASSIFIER_TESTS:
+    log.print_log("testing %s...",description)
+    row = [float(values.get(name,0)) for name in classifier.features]
+    result = int(classifier.svc.predict(features.matrix([row]))[0])
+    log.print_log("%s (expected %s)",classification_name(result),classification_name(expected))
     log.print_log("...done")
 
+class ClassifyClient():
+  """A reusable RPC client for the classifyd queue.
+  One connection and one exclusive reply queue are kept for the life of the client, so any number
+  of requests can be sent and waited on. Replies are matched to requests by correlation id.
+  
+  """
+  def __init__(self,amqp_host='localhost',amqp_queue='classifyd',timeout=60,connection=None):
+    import pika
+    self.amqp_queue = amqp_queue
+    self.timeout = timeout
+    #a connection can be passed in, for example one to a stand-in broker
+    self.connection = connection or pika.BlockingConnection(pika.ConnectionParameters(host=amqp_host))
+    self.channel = self.connection.channel()
+    
+    log.print_log_verbose("declaring queues")
+    self.bulk_queue = self.amqp_queue + '.bulk'
+    self.learn_queue = self.amqp_queue + '.learn'
+    self.channel.queue_declare(queue=self.amqp_queue, durable=True)
+    self.channel.queue_declare(queue=self.bulk_queue, durable=True)
+    self.channel.queue_declare(queue=self.learn_queue, durable=True)
+    log.print_log_verbose("queues declared")
+    
+    #setup the response queue, it is used for every request from this client
+    result = self.channel.queue_declare(exclusive=True)
+    self.response_queue = result.method.queue
+    self.channel.basic_consume(self.on_response, no_ack=True, queue=self.response_queue)
+    
+    #correlation id -> response body, for requests that are in flight
+    self.responses = {}
+  
+  def on_response(self,ch,method,props,body):
+    log.print_log_verbose("received %s",body)
+    if props.correlation_id in self.responses:
+      self.responses[props.correlation_id] = body
+  
+  def submit(self,body,timeout=None,priority=PRIORITY_INTERACTIVE,content_type=None):
+    """Send a request without waiting for the response, to the classifyd queue or, with a priority below
+    PRIORITY_INTERACTIVE, to the bulk queue. Return the correlation id to pass to wait().
+    The request carries the time the client stops waiting as its deadline. The broker drops it if it is
+    still queued by then, and classifyd answers it without classifying if it gets it too late.
+    
+    """
+    import pika
+    #the correlation id will make sure we are reading the response to our request
+    corr_id = str(uuid.uuid4())
+    self.responses[corr_id] = None
+    #delivery_mode=2 means persistent
+    timeout = timeout if timeout is not None else self.timeout
+    sent = time.time()
+    self.channel.basic_publish(exchange='',
+                               routing_key=self.amqp_queue if priority >= PRIORITY_INTERACTIVE else self.bulk_queue,
+                               properties=pika.BasicProperties(
+                                                               reply_to = self.response_queue,
+                                                               correlation_id = corr_id,
+                                                               delivery_mode = 2,
+                                                               priority = priority,
+                                                               content_type = content_type,
+                                                               expiration = str(int(timeout * 1000)),
+                                                               headers = {'sent': sent,'deadline': sent + timeout}),
+                               body=body)
+    log.print_log_verbose("sent %s",body)
+    return corr_id
+  
+  def wait(self,corr_ids,timeout=None):
+    """Wait for the responses to the given correlation ids, for at most timeout seconds.
+    Return a dict of correlation id to response body (None if no response arrived in time).
+    
+    """
+    deadline = time.time() + (timeout if timeout is not None else self.timeout)
+    while any(self.responses.get(corr_id) is None for corr_id in corr_ids):
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        log.print_error("timed out waiting for classifyd")
+        break
+      self.connection.process_data_events(time_limit=min(remaining,1))
+    return dict((corr_id,self.responses.pop(corr_id,None)) for corr_id in corr_ids)
+  
+  def learn(self,filename,classification):
+    """Tell classifyd the classification of a file (for example, one that was moved into the library),
+    so it is added to the training set. The request goes to the learn queue, which only one classifyd
+    process consumes, and is not answered.
+    
+    """
+    import pika
+    self.channel.basic_publish(exchange='',routing_key=self.learn_queue,
+                               properties=pika.BasicProperties(delivery_mode = 2,
+                                                               priority = PRIORITY_BULK,
+                                                               headers = {'sent': time.time(),'learn': classification}),
+                               body=os.path.abspath(filename))
+    log.print_log_verbose("sent %s to be learned as %s",filename,classification_name(classification))
+  
+  def classify(self,filename,timeout=None):
+    """Classify a single file and return a classification from the Video class (-1 on error)."""
+    #classifyd may run in another directory
+    corr_id = self.submit(os.path.abspath(filename),timeout)
+    response = self.wait([corr_id],timeout)[corr_id]
+    try:
+      return int(response) if response is not None else -1
+    except ValueError:
+      log.print_error("unexpected response from classifyd: %s",response)
+      return -1
+  
+  def classify_many(self,filenames,batch_size=32,timeout=None,priority=None):
+    """Classify a list of files. They are sent as batch requests which are all in flight at once.
+    Unless a priority is given, a single batch is sent as interactive and anything larger as bulk.
+    Return a list of classifications in the same order as filenames.
+    
+    """
+    batches = [filenames[i:i+batch_size] for i in range(0,len(filenames),batch_size)]
+    if priority is None:
+      priority = PRIORITY_INTERACTIVE if len(batches) <= 1 else PRIORITY_BULK
+    corr_ids = [self.submit(json.dumps(batch),timeout,priority,BATCH_CONTENT_TYPE) for batch in batches]
+    responses = self.wait(corr_ids,timeout)
+    results = []
+    for corr_id,batch in zip(corr_ids,batches):
+      response = responses[corr_id]
+      results.extend(json.loads(response) if response is not None else [-1] * len(batch))
+    return results
+  
+  def close(self):
+    try:
+      self.connection.close()
+    except Exception,e:
+      log.print_log_verbose("error closing connection: %s",e)
+
+class LocalClient():
+  """Classifies files in this process with the saved model, with the same interface as ClassifyClient.
+  On a single host this saves the round trip through the broker, and classifyd does not need to run.
+  
+  """
+  def __init__(self,classifier,timeout=60):
+    self.classifier = classifier
+    self.timeout = timeout
+    if not classifier.load_svm_from_file(classifier.svm_filename):
+      raise IOError("no usable model in %s, start the classifier once to train it" % str(classifier.svm_filename))
+  
+  def learn(self,filename,classification):
+    """Add a file with a known classification to the training set, see Classifier.learn_file().
+    There is no connection to time the batch with, it is saved when it is full or the client is closed.
+    
+    """
+    self.classifier.learn_file(os.path.abspath(filename),classification)
+  
+  def classify(self,filename,timeout=None):
+    """Classify a single file and return a classification from the Video class (-1 on error)."""
+    return self.classify_many([filename],timeout=timeout)[0]
+  
+  def classify_many(self,filenames,batch_size=32,timeout=None,priority=None):
+    """Classify a list of files, batch_size files at a time.
+    Files that are not classified within timeout seconds are returned as -1. The priority is
+    ignored, there is no queue to jump in this process.
+    
+    """
+    deadline = time.time() + (timeout if timeout is not None else self.timeout)
+    results = []
+    for i in range(0,len(filenames),batch_size):
+      results.extend(self.classifier.classify_many(filenames[i:i+batch_size],deadline=deadline))
+    return results
+  
+  def close(self):
+    self.classifier.save_learned()
+    if self.classifier.feature_pool is not None:
+      self.classifier.feature_pool.close()
+      self.classifier.feature_pool = None
+    if self.classifier.feature_cache:
+      self.classifier.feature_cache.close()
+
+def config_amqp_host():
+  """Return the host of the RabbitMQ broker from the CLASSIFIER section of the config."""
+  if config is not None and config.has_option("CLASSIFIER","amqp_host"):
+    return config.get("CLASSIFIER","amqp_host")
+  return 'localhost'
+
+def config_extensions():
+  """Return the video extensions allowlist from the CLASSIFIER section of the config."""
+  if config.has_option("CLASSIFIER","extensions"):
+    return config.get("CLASSIFIER","extensions").replace(',',' ').split()
+  return VIDEO_EXTENSIONS
+
+def config_classifier_status():
+  """Return a ClassifierStatus for the classifyd configured in the CLASSIFIER section."""
+  status_filename = config.get("CLASSIFIER","status_filename") if config.has_option("CLASSIFIER","status_filename") else None
+  status_socket = config.get("CLASSIFIER","status_socket") if config.has_option("CLASSIFIER","status_socket") else None
+  return ClassifierStatus(config.get("CLASSIFIER","pidfile"),status_socket,status_filename)
+
+def config_classifier(daemon=True,**overrides):
+  """Build the Classifier from the CLASSIFIER section of the config, keyword arguments override the config.
+  Only the daemon saves its status, a classifier used in another process (local mode) does not.
+  
+  """
+  status_filename = None
+  if daemon and config.has_option("CLASSIFIER","status_filename"):
+    status_filename = config.get("CLASSIFIER","status_filename")
+  svm_filename = config.get("CLASSIFIER","svm_filename") if config.has_option("CLASSIFIER","svm_filename") else None
+  status_socket = config.get("CLASSIFIER","status_socket") if config.has_option("CLASSIFIER","status_socket") else None
+  status_interval = config.getfloat("CLASSIFIER","status_interval") if config.has_option("CLASSIFIER","status_interval") else 5
+  X_filename = config.get("CLASSIFIER","X_filename") if config.has_option("CLASSIFIER","X_filename") else None
+  y_filename = config.get("CLASSIFIER","y_filename") if config.has_option("CLASSIFIER","y_filename") else None
+  feature_cache_filename = config.get("CLASSIFIER","feature_cache") if config.has_option("CLASSIFIER","feature_cache") else None
+  parse_workers = config.getint("CLASSIFIER","parse_workers") if config.has_option("CLASSIFIER","parse_workers") else 1
+  parse_mode = config.get("CLASSIFIER","parse_mode") if config.has_option("CLASSIFIER","parse_mode") else 'thread'
+  if parse_mode not in ('thread','process'):
+    log.print_error_and_exit("parse_mode in CLASSIFIER section must be thread or process")
+  extensions = config_extensions()
+  sniff = config.getboolean("CLASSIFIER","sniff") if config.has_option("CLASSIFIER","sniff") else True
+  skip_samples = config.getboolean("CLASSIFIER","skip_samples") if config.has_option("CLASSIFIER","skip_samples") else True
+  batch_size = config.getint("CLASSIFIER","batch_size") if config.has_option("CLASSIFIER","batch_size") else 32
+  batch_window = config.getfloat("CLASSIFIER","batch_window") if config.has_option("CLASSIFIER","batch_window") else 0.05
+  model = config.get("CLASSIFIER","model") if config.has_option("CLASSIFIER","model") else 'svc'
+  consumers = config.getint("CLASSIFIER","consumers") if config.has_option("CLASSIFIER","consumers") else 1
+  heartbeat = config.getint("CLASSIFIER","heartbeat") if config.has_option("CLASSIFIER","heartbeat") else 60
+  reconnect_max = config.getfloat("CLASSIFIER","reconnect_max") if config.has_option("CLASSIFIER","reconnect_max") else 60
+  metrics_port = config.getint("CLASSIFIER","metrics_port") if config.has_option("CLASSIFIER","metrics_port") else 0
+  metrics_host = config.get("CLASSIFIER","metrics_host") if config.has_option("CLASSIFIER","metrics_host") else '127.0.0.1'
+  reload_interval = config.getfloat("CLASSIFIER","reload_interval") if config.has_option("CLASSIFIER","reload_interval") else 30
+  result_cache_size = config.getint("CLASSIFIER","result_cache_size") if config.has_option("CLASSIFIER","result_cache_size") else 10000
+  result_cache_ttl = config.getfloat("CLASSIFIER","result_cache_ttl") if config.has_option("CLASSIFIER","result_cache_ttl") else 300
+  bulk_prefetch = config.getint("CLASSIFIER","bulk_prefetch") if config.has_option("CLASSIFIER","bulk_prefetch") else 1
+  learn_batch = config.getint("CLASSIFIER","learn_batch") if config.has_option("CLASSIFIER","learn_batch") else 50
+  learn_interval = config.getfloat("CLASSIFIER","learn_interval") if config.has_option("CLASSIFIER","learn_interval") else 60
+  feature_names = config.get("CLASSIFIER","features").replace(',',' ').split() if config.has_option("CLASSIFIER","features") else DEFAULT_FEATURES
+  try:
+    features.check_features(feature_names)
+  except ValueError,e:
+    log.print_error_and_exit("features in CLASSIFIER section: %s",e)
+  if model not in ('svc','sgd'):
+    log.print_error_and_exit("model in CLASSIFIER section must be svc or sgd")
+  
+  options = dict(amqp_host=config_amqp_host(),
+                 svm_save_filename=svm_filename,
+                 status_filename=status_filename,X_filename=X_filename,y_filename=y_filename,
+                 feature_cache_filename=feature_cache_filename,
+                 parse_workers=parse_workers,parse_mode=parse_mode,
+                 extensions=extensions,sniff=sniff,skip_samples=skip_samples,
+                 batch_size=batch_size,batch_window=batch_window,model=model,
+                 status_socket=status_socket,status_interval=status_interval,
+                 feature_names=feature_names,consumers=consumers,
+                 heartbeat=heartbeat,reconnect_max=reconnect_max,
+                 metrics_port=metrics_port,metrics_host=metrics_host,reload_interval=reload_interval,
+                 result_cache_size=result_cache_size,result_cache_ttl=result_cache_ttl,bulk_prefetch=bulk_prefetch,
+                 learn_batch=learn_batch,learn_interval=learn_interval)
+  options.update(overrides)
+  return Classifier(config.get("CLASSIFIER","pidfile"),logfile_path,**options)
+
+def open_client():
+  """Return a client to classify files with: a LocalClient in local mode (--local, or mode=local in the
+  CLASSIFIER section), otherwise a ClassifyClient for the classifyd daemon.
+  
+  """
+  mode = config.get("CLASSIFIER","mode") if config.has_option("CLASSIFIER","mode") else 'broker'
+  if mode not in ('broker','local'):
+    log.print_error_and_exit("mode in CLASSIFIER section must be broker or local")
+  timeout = config.getfloat("CLASSIFIER","timeout") if config.has_option("CLASSIFIER","timeout") else 60
+  if mode == 'local' or (args and args.local):
+    try:
+      return LocalClient(config_classifier(daemon=False),timeout=timeout)
+    except IOError,e:
+      log.print_error_and_exit(str(e))
+  return ClassifyClient(amqp_host=config_amqp_host(),timeout=timeout)
+
+def expand_filenames(names,extensions=VIDEO_EXTENSIONS):
+  """Yield the files to classify from the --filename arguments.
+  A directory is walked for files with a video extension, and - reads one path per line from stdin.
+  
+  """
+  extensions = frozenset(e.lower().lstrip('.') for e in extensions)
+  for name in names:
+    if name == '-':
+      for line in sys.stdin:
+        line = line.rstrip('\r\n')
+        if line:
+          yield line
+    elif os.path.isdir(name):
+      for path,subdirs,files in os.walk(name):
+        subdirs.sort()
+        for filename in sorted(files):
+          if os.path.splitext(filename)[1].lower().lstrip('.') in extensions:
+            yield os.path.join(path,filename)
+    else:
+      yield name
+
+def identify_episode(matcher,filename):
+  """Return Video.tv if the file name is an episode of a series known to the matcher, otherwise None."""
+  if matcher is None:
+    return None
+  found = matcher.identify(filename,threshold=match_threshold())
+  if found is None:
+    return None
+  log.print_log_verbose("%s identified by name as %s (%s)",filename,found[1],found[2])
+  return Video.tv
+
+def classify_files(client,filenames,chunk_size=32,matcher=None,priority=None):
+  """Classify the files through one client, chunk_size files at a time.
+  Yield (filename, result) tuples as each chunk is answered, files that do not exist are returned as -1
+  without being sent. Files whose names identify them as episodes of a known series are not sent either.
+  Unless a priority is given, a run that fits in one chunk is sent as interactive and a longer one as bulk.
+  
+  """
+  filenames = iter(filenames)
+  chunk = list(itertools.islice(filenames,chunk_size))
+  while chunk:
+    #read one chunk ahead, to know if there is more than one
+    following = list(itertools.islice(filenames,chunk_size))
+    if priority is None:
+      priority = PRIORITY_INTERACTIVE if not following else PRIORITY_BULK
+    identified = {}
+    for filename in chunk:
+      if identify_episode(matcher,filename) == Video.tv:
+        identified[filename] = Video.tv
+    existing = [os.path.abspath(f) for f in chunk if f not in identified and os.path.isfile(f)]
+    results = dict(zip(existing,client.classify_many(existing,batch_size=chunk_size,priority=priority))) if existing else {}
+    for filename in chunk:
+      if filename in identified:
+        yield (filename,identified[filename])
+      else:
+        yield (filename,results.get(os.path.abspath(filename),-1))
+    chunk = following
+
+def open_tvdb_cache():
+  """Open the local TheTVDB store configured in the TVDB section, or return None if there is none.
+  Series are refreshed from the server when an api_key is configured and the server can be reached.
+  
+  """
+  if not config.has_option("TVDB","cache"):
+    return None
+  from tvdbcache import TVDBCache, TVDBFetcher
+  fetcher = None
+  if config.has_option("TVDB","api_key") and config.get("TVDB","api_key"):
+    mirror = config.get("TVDB","mirror") if config.has_option("TVDB","mirror") else 'http://thetvdb.com'
+    fetcher = TVDBFetcher(config.get("TVDB","api_key"),mirror)
+  ttl_days = config.getfloat("TVDB","ttl_days") if config.has_option("TVDB","ttl_days") else 7
+  return TVDBCache(config.get("TVDB","cache"),fetcher=fetcher,ttl=ttl_days*24*3600)
+
+def load_series_matcher():
+  """Build a SeriesMatcher from the series in the local TheTVDB store, or return None if there is no store
+  or it is empty.
+  
+  """
+  tvdb = open_tvdb_cache()
+  if tvdb is None:
+    return None
+  from episodename import SeriesMatcher
+  try:
+    matcher = SeriesMatcher(tvdb.series_names())
+  finally:
+    tvdb.close()
+  if len(matcher) == 0:
+    return None
+  log.print_log_verbose("series matcher built with %d series",len(matcher))
+  return matcher
+
+def resolve_episode(filename):
+  """Resolve the file name to the canonical episode in the local TheTVDB store, refreshing the series
+  through TheTVDB when it is stale. Return the episode dict, or None if it could not be resolved.
+  
+  """
+  from episodename import parse
+  parsed = parse(filename)
+  if parsed is None:
+    return None
+  tvdb = open_tvdb_cache()
+  if tvdb is None:
+    return None
+  try:
+    return tvdb.resolve(parsed.series,parsed.season,parsed.episode,parsed.aired)
+  finally:
+    tvdb.close()
+
+def match_threshold():
+  """The score a series name match needs to classify a file without the SVM."""
+  return config.getfloat("TVDB","match_threshold") if config.has_option("TVDB","match_threshold") else 0.8
+
+def classification_name(result):
+  """Return the name for a classification from the Video class."""
+  if result == Video.tv:
+    return "tv"
+  elif result == Video.movie:
+    return "movie"
+  return "error"
+
 def classify(filename):
-  """After verifying the file exists, send the filename to the classifyd message queue and wait for a response.
+  """After verifying the file exists, classify it through classifyd (or locally in local mode) and return the result.
   
   """
-  connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-  channel = connection.channel()
-  
-  log.print_log_verbose("declaring queue")
-  channel.queue_declare(queue='classifyd', durable=True)
-  log.print_log_verbose("queue declared")
-  
-  #the correlation id will make sure we are reading the response to our request
-  corr_id = str(uuid.uuid4())
-  
-  #setup the response callback
-  global response
-  response = None
-  def on_response(ch, method, props, body):
-    log.print_log("received %s" % str(body))
-    if corr_id == props.correlation_id:
-      global response
-      #return int(response.body)
-      response = int(body)
-  
-  #setup the response queue
-  result = channel.queue_declare(exclusive=True)
-  response_queue = result.method.queue
-  channel.basic_consume(on_response, no_ack=True, queue=response_queue)
-  
-  #delivery_mode=2 means persistent
-  #send the request
-  channel.basic_publish(exchange='',routing_key='classifyd',
-                        properties=pika.BasicProperties(
-                                                        reply_to = response_queue,
-                                                        correlation_id = corr_id,
-                                                        delivery_mode = 2),
-                        body=filename)
-  log.print_log("sent %s" % str(filename))
-  
-  #wait for the response
-  while response is None:
-    connection.process_data_events()
-  return int(response)
-  
-  connection.close()
-  return -1
+  client = open_client()
+  try:
+    return client.classify(filename)
+  finally:
+    client.close()
+
+#training set sizes that train() is timed with
+BENCHMARK_TRAIN_SIZES = (100,1000,5000)
+
+def percentile(values,percent):
+  """Return the value below which percent of the values fall (nearest rank)."""
+  values = sorted(values)
+  return values[min(len(values) - 1,int(round(percent / 100.0 * (len(values) - 1))))]
+
+def run_benchmark(files=200,requests=500):
+  """Measure the hot paths on a synthetic corpus of files in a temporary directory, with the
+  classifier settings from the config (but none of its files, so the saved model is not touched).
+  Return the results as a dict.
+  
+  """
+  import tempfile
+  import shutil
+  from corpus import make_corpus
+  from standin import StandInBroker
+  directory = tempfile.mkdtemp(prefix='mediad-benchmark-')
+  results = {'version': version, 'date': time.strftime("%Y-%m-%d %H:%M:%S"), 'files': files}
+  def build(**overrides):
+    options = dict(svm_save_filename=None,X_filename=None,y_filename=None,feature_cache_filename=None,
+                   status_socket=None,batch_window=0)
+    options.update(overrides)
+    return config_classifier(daemon=False,**options)
+  try:
+    log.print_log("writing %d synthetic files to %s...",files,directory)
+    tv_dir,movie_dir = make_corpus(os.path.join(directory,'corpus'),files)
+    
+    #gather_training_data, with an empty feature cache and then again with a full one
+    feature_cache_filename = os.path.join(directory,'features.db')
+    for name in ('gather','gather (feature cache)'):
+      log.print_log("benchmarking %s...",name)
+      classifier = build(feature_cache_filename=feature_cache_filename)
+      X_rows = []
+      y_rows = []
+      start = time.time()
+      for training_dir,classification in ((tv_dir,Video.tv),(movie_dir,Video.movie)):
+        X,y = classifier.gather_training_data(training_dir,classification)
+        X_rows.extend(X)
+        y_rows.extend(y)
+      seconds = time.time() - start
+      results[name] = {'seconds': seconds, 'files per second': files / seconds, 'examples': len(X_rows)}
+      classifier.feature_cache.close()
+    if len(set(y_rows)) < 2:
+      raise ValueError("the synthetic files could not be parsed, is kaa.metadata installed?")
+    
+    #train() against the size of the training set, the examples are drawn from the corpus
+    log.print_log("benchmarking train...")
+    rng = random.Random(0)
+    results['train'] = []
+    #one untimed train first, so the first size does not pay for importing sklearn
+    classifier = build()
+    classifier.add_training_rows(X_rows,y_rows)
+    classifier.train()
+    for size in BENCHMARK_TRAIN_SIZES:
+      indexes = [rng.randrange(len(X_rows)) for i in range(size)]
+      classifier = build()
+      classifier.add_training_rows([X_rows[i] for i in indexes],[y_rows[i] for i in indexes])
+      start = time.time()
+      classifier.train()
+      results['train'].append({'examples': size, 'seconds': time.time() - start})
+    
+    #loading the saved model, as the daemon does when it starts
+    log.print_log("benchmarking model load...")
+    saved = dict(svm_save_filename=os.path.join(directory,'svm.pkl'),
+                 X_filename=os.path.join(directory,'X.dat'),y_filename=os.path.join(directory,'y.dat'))
+    classifier = build(**saved)
+    classifier.add_training_rows(X_rows,y_rows)
+    classifier.train()
+    #the result cache is turned on for the second classify run below
+    classifier = build(result_cache_size=0,**saved)
+    start = time.time()
+    if not classifier.load_svm_from_file(saved['svm_save_filename']):
+      raise ValueError("the model saved by the benchmark could not be loaded")
+    manifest = classifier.model_store.manifest()
+    results['model load'] = {'seconds': time.time() - start,'version': manifest['version'],
+                             'bytes': sum(details['size'] for details in manifest['files'].values())}
+    
+    #the classify RPC, through the daemon's request handler and a client on a stand-in broker
+    log.print_log("benchmarking classify...")
+    broker = StandInBroker()
+    classifier.connection = broker.connect()
+    channel = classifier.connection.channel()
+    for queue in (classifier.amqp_queue,classifier.bulk_queue):
+      channel.queue_declare(queue=queue,durable=True)
+      channel.basic_consume(classifier.on_request,queue=queue)
+    client = ClassifyClient(amqp_queue=classifier.amqp_queue,connection=broker.connect())
+    filenames = sorted(expand_filenames([tv_dir,movie_dir]))
+    for name in ('classify','classify (result cache)'):
+      if name == 'classify (result cache)':
+        classifier.result_cache = ResultCache()
+      latencies = []
+      for i in range(requests):
+        start = time.time()
+        client.classify(filenames[i % len(filenames)])
+        latencies.append(time.time() - start)
+      results[name] = {'requests': requests,
+                       'p50 ms': percentile(latencies,50) * 1000,
+                       'p99 ms': percentile(latencies,99) * 1000,
+                       'mean ms': sum(latencies) / len(latencies) * 1000}
+    #batches are measured without the result cache, it would answer every file from the runs above
+    classifier.result_cache = None
+    start = time.time()
+    client.classify_many(filenames,batch_size=classifier.batch_size)
+    seconds = time.time() - start
+    results['classify batches'] = {'seconds': seconds,'files per second': len(filenames) / seconds}
+    client.close()
+  finally:
+    shutil.rmtree(directory,ignore_errors=True)
+  return results
 
 def main():
   
@@ -622,9 +2383,14 @@ def main():
   parser.add_argument('-d','--daemon', help="manage the media daemon", nargs=1)
   parser.add_argument('-p','--plot', help="plot the training data", action='store_true')
   parser.add_argument('-t','--test', help="test the classifier SVM", action='store_true')
-  parser.add_argument('-f','--filename', help="classify a specific file", nargs=1)
+  parser.add_argument('-f','--filename', help="classify files (a directory is walked, - reads paths from stdin)", nargs='+')
   parser.add_argument('--logfile', help="specify a log file for the output", nargs=1)
   parser.add_argument('-c','--classifier', help="manage the classifier daemon", nargs=1)
+  parser.add_argument('--local', help="classify with the saved model in this process, without classifyd", action='store_true')
+  parser.add_argument('--benchmark', help="benchmark the classifier on synthetic files and write the results as JSON (default benchmark.json)",
+                      nargs='?', const='benchmark.json', metavar='FILENAME')
+  parser.add_argument('--benchmark-files', help="number of synthetic files for --benchmark", type=int, default=200)
+  parser.add_argument('--tvdb-import', help="seed the local TheTVDB store from XML dump files", nargs=1)
   global args
   args = parser.parse_args()
   
@@ -641,31 +2407,63 @@ def main():
       logfile_path = os.path.abspath(config.get("GENERAL","logfile"))
   
   global log
-  log = Logger(logfile_path)
+  log = Logger(logfile_path,json_lines=config_log_json())
   
   if verify_config(config) is False:
-    log.print_error_and_exit("Error in config file %s" % args.conf)
+    log.print_error_and_exit("Error in config file %s",args.conf)
   
   if args.verbose:
     log.print_log_verbose("verbose logging on")
   
+  if args.tvdb_import:
+    tvdb = open_tvdb_cache()
+    if tvdb is None:
+      log.print_error_and_exit("cache must be defined in TVDB section to import a dump")
+    log.print_log("importing %s...",args.tvdb_import[0])
+    log.print_log_and_stdout("imported %d series into %s",tvdb.import_dump(args.tvdb_import[0]),tvdb)
+    tvdb.close()
+  
+  if args.daemon:
+    if not args.daemon[0] or args.daemon[0] not in ('start','stop','restart','status'):
+      log.print_error_and_exit("expected daemon argument in {start|stop|restart|status}")
+    settle = config.getfloat("GENERAL","settle") if config.has_option("GENERAL","settle") else 5
+    move_files = config.getboolean("GENERAL","move_files") if config.has_option("GENERAL","move_files") else False
+    move_journal = config.get("GENERAL","move_journal") if config.has_option("GENERAL","move_journal") else None
+    if move_files and not move_journal:
+      log.print_error_and_exit("move_journal must be defined in GENERAL section to move files")
+    transfers_per_device = config.getint("GENERAL","transfers_per_device") if config.has_option("GENERAL","transfers_per_device") else 2
+    watcher = Watcher(config.get("GENERAL","pidfile"),config.get("GENERAL","watch_dir"),logfile_path,
+                      amqp_host=config_amqp_host(),
+                      settle=settle,extensions=config_extensions(),
+                      tv_dir=config.get("TV","tv_dir"),
+                      movie_dir=config.get("MOVIES","movie_dir") if config.has_option("MOVIES","movie_dir") else None,
+                      move_journal=move_journal if move_files else None,
+                      transfers_per_device=transfers_per_device,
+                      matcher=load_series_matcher() if args.daemon[0] in ('start','restart') else None)
+    if args.daemon[0] in ('start','restart'):
+      if args.daemon[0] == 'restart':
+        watcher.stop()
+      if watcher.get_pid():
+        log.print_log_and_stdout("media daemon already running (pid %s)",watcher.get_pid())
+      else:
+        watcher.start()
+    elif args.daemon[0] == 'stop':
+      watcher.stop()
+    elif args.daemon[0] == 'status':
+      log.print_log_and_stdout(str(watcher))
+  
+  classifier = None
   if args.classifier:
-    if not args.classifier[0] or args.classifier[0] not in ('start','stop','restart','status'):
-      log.print_error_and_exit("expected classifier argument in {start|stop|restart|status}")
-    #at this point, we have a valid daemon command
-    svm_filename = config.get("CLASSIFIER","svm_filename") if config.has_option("CLASSIFIER","svm_filename") else None
-    status_filename = config.get("CLASSIFIER","status_filename") if config.has_option("CLASSIFIER","status_filename") else None
-    X_filename = config.get("CLASSIFIER","X_filename") if config.has_option("CLASSIFIER","X_filename") else None
-    y_filename = config.get("CLASSIFIER","y_filename") if config.has_option("CLASSIFIER","y_filename") else None
-    
-    classifier = Classifier(config.get("CLASSIFIER","pidfile"),logfile_path,svm_save_filename=svm_filename,
-                                       status_filename=status_filename,X_filename=X_filename,y_filename=y_filename)
+    if not args.classifier[0] or args.classifier[0] not in ('start','stop','restart','status','reload','retrain'):
+      log.print_error_and_exit("expected classifier argument in {start|stop|restart|status|reload|retrain}")
+    #at this point, we have a valid daemon command. status only reads the pidfile and the status socket
+    classifier = config_classifier_status() if args.classifier[0] == 'status' else config_classifier()
     if args.classifier[0] in ('start','restart'):
       if args.classifier[0] == 'restart':
         classifier.stop()
       if classifier.get_pid():
         #if the classifier is already running, then we won't load the media data again
-        log.print_log_and_stdout("classifier daemon already running (pid %s)" % classifier.get_pid())
+        log.print_log_and_stdout("classifier daemon already running (pid %s)",classifier.get_pid())
       else:
         if load_media_data(classifier):
           classifier.start()
@@ -676,29 +2474,78 @@ def main():
       classifier.stop()
     elif args.classifier[0] == 'status':
       log.print_log_and_stdout(str(classifier))
-      log.print_log_and_stdout("statistics: %s" % str(classifier.get_statistics()))
+      log.print_log_and_stdout("statistics: %s",str(classifier.get_statistics()))
+    elif args.classifier[0] in ('reload','retrain'):
+      if args.classifier[0] == 'retrain':
+        #train a new model version from scratch, next to the running daemon
+        trainer = config_classifier(daemon=False)
+        log.print_log("gathering training data...")
+        trainer.gather_training_data(config.get("TV","tv_dir"),Video.tv)
+        trainer.gather_training_data(config.get("MOVIES","movie_dir"),Video.movie)
+        trainer.train()
+        log.print_log_and_stdout("model version %s saved",trainer.model_version)
+      if classifier.get_pid():
+        #the daemon loads the current model version in the background and switches to it between batches
+        os.kill(classifier.get_pid(),signal.SIGHUP)
+        log.print_log_and_stdout("classifier daemon (pid %s) is reloading the model",classifier.get_pid())
+      elif args.classifier[0] == 'reload':
+        log.print_log_and_stdout("classifier daemon is not running")
 
   if args.plot:
     log.print_log("plotting training data...")
-    
+    plotter = config_classifier(daemon=False)
+    if load_media_data(plotter):
+      plotter.plot_training_data()
+    else:
+      log.print_error("error loading media data")
     log.print_log("...done")
+  if args.benchmark:
+    try:
+      results = run_benchmark(files=args.benchmark_files)
+    except (ValueError,ImportError),e:
+      log.print_error_and_exit("benchmark failed: %s",e)
+    f = open(args.benchmark,'w')
+    try:
+      json.dump(results,f,indent=2,sort_keys=True)
+    finally:
+      f.close()
+    log.print_log_and_stdout("benchmark results written to %s",args.benchmark)
   if args.test:
-    test_classifier(classifier)
+    #the model is loaded (or trained) in this process, the daemon's status is not touched
+    tester = config_classifier(daemon=False)
+    if load_media_data(tester):
+      test_classifier(tester)
+    else:
+      log.print_error_and_exit("error loading media data")
   else:
     if args.filename:
-      log.print_log("classifying file...")
-      if os.path.exists(args.filename[0]):
-        log.print_log_verbose("file found: "+str(args.filename[0]))
-        result = classify(args.filename[0])
-        if result == Video.tv:
-          log.print_log_and_stdout("tv")
-        elif result == Video.movie:
-          log.print_log_and_stdout("movie")
+      if len(args.filename) == 1 and args.filename[0] != '-' and not os.path.isdir(args.filename[0]):
+        log.print_log("classifying file...")
+        if os.path.exists(args.filename[0]):
+          log.print_log_verbose("file found: "+str(args.filename[0]))
+          result = identify_episode(load_series_matcher(),args.filename[0])
+          if result is None:
+            result = classify(args.filename[0])
+          else:
+            episode = resolve_episode(args.filename[0])
+            if episode is not None:
+              log.print_log("%s is %s S%02dE%02d %s",args.filename[0],episode['series'],episode['season'],episode['episode'],episode['name'])
+          log.print_log_and_stdout(classification_name(result))
         else:
-          log.print_log_and_stdout("error")
+          log.print_error("file not found")
+        log.print_log("...done")
       else:
-        log.print_error("file not found")
-      log.print_log("...done")
+        #bulk mode, one client for the whole batch and one line per file
+        log.print_log("classifying files...")
+        client = open_client()
+        try:
+          for filename,result in classify_files(client,expand_filenames(args.filename,config_extensions()),
+                                                matcher=load_series_matcher()):
+            sys.stdout.write("%s\t%s\n" % (filename,classification_name(result)))
+            sys.stdout.flush()
+        finally:
+          client.close()
+        log.print_log("...done")
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import threading
+import BaseHTTPServer
+
+#upper bounds (seconds) of the latency histogram buckets, from a fraction of a millisecond for predict
+#to several seconds for parsing a file on a slow disk
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+  def reset(self):
+    self.value = 0
+    #a fork can copy the lock while another thread holds it, so the child gets a new one
+    self.lock = threading.Lock()
+
+  def snapshot(self):
+    return {'type': 'counter', 'help': self.help, 'value': self.value}
+
+class Timer:
+  """Context manager that observes the time spent in the block."""
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.histogram.observe(time.time() - self.start)
+
+class Histogram:
+  def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.buckets = tuple(buckets)
+    #one count per bucket (not cumulative), plus the values above the last bucket
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    index = 0
+    while index < len(self.buckets) and value > self.buckets[index]:
+      index += 1
+    with self.lock:
+      self.counts[index] += 1
+      self.sum += value
+
+  def time(self):
+    return Timer(self)
+
+  def reset(self):
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def snapshot(self):
+    with self.lock:
+      return {'type': 'histogram', 'help': self.help, 'buckets': list(self.buckets),
+              'counts': list(self.counts), 'sum': self.sum}
+
+class Registry:
+  """
+  Counters and latency histograms, rendered in the Prometheus text format.
+
+  Each process keeps its own registry. Forked workers write a snapshot of theirs to a
+  shared directory (write_snapshot), and the process serving the metrics adds those to
+  its own when it renders them, so the totals cover every worker, including workers
+  that have died since.
+  """
+  def __init__(self, prefix=''):
+    self.prefix = prefix
+    self.metrics = []
+
+  def counter(self, name, help):
+    metric = Counter(self.prefix + name, help)
+    self.metrics.append(metric)
+    return metric
+
+  def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+    metric = Histogram(self.prefix + name, help, buckets)
+    self.metrics.append(metric)
+    return metric
+
+  def reset(self):
+    """Set everything back to zero, in a forked worker that should only count its own work.
+    The locks are replaced too, the serving thread of the parent may have held one at the fork.
+
+    """
+    for metric in self.metrics:
+      metric.reset()
+
+  def snapshot(self):
+    """Return the current values as a dict of metric name to values, which can be saved as JSON."""
+    return dict((metric.name, metric.snapshot()) for metric in self.metrics)
+
+  def write_snapshot(self, directory):
+    """Save the snapshot to <pid>.json in the directory, atomically."""
+    save_snapshot(directory, self.snapshot())
+
+  def collect(self, directory=None):
+    """Return the snapshot of this registry added to the snapshots of the other processes in the directory."""
+    return merge([self.snapshot()] + load_snapshots(directory))
+
+def save_snapshot(directory, snapshot):
+  """Save a JSON-serializable snapshot of this process to <pid>.json in the directory, atomically."""
+  filename = os.path.join(directory, '%d.json' % os.getpid())
+  f = open(filename + '.tmp', 'w')
+  try:
+    json.dump(snapshot, f)
+  finally:
+    f.close()
+  os.rename(filename + '.tmp', filename)
+
+def load_snapshots(directory):
+  """Return the snapshots the other processes saved to the directory with save_snapshot()."""
+  snapshots = []
+  if directory and os.path.isdir(directory):
+    own = '%d.json' % os.getpid()
+    for filename in sorted(os.listdir(directory)):
+      if filename.endswith('.json') and filename != own:
+        try:
+          f = open(os.path.join(directory, filename), 'r')
+          try:
+            snapshots.append(json.load(f))
+          finally:
+            f.close()
+        except (IOError, ValueError):
+          #a worker that is replacing its snapshot right now
+          continue
+  return snapshots
+
+def merge(snapshots):
+  """Add up the counters and histograms of several snapshots."""
+  merged = {}
+  for snapshot in snapshots:
+    for name, metric in snapshot.items():
+      if name not in merged:
+        merged[name] = json.loads(json.dumps(metric))
+        continue
+      total = merged[name]
+      if metric['type'] == 'counter':
+        total['value'] += metric['value']
+      elif metric['buckets'] == total['buckets']:
+        total['counts'] = [a + b for a, b in zip(total['counts'], metric['counts'])]
+        total['sum'] += metric['sum']
+  return merged
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(snapshot):
+  """Return the snapshot in the Prometheus text exposition format."""
+  lines = []
+  for name in sorted(snapshot):
+    metric = snapshot[name]
+    lines.append('# HELP %s %s' % (name, metric['help']))
+    lines.append('# TYPE %s %s' % (name, metric['type']))
+    if metric['type'] == 'counter':
+      lines.append('%s %s' % (name, format_value(metric['value'])))
+      continue
+    cumulative = 0
+    for bound, count in zip(list(metric['buckets']) + [float('inf')], metric['counts']):
+      cumulative += count
+      lines.append('%s_bucket{le="%s"} %d' % (name, format_value(bound), cumulative))
+    lines.append('%s_sum %s' % (name, format_value(metric['sum'])))
+    lines.append('%s_count %d' % (name, cumulative))
+  return '\n'.join(lines) + '\n'
+
+def serve(host, port, collect, log=None):
+  """Serve the text returned by collect() on http://host:port/metrics from a daemon thread.
+  Return the server, or None if the port could not be bound.
+
+  """
+  class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split('?')[0] not in ('/', '/metrics'):
+        self.send_error(404)
+        return
+      body = collect()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      #scrapes every few seconds would flood the log
+      pass
+
+  try:
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+  except Exception, e:
+    if log:
+      log.print_error("metrics could not be served on %s:%s: %s", host, port, e)
+    return None
+  thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+  thread.daemon = True
+  thread.start()
+  return server
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+from mover import fsync_path
+
+#bump when the layout of a model version or its manifest changes
+FORMAT_VERSION = 1
+
+def file_checksum(filename):
+  """Return the sha256 of the file as a hex string."""
+  digest = hashlib.sha256()
+  f = open(filename, 'rb')
+  try:
+    while True:
+      data = f.read(1024 * 1024)
+      if not data:
+        break
+      digest.update(data)
+  finally:
+    f.close()
+  return digest.hexdigest()
+
+class ModelStore:
+  """
+  Versioned model artifacts, kept in a directory next to the configured svm_filename.
+
+  Every save writes a new numbered version directory with the model dumped by joblib
+  without compression (so its arrays can be memory mapped on load, and are shared
+  between the forked workers) and a manifest.json with the format version, the
+  feature schema, and the size and sha256 of every file. The 'current' symlink is
+  then switched to the new version with a rename, so a reader sees either the old
+  or the new model, never a partial one. load() checks the checksums first.
+  """
+  MANIFEST = 'manifest.json'
+  CURRENT = 'current'
+
+  def __init__(self, svm_filename, keep=3):
+    self.directory = os.path.abspath(svm_filename) + '.d'
+    self.keep = keep
+
+  def __repr__(self):
+    return self.directory
+
+  def exists(self):
+    return os.path.islink(os.path.join(self.directory, self.CURRENT))
+
+  def current_version(self):
+    """Return the number of the current version, or None if nothing was saved. This is only a readlink."""
+    try:
+      return int(os.readlink(os.path.join(self.directory, self.CURRENT)))
+    except (OSError, ValueError):
+      return None
+
+  def version_directory(self, version):
+    return os.path.join(self.directory, '%06d' % version)
+
+  def versions(self):
+    if not os.path.isdir(self.directory):
+      return []
+    return sorted(int(name) for name in os.listdir(self.directory) if name.isdigit())
+
+  def manifest(self, version=None):
+    """Return the manifest of the version (the current one by default), or None if there is none."""
+    version = self.current_version() if version is None else version
+    if version is None:
+      return None
+    try:
+      f = open(os.path.join(self.version_directory(version), self.MANIFEST), 'r')
+      try:
+        return json.load(f)
+      finally:
+        f.close()
+    except (IOError, ValueError):
+      return None
+
+  def save(self, model, schema, **details):
+    """Save the model as a new version and make it the current one. Extra keyword arguments are
+    recorded in the manifest. Return the manifest.
+
+    """
+    from sklearn.externals import joblib
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    versions = self.versions()
+    version = (versions[-1] if versions else 0) + 1
+    temp_directory = os.path.join(self.directory, '.tmp-%s' % uuid.uuid4())
+    os.mkdir(temp_directory)
+    try:
+      joblib.dump(model, os.path.join(temp_directory, 'model.pkl'))
+      files = {}
+      for name in sorted(os.listdir(temp_directory)):
+        filename = os.path.join(temp_directory, name)
+        fsync_path(filename)
+        files[name] = {'size': os.path.getsize(filename), 'sha256': file_checksum(filename)}
+      manifest = {'format': FORMAT_VERSION, 'version': version, 'created': time.time(),
+                  'model': type(model).__name__, 'schema': schema, 'files': files}
+      manifest.update(details)
+      f = open(os.path.join(temp_directory, self.MANIFEST), 'w')
+      try:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      os.rename(temp_directory, self.version_directory(version))
+    except:
+      shutil.rmtree(temp_directory, ignore_errors=True)
+      raise
+    #switch the current link in one rename
+    link = os.path.join(self.directory, '.current-%s' % uuid.uuid4())
+    os.symlink('%06d' % version, link)
+    os.rename(link, os.path.join(self.directory, self.CURRENT))
+    fsync_path(self.directory)
+    self.prune()
+    return manifest
+
+  def prune(self):
+    """Remove all but the newest keep versions. A reader that still has an old version mapped keeps
+    its pages, the files are only gone from the directory.
+
+    """
+    for version in self.versions()[:-self.keep]:
+      shutil.rmtree(self.version_directory(version), ignore_errors=True)
+
+  def load(self, version=None, mmap=True):
+    """Load a version (the current one by default). Return (model, manifest), or raise ValueError
+    if the version is missing, was written in another format, or does not match its checksums.
+    With mmap, the arrays of the model are mapped read-only instead of read into memory.
+
+    """
+    version = self.current_version() if version is None else version
+    manifest = self.manifest(version)
+    if manifest is None:
+      raise ValueError("%s has no model version %s" % (self.directory, version))
+    if manifest.get('format') != FORMAT_VERSION:
+      raise ValueError("model version %s has format %s, expected %d" % (version, manifest.get('format'), FORMAT_VERSION))
+    directory = self.version_directory(version)
+    for name, details in manifest['files'].items():
+      filename = os.path.join(directory, name)
+      if not os.path.exists(filename) or os.path.getsize(filename) != details['size'] or file_checksum(filename) != details['sha256']:
+        raise ValueError("%s does not match the checksum in the manifest of model version %s" % (filename, version))
+    from sklearn.externals import joblib
+    return (joblib.load(os.path.join(directory, 'model.pkl'), mmap_mode='r' if mmap else None), manifest)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+import os
+import json
+import uuid
+import errno
+import shutil
+import threading
+import ctypes
+import ctypes.util
+from multiprocessing.pool import ThreadPool
+
+#bytes copied per system call when the file has to be copied to another filesystem
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def load_libc():
+  try:
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  except OSError:
+    return None
+
+libc = load_libc()
+
+def kernel_copy(name, source_fd, destination_fd, size):
+  """Copy size bytes between the file descriptors in the kernel with copy_file_range or sendfile.
+  Return the number of bytes copied, which is less than size if the call is not supported.
+
+  """
+  function = getattr(libc, name, None) if libc else None
+  if function is None:
+    return 0
+  function.restype = ctypes.c_ssize_t
+  copied = 0
+  while copied < size:
+    count = min(CHUNK_SIZE, size - copied)
+    if name == 'copy_file_range':
+      result = function(source_fd, None, destination_fd, None, ctypes.c_size_t(count), 0)
+    else:
+      result = function(destination_fd, source_fd, None, ctypes.c_size_t(count))
+    if result < 0:
+      error = ctypes.get_errno()
+      if error == errno.EINTR:
+        continue
+      if copied == 0 and error in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+        #not supported for these files, the caller falls back to the next method
+        return 0
+      raise OSError(error, os.strerror(error))
+    if result == 0:
+      break
+    copied += result
+  return copied
+
+def copy_data(source_fd, destination_fd, size):
+  """Copy the file, using the fastest method that works: copy_file_range, sendfile, then read/write."""
+  copied = 0
+  for name in ('copy_file_range', 'sendfile'):
+    copied = kernel_copy(name, source_fd, destination_fd, size)
+    if copied:
+      break
+  #finish with plain reads and writes (or do the whole copy if the kernel calls were not available)
+  os.lseek(source_fd, copied, os.SEEK_SET)
+  os.lseek(destination_fd, copied, os.SEEK_SET)
+  while True:
+    data = os.read(source_fd, CHUNK_SIZE)
+    if not data:
+      break
+    while data:
+      written = os.write(destination_fd, data)
+      data = data[written:]
+
+def fsync_path(path):
+  """Flush a file or a directory (so a rename in it is durable) to disk."""
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+class Mover:
+  """
+  Move files into the media library.
+
+  A file on the same filesystem as the destination is moved with os.rename. Otherwise it
+  is copied to a temporary file next to the destination (in the kernel when possible),
+  fsync'ed, verified, renamed into place, and only then is the source removed.
+
+  Every move is recorded in an append-only journal before it starts and when it is
+  done, so moves interrupted by a crash are cleaned up and finished by recover().
+  Transfers run in a thread pool, with at most transfers_per_device copies to the
+  same destination device at a time.
+  """
+  def __init__(self, journal_filename, transfers_per_device=2, workers=4, log=None):
+    self.journal_filename = os.path.abspath(journal_filename)
+    self.transfers_per_device = transfers_per_device
+    self.workers = workers
+    self.log = log
+    self.lock = threading.Lock()
+    self.device_slots = {}
+    self.pool = None
+    self.journal = None
+
+  def __repr__(self):
+    return self.journal_filename
+
+  def print_log(self, message):
+    if self.log:
+      self.log.print_log(message)
+
+  def print_error(self, message):
+    if self.log:
+      self.log.print_error(message)
+
+  def record(self, entry):
+    """Append an entry to the journal and flush it to disk."""
+    with self.lock:
+      if self.journal is None:
+        self.journal = open(self.journal_filename, 'a')
+      self.journal.write(json.dumps(entry) + '\n')
+      self.journal.flush()
+      os.fsync(self.journal.fileno())
+
+  def recover(self):
+    """Finish the moves that were started but not completed before the last shutdown, then compact
+    the journal. Return the number of moves that were recovered.
+
+    """
+    if not os.path.exists(self.journal_filename):
+      return 0
+    unfinished = {}
+    f = open(self.journal_filename, 'r')
+    try:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          #the last line may have been cut off by the crash
+          continue
+        if entry.get('op') == 'begin':
+          unfinished[entry['id']] = entry
+        else:
+          unfinished.pop(entry.get('id'), None)
+    finally:
+      f.close()
+
+    recovered = 0
+    for entry in unfinished.values():
+      if entry.get('tmp') and os.path.exists(entry['tmp']):
+        os.remove(entry['tmp'])
+      if os.path.exists(entry['src']):
+        if os.path.exists(entry['dst']):
+          #the copy was renamed into place but the source was not removed yet
+          if os.path.getsize(entry['dst']) == os.path.getsize(entry['src']):
+            os.remove(entry['src'])
+            recovered += 1
+            continue
+        self.print_log("resuming move of %s to %s" % (entry['src'], entry['dst']))
+        try:
+          self.transfer(entry['src'], entry['dst'], entry['id'])
+          recovered += 1
+        except (IOError, OSError), e:
+          self.print_error("could not resume move of %s: %s" % (entry['src'], e))
+      elif os.path.exists(entry['dst']):
+        recovered += 1
+      else:
+        self.print_error("%s was lost in an interrupted move to %s" % (entry['src'], entry['dst']))
+
+    #everything in the journal is finished now
+    with self.lock:
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
+      os.remove(self.journal_filename)
+    return recovered
+
+  def device_slot(self, directory):
+    """Return the semaphore that limits the transfers to the device of the directory."""
+    device = os.stat(directory).st_dev
+    with self.lock:
+      if device not in self.device_slots:
+        self.device_slots[device] = threading.BoundedSemaphore(self.transfers_per_device)
+      return self.device_slots[device]
+
+  def move(self, source, destination):
+    """Move the file to the destination path, creating the destination directory if needed.
+    Raise OSError if the destination already exists.
+
+    """
+    source = os.path.abspath(source)
+    destination = os.path.abspath(destination)
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+    if os.path.exists(destination):
+      raise OSError(errno.EEXIST, "destination already exists", destination)
+    slot = self.device_slot(directory)
+    with slot:
+      self.transfer(source, destination, str(uuid.uuid4()))
+
+  def transfer(self, source, destination, move_id):
+    directory = os.path.dirname(destination)
+    if os.stat(source).st_dev == os.stat(directory).st_dev:
+      #same filesystem, rename is atomic and there is nothing to journal
+      os.rename(source, destination)
+      return
+    temp = os.path.join(directory, '.%s.mediad-part' % os.path.basename(destination))
+    self.record({'op': 'begin', 'id': move_id, 'src': source, 'dst': destination, 'tmp': temp})
+    size = os.path.getsize(source)
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+      destination_fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+      try:
+        copy_data(source_fd, destination_fd, size)
+        os.fsync(destination_fd)
+      finally:
+        os.close(destination_fd)
+    finally:
+      os.close(source_fd)
+    #verify before the source is removed
+    if os.path.getsize(temp) != size:
+      os.remove(temp)
+      raise IOError(errno.EIO, "copy of %s is incomplete" % source)
+    shutil.copystat(source, temp)
+    os.rename(temp, destination)
+    fsync_path(directory)
+    os.remove(source)
+    self.record({'op': 'done', 'id': move_id})
+
+  def submit(self, source, destination, callback=None):
+    """Move the file in the background. callback(source, destination, error) is called when it is done,
+    with error set to None if the move succeeded.
+
+    """
+    if self.pool is None:
+      self.pool = ThreadPool(self.workers)
+    def run():
+      try:
+        self.move(source, destination)
+        error = None
+        self.print_log("moved %s to %s" % (source, destination))
+      except (IOError, OSError), e:
+        error = e
+        self.print_error("could not move %s to %s: %s" % (source, destination, e))
+      if callback:
+        callback(source, destination, error)
+    self.pool.apply_async(run)
+
+  def close(self):
+    """Wait for the submitted moves to finish."""
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    with self.lock:
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
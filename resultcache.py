@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import os
+import time
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+  """
+  An in-memory LRU cache of classification results.
+
+  Results are keyed by the path, size and mtime of the file and the version of the
+  model that classified it, so a repeated request for a file that has not changed
+  is answered after a single stat(), without parsing it or running predict. A file
+  that is still being copied changes size or mtime, and a new model version changes
+  every key, so neither needs an explicit invalidation. Entries are evicted when
+  there are more than max_entries, least recently used first, or ttl seconds after
+  they were added.
+  """
+  def __init__(self, max_entries=10000, ttl=300):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    #the cache is used from the consumer thread and the thread of a LocalClient
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def key(self, filename, version=None):
+    """Return the (path, size, mtime, version) key for the file, or None if it can't be stat'ed."""
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return None
+    return (filename, st.st_size, st.st_mtime, version)
+
+  def get(self, key):
+    """Return (hit, result). A miss is (False, None)."""
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and (self.ttl <= 0 or time.time() - entry[1] < self.ttl):
+        #move it to the most recently used end
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return (True, entry[0])
+      if entry is not None:
+        del self.entries[key]
+      self.misses += 1
+      return (False, None)
+
+  def put(self, key, result):
+    with self.lock:
+      if key in self.entries:
+        del self.entries[key]
+      self.entries[key] = (result, time.time())
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def hit_ratio(self):
+    """Return the share of lookups that were hits, between 0 and 1."""
+    lookups = self.hits + self.misses
+    return float(self.hits) / lookups if lookups else 0.0
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+import time
+import uuid
+import socket
+import heapq
+import itertools
+from collections import deque
+
+class Frame:
+  """Holds the attributes pika passes to callbacks (method frames, queue_declare results)."""
+  def __init__(self, **attributes):
+    self.__dict__.update(attributes)
+
+class StandInBroker:
+  """
+  An in-process stand-in for the RabbitMQ broker, for benchmarks and for trying the
+  daemon without one.
+
+  It implements the parts of the pika BlockingConnection and channel API that the
+  classifier and ClassifyClient use. Everything runs in the calling thread: messages
+  are delivered to the consumers, and due timeouts are run, whenever a connection
+  processes data events. Replies published by a consumer are delivered in the same
+  call, so a client and a classifier can share one broker (and one thread).
+
+  A connection can be made to fail (StandInConnection.fail) to try the consumer's
+  reconnect loop: the messages it did not acknowledge are delivered again, as RabbitMQ
+  does when a connection is lost.
+  """
+  def __init__(self):
+    self.queues = {}
+    #queue name -> list of (channel, callback, no_ack)
+    self.consumers = {}
+    self.timeouts = []
+    self.sequence = itertools.count()
+    self.published = 0
+    self.acknowledged = 0
+    self.redelivered = 0
+
+  def connect(self):
+    """Return a new connection, this can be used as the connection_factory of a Classifier."""
+    return StandInConnection(self)
+
+  def deliver(self):
+    """Deliver every queued message that has a consumer, then run the timeouts that are due.
+    Return the number of messages and timeouts handled.
+
+    """
+    handled = 0
+    busy = True
+    while busy:
+      busy = False
+      for name, messages in self.queues.items():
+        consumers = [consumer for consumer in self.consumers.get(name, ()) if consumer[0].is_open and not consumer[0].connection.failed]
+        while messages and consumers:
+          channel, callback, no_ack = consumers[0]
+          properties, body, redelivered = messages.popleft()
+          channel.delivery_tag += 1
+          if not no_ack:
+            channel.unacked.append((channel.delivery_tag, name, properties, body))
+          callback(channel, Frame(delivery_tag=channel.delivery_tag, routing_key=name, redelivered=redelivered), properties, body)
+          handled += 1
+          busy = True
+          channel.connection.delivered()
+          if channel.connection.failed:
+            break
+      while self.timeouts and self.timeouts[0][0] <= time.time():
+        deadline, sequence, callback = heapq.heappop(self.timeouts)
+        callback()
+        handled += 1
+        busy = True
+    return handled
+
+class StandInConnection:
+  def __init__(self, broker):
+    self.broker = broker
+    self.is_open = True
+    self.channels = []
+    #messages to deliver before the connection fails, None if it should not fail
+    self.fail_after = None
+    self.failed = False
+
+  def channel(self):
+    channel = StandInChannel(self)
+    self.channels.append(channel)
+    return channel
+
+  def fail(self, deliveries=0):
+    """Lose the connection once deliveries more messages have been delivered on it. The next call that
+    processes data events raises socket.error, and the messages that were not acknowledged go back to
+    the front of their queues to be delivered again.
+
+    """
+    self.fail_after = deliveries
+    if deliveries <= 0:
+      self.failed = True
+
+  def delivered(self):
+    if self.fail_after is not None and not self.failed:
+      self.fail_after -= 1
+      if self.fail_after <= 0:
+        self.failed = True
+
+  def check(self):
+    """Raise socket.error if the connection failed, after returning its unacknowledged messages to the broker."""
+    if not self.failed:
+      return
+    if self.is_open:
+      self.is_open = False
+      for channel in self.channels:
+        for tag, name, properties, body in reversed(channel.unacked):
+          self.broker.queues[name].appendleft((properties, body, True))
+          self.broker.redelivered += 1
+        channel.unacked = []
+    raise socket.error("connection lost (stand-in broker)")
+
+  def add_timeout(self, deadline, callback):
+    heapq.heappush(self.broker.timeouts, (time.time() + deadline, next(self.broker.sequence), callback))
+
+  def process_data_events(self, time_limit=0):
+    """Deliver the pending messages. If there are none, wait up to time_limit seconds for a timeout to come due."""
+    self.check()
+    handled = self.broker.deliver()
+    self.check()
+    if handled or not time_limit:
+      return
+    end = time.time() + time_limit
+    while time.time() < end:
+      next_timeout = self.broker.timeouts[0][0] if self.broker.timeouts else end
+      time.sleep(max(0, min(end, next_timeout) - time.time()))
+      handled = self.broker.deliver()
+      self.check()
+      if handled:
+        return
+
+  def close(self):
+    self.is_open = False
+
+class StandInChannel:
+  def __init__(self, connection):
+    self.connection = connection
+    self.broker = connection.broker
+    self.delivery_tag = 0
+    self.unacked = []
+    self.consuming = False
+
+  @property
+  def is_open(self):
+    return self.connection.is_open
+
+  def queue_declare(self, queue='', **kwargs):
+    name = queue or 'amq.gen-%s' % uuid.uuid4()
+    self.broker.queues.setdefault(name, deque())
+    return Frame(method=Frame(queue=name, message_count=len(self.broker.queues[name])))
+
+  def basic_qos(self, **kwargs):
+    pass
+
+  def basic_consume(self, callback, queue, no_ack=False, **kwargs):
+    self.broker.consumers.setdefault(queue, []).append((self, callback, no_ack))
+
+  def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+    self.connection.check()
+    #like the default exchange, a message to a queue that does not exist is dropped
+    if routing_key in self.broker.queues:
+      self.broker.queues[routing_key].append((properties, body, False))
+      self.broker.published += 1
+
+  def basic_ack(self, delivery_tag=0, multiple=False):
+    self.connection.check()
+    if multiple:
+      remaining = [message for message in self.unacked if message[0] > delivery_tag]
+    else:
+      remaining = [message for message in self.unacked if message[0] != delivery_tag]
+    self.broker.acknowledged += len(self.unacked) - len(remaining)
+    self.unacked = remaining
+
+  def start_consuming(self):
+    self.consuming = True
+    while self.consuming and self.is_open:
+      self.connection.process_data_events(time_limit=0.1)
+
+  def stop_consuming(self):
+    self.consuming = False
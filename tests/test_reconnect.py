@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import os
+import sys
+import socket
+import shutil
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+  import pika
+except ImportError:
+  pika = None
+
+import mediad
+from standin import StandInBroker
+
+class Stop(Exception):
+  """Raised from a callback to get out of Classifier.consume(), which otherwise runs forever."""
+
+class RecordingTime:
+  """The time module, with sleep() recording the backoff and moving the clock on instead of waiting."""
+  def __init__(self):
+    self.sleeps = []
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+
+  def time(self):
+    return time.time() + sum(self.sleeps)
+
+  def __getattr__(self, name):
+    return getattr(time, name)
+
+@unittest.skipIf(pika is None, "pika is not installed")
+class ReconnectTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    mediad.log = mediad.Logger(os.path.join(self.directory, 'mediad.log'), False)
+    self.time = RecordingTime()
+    mediad.time = self.time
+    #the feature cache answers for the missing files, so nothing is parsed or predicted
+    self.classifier = mediad.Classifier(os.path.join(self.directory, 'classifyd.pid'),
+                                        logfile_path=os.path.join(self.directory, 'classifyd.log'),
+                                        feature_cache_filename=os.path.join(self.directory, 'features.db'),
+                                        batch_window=0.05, reconnect_max=3, result_cache_size=0)
+    self.broker = StandInBroker()
+    self.connections = []
+    self.replies = {}
+    self.classifier.connection_factory = self.connect
+    client = self.broker.connect().channel()
+    self.reply_queue = client.queue_declare(exclusive=True).method.queue
+    client.basic_consume(self.on_reply, queue=self.reply_queue, no_ack=True)
+    client.queue_declare(queue=self.classifier.amqp_queue, durable=True)
+    self.broker_down = 0
+    self.requests = {}
+    for i in range(3):
+      filename = os.path.join(self.directory, 'missing-%d.avi' % i)
+      self.requests[str(i)] = filename
+      client.basic_publish(exchange='', routing_key=self.classifier.amqp_queue, body=filename,
+                           properties=pika.BasicProperties(reply_to=self.reply_queue, correlation_id=str(i)))
+
+  def tearDown(self):
+    mediad.time = time
+    self.classifier.feature_cache.close()
+    self.classifier.log.close()
+    mediad.log.close()
+    shutil.rmtree(self.directory)
+
+  def connect(self):
+    if len(self.connections) == 4:
+      raise Stop("the consumer did not recover")
+    if self.broker_down and self.connections:
+      self.broker_down -= 1
+      raise socket.error("connection refused")
+    connection = self.broker.connect()
+    self.connections.append(connection)
+    if len(self.connections) == 1:
+      #lost while the first requests are held for their batch, before they are acknowledged
+      connection.fail(deliveries=2)
+    return connection
+
+  def on_reply(self, channel, method, properties, body):
+    self.replies[properties.correlation_id] = body
+    if len(self.replies) == len(self.requests):
+      raise Stop()
+
+  def test_redelivered_after_reconnect(self):
+    self.assertRaises(Stop, self.classifier.consume)
+    self.assertEqual(len(self.connections), 2)
+    #the two requests held when the connection was lost are delivered again and answered once
+    self.assertEqual(self.broker.redelivered, 2)
+    self.assertEqual(self.replies, dict((key, '-1') for key in self.requests))
+    self.assertEqual(self.broker.acknowledged, len(self.requests))
+    self.assertEqual(self.classifier.status.statistics.get('amqp reconnects'), 1)
+    self.assertEqual(self.classifier.counter['reconnects'].value, 1)
+    self.assertEqual(len(self.time.sleeps), 1)
+    self.assertRecovery(sum(self.time.sleeps))
+
+  def assertRecovery(self, seconds):
+    """The recovery time is the backoff, plus the little time the test itself took."""
+    recovery = self.classifier.status.statistics.get('amqp recovery seconds')
+    self.assertTrue(seconds <= recovery < seconds + 0.5, (recovery, seconds))
+    snapshot = self.classifier.recovery.snapshot()
+    self.assertEqual(sum(snapshot['counts']), 1)
+    self.assertAlmostEqual(snapshot['sum'], recovery, places=2)
+
+  def test_backoff(self):
+    #the broker refuses the next three connections after the first one is lost
+    self.broker_down = 3
+    self.assertRaises(Stop, self.classifier.consume)
+    self.assertEqual(len(self.connections), 2)
+    self.assertEqual(self.replies, dict((key, '-1') for key in self.requests))
+    #one reconnect however many attempts it took, with the delay doubling up to reconnect_max
+    self.assertEqual(self.classifier.status.statistics.get('amqp reconnects'), 1)
+    self.assertEqual(self.classifier.counter['reconnects'].value, 1)
+    self.assertEqual(len(self.time.sleeps), 4)
+    for wait, delay in zip(self.time.sleeps, (1, 2, 3, 3)):
+      self.assertTrue(delay * 0.5 <= wait <= delay, (wait, delay))
+    self.assertRecovery(sum(self.time.sleeps))
+
+if __name__ == '__main__':
+  unittest.main()
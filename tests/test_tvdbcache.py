@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tvdbcache import TVDBFetcher, TVDBCache
+
+API_KEY = 'TESTKEY'
+
+SEARCH_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+<Data>
+<Series><seriesid>73244</seriesid><SeriesName>The Office (US)</SeriesName></Series>
+</Data>
+"""
+
+SERIES_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+<Data>
+<Series><id>73244</id><SeriesName>The Office (US)</SeriesName></Series>
+<Episode><seriesid>73244</seriesid><SeasonNumber>2</SeasonNumber><EpisodeNumber>3</EpisodeNumber>
+<EpisodeName>%s</EpisodeName><FirstAired>2005-10-04</FirstAired></Episode>
+</Data>
+"""
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serve the fixture documents the way TheTVDB XML API lays them out."""
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    self.server.requests.append(url.path)
+    if url.path == '/api/GetSeries.php':
+      body = SEARCH_XML if urlparse.parse_qs(url.query).get('seriesname') == ['The Office'] else '<Data></Data>'
+    elif url.path == '/api/%s/series/73244/all/en.xml' % API_KEY:
+      body = SERIES_XML % self.server.episode_name
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/xml')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class TVDBCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FixtureHandler)
+    self.server.requests = []
+    self.server.episode_name = 'The Dundies'
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.mirror = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.cache = TVDBCache(os.path.join(self.directory, 'tvdb.db'), fetcher=TVDBFetcher(API_KEY, self.mirror, timeout=2), ttl=3600)
+
+  def tearDown(self):
+    self.cache.close()
+    self.stop_server()
+    shutil.rmtree(self.directory)
+
+  def stop_server(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.thread.join()
+      self.server = None
+
+  def test_fetcher(self):
+    fetcher = TVDBFetcher(API_KEY, self.mirror, timeout=2)
+    self.assertEqual(fetcher.search('The Office'), [{'id': 73244, 'name': 'The Office (US)'}])
+    self.assertEqual(fetcher.search('Unknown'), [])
+    series, episodes = fetcher.series(73244)
+    self.assertEqual(series['name'], 'The Office (US)')
+    self.assertEqual(episodes, [{'season': 2, 'episode': 3, 'name': 'The Dundies', 'aired': '2005-10-04'}])
+
+  def test_find_series_searches_server(self):
+    self.assertEqual(self.cache.series_names(), [])
+    self.assertEqual(self.cache.find_series('The Office', limit=1), [(73244, 'The Office (US)')])
+    self.assertIn('/api/GetSeries.php', self.server.requests)
+
+  def test_resolve(self):
+    episode = self.cache.resolve('The Office', 2, 3)
+    self.assertEqual(episode, {'series': 'The Office (US)', 'season': 2, 'episode': 3,
+                               'name': 'The Dundies', 'aired': '2005-10-04'})
+    self.assertEqual(self.cache.resolve('The Office', aired='2005-10-04')['name'], 'The Dundies')
+    self.assertIsNone(self.cache.resolve('The Office', 9, 9))
+    self.assertIsNone(self.cache.resolve('Unknown', 1, 1))
+
+  def test_ttl_refresh(self):
+    series_path = '/api/%s/series/73244/all/en.xml' % API_KEY
+    self.assertEqual(self.cache.resolve('The Office', 2, 3)['name'], 'The Dundies')
+    fetched = self.server.requests.count(series_path)
+    #within the ttl the store answers without the server
+    self.server.episode_name = 'Renamed'
+    self.assertEqual(self.cache.resolve('The Office', 2, 3)['name'], 'The Dundies')
+    self.assertEqual(self.server.requests.count(series_path), fetched)
+    #a forced refresh, or one past the ttl, fetches the series again
+    self.assertTrue(self.cache.refresh(73244, force=True))
+    self.assertEqual(self.cache.episode(73244, 2, 3)['name'], 'Renamed')
+    self.server.episode_name = 'Expired'
+    self.cache.ttl = 0
+    self.assertEqual(self.cache.episode(73244, 2, 3)['name'], 'Expired')
+    self.assertEqual(self.server.requests.count(series_path), fetched + 2)
+
+  def test_offline_fallback(self):
+    self.assertEqual(self.cache.resolve('The Office', 2, 3)['name'], 'The Dundies')
+    self.stop_server()
+    self.cache.ttl = 0
+    #the series is stale and the server is gone, the cached data is used as is
+    self.assertTrue(self.cache.refresh(73244))
+    self.assertEqual(self.cache.resolve('The Office', 2, 3)['name'], 'The Dundies')
+    #a series that was never cached cannot be found offline
+    self.assertEqual(self.cache.find_series('Unknown'), [])
+    self.assertFalse(self.cache.refresh(1))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+import os
+import uuid
+import struct
+import cPickle as pickle
+
+class TrainingSet:
+  """
+  The X matrix and y vector of the classifier, stored as a pair of raw row-major files.
+
+  Each file starts with a small fixed-size header (magic, format version, number of
+  columns, the numpy dtype and the generation) followed by the rows. The number of rows
+  is not stored, it follows from the file size, so new rows can be appended without
+  rewriting the file. Loading maps the files with numpy.memmap, so nothing is read until
+  it is used.
+
+  Both files get the same random generation every time they are saved, so an X and a y
+  from different saves (a crash between the two renames) are never paired up.
+  """
+  MAGIC = 'MEDIADTS'
+  VERSION = 2
+  HEADER_FORMAT = '<8sHI16s16s'
+  #version 1 had no generation
+  HEADER_FORMATS = {1: '<8sHI16s', 2: HEADER_FORMAT}
+  HEADER_SIZE = 64
+  X_DTYPE = '<f8'
+  Y_DTYPE = '<i4'
+
+  def __init__(self, X_filename, y_filename):
+    self.X_filename = os.path.abspath(X_filename)
+    self.y_filename = os.path.abspath(y_filename)
+
+  def __repr__(self):
+    return "%s, %s" % (self.X_filename, self.y_filename)
+
+  def header(self, columns, dtype, generation):
+    header = struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, columns, dtype, generation)
+    return header + '\0' * (self.HEADER_SIZE - len(header))
+
+  def read_full_header(self, filename):
+    """Return the (columns, dtype, generation) of the file, or raise ValueError if it is not a training
+    set file. The generation is None for files written before it was recorded.
+
+    """
+    f = open(filename, 'rb')
+    try:
+      data = f.read(self.HEADER_SIZE)
+    finally:
+      f.close()
+    if len(data) < self.HEADER_SIZE:
+      raise ValueError("%s is too short to be a training set file" % filename)
+    magic, version = struct.unpack('<8sH', data[:10])
+    if magic != self.MAGIC:
+      raise ValueError("%s is not a training set file" % filename)
+    if version not in self.HEADER_FORMATS:
+      raise ValueError("%s has version %d, expected %d" % (filename, version, self.VERSION))
+    fields = struct.unpack(self.HEADER_FORMATS[version], data[:struct.calcsize(self.HEADER_FORMATS[version])])
+    return (fields[2], fields[3].rstrip('\0'), fields[4] if version > 1 else None)
+
+  def read_header(self, filename):
+    """Return the (columns, dtype) of the file, or raise ValueError if it is not a training set file."""
+    return self.read_full_header(filename)[:2]
+
+  def is_pickle(self, filename):
+    """Return True if the file was pickled by mediad versions that saved X and y with cPickle."""
+    f = open(filename, 'rb')
+    try:
+      data = f.read(len(self.MAGIC))
+    finally:
+      f.close()
+    #protocol 2 starts with PROTO, the text protocols with an opcode such as 'c' (class) or '(' (mark)
+    return data[:1] in ('\x80', 'c', '(') and data != self.MAGIC
+
+  def rows(self, filename, columns, dtype):
+    """Return the number of complete rows in the file."""
+    import numpy
+    row_size = columns * numpy.dtype(dtype).itemsize
+    return (os.path.getsize(filename) - self.HEADER_SIZE) // row_size
+
+  def map(self, filename, rows):
+    """Map the first rows of the file, read-only."""
+    import numpy
+    columns, dtype = self.read_header(filename)
+    if rows == 0:
+      return numpy.zeros((0, columns), dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=self.HEADER_SIZE, shape=(rows, columns))
+
+  def exists(self):
+    return os.path.exists(self.X_filename) and os.path.exists(self.y_filename)
+
+  def load(self):
+    """Map the X matrix and y vector. Return (X, y), or raise ValueError if the files are not usable.
+    A row that was only partly written (for example, by a crash during an append) is ignored.
+    Pickled files from earlier versions of mediad are converted first.
+
+    """
+    if self.is_pickle(self.X_filename) and self.is_pickle(self.y_filename):
+      self.migrate()
+    X_columns, X_dtype, X_generation = self.read_full_header(self.X_filename)
+    y_columns, y_dtype, y_generation = self.read_full_header(self.y_filename)
+    if X_generation != y_generation:
+      #save() renames X first, so a crash between the renames leaves the new y as a temporary file
+      if not self.finish_save(X_generation):
+        raise ValueError("%s and %s were written by different saves" % (self.X_filename, self.y_filename))
+      y_columns, y_dtype, y_generation = self.read_full_header(self.y_filename)
+    rows = min(self.rows(self.X_filename, X_columns, X_dtype), self.rows(self.y_filename, y_columns, y_dtype))
+    X = self.map(self.X_filename, rows)
+    y = self.map(self.y_filename, rows)
+    return (X, y.reshape(rows))
+
+  def write(self, filename, data, dtype, generation):
+    """Write the whole file to a temporary file, which save() renames into place. Return its filename."""
+    import numpy
+    data = numpy.ascontiguousarray(data, dtype=dtype)
+    columns = data.shape[1] if data.ndim > 1 else 1
+    temp_filename = filename + '.tmp'
+    f = open(temp_filename, 'wb')
+    try:
+      f.write(self.header(columns, dtype, generation))
+      f.write(data.tostring())
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    return temp_filename
+
+  def save(self, X, y):
+    """Replace the stored training set with X and y. Both files are written before either is renamed."""
+    generation = uuid.uuid4().bytes
+    X_temp = self.write(self.X_filename, X, self.X_DTYPE, generation)
+    y_temp = self.write(self.y_filename, y, self.Y_DTYPE, generation)
+    os.rename(X_temp, self.X_filename)
+    os.rename(y_temp, self.y_filename)
+
+  def finish_save(self, generation):
+    """Rename the temporary y file left by an interrupted save into place, if it belongs to the X file's
+    generation. Return True if it did.
+
+    """
+    y_temp = self.y_filename + '.tmp'
+    try:
+      if generation is None or self.read_full_header(y_temp)[2] != generation:
+        return False
+    except (IOError, OSError, ValueError):
+      return False
+    os.rename(y_temp, self.y_filename)
+    return True
+
+  def migrate(self):
+    """Convert X and y pickled by earlier versions of mediad to training set files."""
+    import numpy
+    data = []
+    for filename in (self.X_filename, self.y_filename):
+      f = open(filename, 'rb')
+      try:
+        data.append(numpy.asarray(pickle.load(f)))
+      finally:
+        f.close()
+    self.save(data[0], data[1])
+
+  def truncate(self):
+    """Cut both files to the number of complete rows they have in common, so an interrupted append
+    does not leave the files out of step.
+
+    """
+    import numpy
+    headers = [(filename,) + self.read_header(filename) for filename in (self.X_filename, self.y_filename)]
+    rows = min(self.rows(filename, columns, dtype) for filename, columns, dtype in headers)
+    for filename, columns, dtype in headers:
+      size = self.HEADER_SIZE + rows * columns * numpy.dtype(dtype).itemsize
+      if os.path.getsize(filename) != size:
+        f = open(filename, 'r+b')
+        try:
+          f.truncate(size)
+        finally:
+          f.close()
+
+  def append(self, X_rows, y_rows):
+    """Add rows to the end of the stored training set, without rewriting it."""
+    import numpy
+    X_rows = numpy.ascontiguousarray(X_rows, dtype=self.X_DTYPE)
+    y_rows = numpy.ascontiguousarray(y_rows, dtype=self.Y_DTYPE)
+    if not self.exists():
+      self.save(X_rows, y_rows)
+      return
+    columns, dtype = self.read_header(self.X_filename)
+    if columns != X_rows.shape[1]:
+      raise ValueError("%s has %d columns, the new rows have %d" % (self.X_filename, columns, X_rows.shape[1]))
+    self.truncate()
+    for filename, data in ((self.y_filename, y_rows), (self.X_filename, X_rows)):
+      f = open(filename, 'ab')
+      try:
+        f.write(data.tostring())
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
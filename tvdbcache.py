@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+import os
+import re
+import time
+import sqlite3
+import threading
+import urllib
+import urllib2
+import xml.etree.ElementTree as ElementTree
+
+#words that say nothing about which series a name refers to
+STOP_WORDS = frozenset(('the', 'a', 'an', 'and', 'of', '&'))
+
+def normalize(name):
+  """Return the series name in lower case, with punctuation and separators collapsed to single spaces."""
+  name = name.lower().replace('&', ' and ').replace("'", '')
+  return ' '.join(re.findall(r'[a-z0-9]+', name))
+
+def tokens(name):
+  """Return the set of index tokens for a series name."""
+  words = normalize(name).split()
+  return set(word for word in words if word not in STOP_WORDS) or set(words)
+
+def parse_data(text):
+  """Parse a TheTVDB XML document (a series record, or a full series/all dump).
+  Return a list of (series, episodes) tuples, where series is a dict with id and name, and
+  episodes is a list of dicts with season, episode, name and aired.
+
+  """
+  root = ElementTree.fromstring(text)
+  result = {}
+  order = []
+  for element in root.findall('Series'):
+    try:
+      series_id = int(element.findtext('id') or element.findtext('seriesid'))
+    except (TypeError, ValueError):
+      continue
+    if series_id not in result:
+      order.append(series_id)
+      result[series_id] = ({'id': series_id, 'name': element.findtext('SeriesName') or ''}, [])
+  for element in root.findall('Episode'):
+    try:
+      series_id = int(element.findtext('seriesid'))
+      season = int(element.findtext('SeasonNumber'))
+      episode = int(element.findtext('EpisodeNumber'))
+    except (TypeError, ValueError):
+      continue
+    if series_id not in result:
+      order.append(series_id)
+      result[series_id] = ({'id': series_id, 'name': ''}, [])
+    result[series_id][1].append({'season': season, 'episode': episode,
+                                 'name': element.findtext('EpisodeName') or '',
+                                 'aired': element.findtext('FirstAired') or None})
+  return [result[series_id] for series_id in order]
+
+class TVDBFetcher:
+  """
+  Fetch series and episodes from TheTVDB XML API (or anything that serves the same
+  documents, such as a local mirror). Network errors return None, so callers can fall
+  back to what is cached when the box is offline.
+  """
+  def __init__(self, api_key, mirror='http://thetvdb.com', language='en', timeout=10):
+    self.api_key = api_key
+    self.mirror = mirror.rstrip('/')
+    self.language = language
+    self.timeout = timeout
+
+  def get(self, url):
+    try:
+      response = urllib2.urlopen(url, timeout=self.timeout)
+      try:
+        return response.read()
+      finally:
+        response.close()
+    except (urllib2.URLError, IOError):
+      return None
+
+  def search(self, name):
+    """Return a list of series dicts that match the name, or None if the server could not be reached."""
+    text = self.get("%s/api/GetSeries.php?%s" % (self.mirror, urllib.urlencode({'seriesname': name, 'language': self.language})))
+    if text is None:
+      return None
+    return [series for series, episodes in parse_data(text)]
+
+  def series(self, series_id):
+    """Return the (series, episodes) of the series, or None if the server could not be reached."""
+    text = self.get("%s/api/%s/series/%d/all/%s.xml" % (self.mirror, self.api_key, int(series_id), self.language))
+    if text is None:
+      return None
+    data = parse_data(text)
+    return data[0] if data else None
+
+class TVDBCache:
+  """
+  A local store of TheTVDB series and episodes.
+
+  Series names are indexed by token and episodes by (series, season, episode) and by air
+  date, so resolving a file name to an episode is a local indexed query. Series older than
+  ttl seconds are refreshed through the fetcher when it is reachable, otherwise the cached
+  data is used as is. The store can be seeded offline with import_dump().
+  """
+  def __init__(self, filename, fetcher=None, ttl=7 * 24 * 3600):
+    self.filename = os.path.abspath(filename)
+    self.fetcher = fetcher
+    self.ttl = ttl
+    self.lock = threading.RLock()
+    self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+    self.connection.executescript("""
+      CREATE TABLE IF NOT EXISTS series (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        normalized TEXT NOT NULL,
+        updated REAL NOT NULL);
+      CREATE TABLE IF NOT EXISTS series_tokens (
+        token TEXT NOT NULL,
+        series_id INTEGER NOT NULL,
+        PRIMARY KEY (token, series_id));
+      CREATE TABLE IF NOT EXISTS episodes (
+        series_id INTEGER NOT NULL,
+        season INTEGER NOT NULL,
+        episode INTEGER NOT NULL,
+        name TEXT,
+        aired TEXT,
+        PRIMARY KEY (series_id, season, episode));
+      CREATE INDEX IF NOT EXISTS series_normalized ON series (normalized);
+      CREATE INDEX IF NOT EXISTS episodes_aired ON episodes (series_id, aired);
+    """)
+    self.connection.commit()
+
+  def __repr__(self):
+    return self.filename
+
+  def store(self, series, episodes, updated=None):
+    """Replace the series and its episodes in the store."""
+    updated = time.time() if updated is None else updated
+    with self.lock:
+      self.connection.execute("INSERT OR REPLACE INTO series (id, name, normalized, updated) VALUES (?,?,?,?)",
+                              (series['id'], series['name'], normalize(series['name']), updated))
+      self.connection.execute("DELETE FROM series_tokens WHERE series_id=?", (series['id'],))
+      self.connection.executemany("INSERT OR IGNORE INTO series_tokens (token, series_id) VALUES (?,?)",
+                                  [(token, series['id']) for token in tokens(series['name'])])
+      self.connection.execute("DELETE FROM episodes WHERE series_id=?", (series['id'],))
+      self.connection.executemany("INSERT OR REPLACE INTO episodes (series_id, season, episode, name, aired) VALUES (?,?,?,?,?)",
+                                  [(series['id'], e['season'], e['episode'], e['name'], e['aired']) for e in episodes])
+      self.connection.commit()
+
+  def import_dump(self, path):
+    """Seed the store from TheTVDB XML files (a file, or a directory that is searched for .xml files).
+    Imported series are marked as stale, so they are refreshed when the fetcher is reachable.
+    Return the number of series imported.
+
+    """
+    if os.path.isdir(path):
+      filenames = [os.path.join(directory, filename)
+                   for directory, subdirs, files in os.walk(path)
+                   for filename in files if filename.lower().endswith('.xml')]
+    else:
+      filenames = [path]
+    imported = 0
+    for filename in filenames:
+      f = open(filename, 'rb')
+      try:
+        data = parse_data(f.read())
+      finally:
+        f.close()
+      for series, episodes in data:
+        if series['name']:
+          self.store(series, episodes, updated=0)
+          imported += 1
+    return imported
+
+  def series_names(self):
+    """Return a list of (series id, name) for every series in the store."""
+    with self.lock:
+      return self.connection.execute("SELECT id, name FROM series").fetchall()
+
+  def find_series(self, name, limit=5):
+    """Return up to limit (series id, name) tuples whose names share the most tokens with name,
+    best match first. An exact match of the normalized name always comes first.
+
+    """
+    name_tokens = list(tokens(name))
+    if not name_tokens:
+      return []
+    with self.lock:
+      exact = self.connection.execute("SELECT id, name FROM series WHERE normalized=?", (normalize(name),)).fetchall()
+      rows = self.connection.execute(
+        "SELECT s.id, s.name, COUNT(*) AS shared FROM series_tokens t JOIN series s ON s.id = t.series_id"
+        " WHERE t.token IN (%s) GROUP BY s.id ORDER BY shared DESC, LENGTH(s.name) ASC LIMIT ?" % ','.join('?' * len(name_tokens)),
+        name_tokens + [limit]).fetchall()
+    result = list(exact)
+    for series_id, series_name, shared in rows:
+      if (series_id, series_name) not in result:
+        result.append((series_id, series_name))
+    if not result and self.fetcher:
+      #not seen before, ask the server
+      found = self.fetcher.search(name)
+      for series in (found or [])[:limit]:
+        if self.refresh(series['id']):
+          result.append((series['id'], series['name']))
+    return result[:limit]
+
+  def refresh(self, series_id, force=False):
+    """Fetch the series again if it is older than the ttl. Return True if the series is in the store."""
+    with self.lock:
+      row = self.connection.execute("SELECT updated FROM series WHERE id=?", (series_id,)).fetchone()
+    if row is not None and not force and time.time() - row[0] < self.ttl:
+      return True
+    if self.fetcher is None:
+      return row is not None
+    data = self.fetcher.series(series_id)
+    if data is None:
+      #offline, use the stale data if there is any
+      return row is not None
+    self.store(data[0], data[1])
+    return True
+
+  def episode(self, series_id, season, episode):
+    """Return the episode as a dict (series, season, episode, name, aired), or None if it is unknown."""
+    self.refresh(series_id)
+    with self.lock:
+      row = self.connection.execute(
+        "SELECT s.name, e.season, e.episode, e.name, e.aired FROM episodes e JOIN series s ON s.id = e.series_id"
+        " WHERE e.series_id=? AND e.season=? AND e.episode=?", (series_id, season, episode)).fetchone()
+    return self.episode_dict(row)
+
+  def episode_by_date(self, series_id, aired):
+    """Return the episode of the series that aired on the date (YYYY-MM-DD), or None."""
+    self.refresh(series_id)
+    with self.lock:
+      row = self.connection.execute(
+        "SELECT s.name, e.season, e.episode, e.name, e.aired FROM episodes e JOIN series s ON s.id = e.series_id"
+        " WHERE e.series_id=? AND e.aired=?", (series_id, aired)).fetchone()
+    return self.episode_dict(row)
+
+  def episode_dict(self, row):
+    if row is None:
+      return None
+    return {'series': row[0], 'season': row[1], 'episode': row[2], 'name': row[3], 'aired': row[4]}
+
+  def resolve(self, series_name, season=None, episode=None, aired=None):
+    """Resolve a series name and an episode number (or air date) to the canonical episode.
+    Return the episode dict, or None if it could not be resolved.
+
+    """
+    for series_id, name in self.find_series(series_name, limit=1):
+      if aired:
+        return self.episode_by_date(series_id, aired)
+      return self.episode(series_id, season, episode)
+    return None
+
+  def close(self):
+    self.connection.close()